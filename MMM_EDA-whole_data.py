@@ -1,9 +1,25 @@
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
 import streamlit as st
 import polars as pl
 import pandas as pd
 import datetime as dt
 import plotly.express as px
 
+import data_stats
+import lazy_exec
+import query_trace
+from chart_data import chart_frame
+from figure_cache import FigureCache
+from agg_planner import orders_spec, gmv_spec
+from mmm_features import GROUP_COL
+from mmm_fit import load_best_fits, saved_fits_version
+from eda_queries import EdaQueries, MemoryCache, dashboard_queries, data_version as get_data_version
+from query_filters import make_filters
+from result_cache import DiskCache
+
 
 # from: https://youtu.be/lWxN-n6L7Zc
 # StreamlitAPIException: set_page_config() can only be called once per app, and must be called as the first Streamlit command in your script.
@@ -12,14 +28,20 @@ import plotly.express as px
 
 ############### Setting Configuration ###############
 
+# start of this run of the script, for the debug panel
+render_started, render_timer = time.time(), time.perf_counter()
+
 st.set_page_config(page_title="EDA of Ekart Data",
                     layout='wide', # centered
-                    initial_sidebar_state="collapsed")
+                    initial_sidebar_state="auto")
 
 
 # Setting configuration to diable plotly zoom in plots
 config = dict({'scrollZoom': False})
 
+# Max points of a time series plot, longer series are downsampled (LTTB) to this many
+MAX_CHART_POINTS = int(os.environ.get('EDA_MAX_CHART_POINTS', 1000))
+
 
 
 st.markdown("""<style>.big-font {
@@ -37,14 +59,155 @@ font-size:38px !important;}
 # @st.cache
 # @st.cache_data
 
-# this is to read main data file
+# single parquet file or a Year/Month partitioned dataset directory (see partitioned_dataset.py)
+DATA_PATH = os.environ.get('EDA_DATA_PATH', 'df_consumer_v3.parquet')
+
+# Query results on disk shared by every app process of the machine (see result_cache.py),
+# set EDA_CACHE_DIR to '' to keep them in this process' memory only
+CACHE_DIR = os.environ.get('EDA_CACHE_DIR', '.eda_cache')
+CACHE_MAX_MB = int(os.environ.get('EDA_CACHE_MAX_MB', 1024))
+
+# 'approx' ranks the top pincodes with a sketch when they would be grouped from the data,
+# within EDA_TOPK_EPSILON of the total, 'verify' makes that exact (see topk_sketch.py)
+TOPK_MODE = os.environ.get('EDA_TOPK', 'exact')
+TOPK_EPSILON = float(os.environ.get('EDA_TOPK_EPSILON', 0.001))
+
+# file the query metrics are written to in the Prometheus text format after every render,
+# for a node exporter textfile collector (see query_trace.py)
+TRACE_PROM_FILE = os.environ.get('EDA_TRACE_PROM_FILE', '')
+
+# All the queries of the page (see eda_queries.py), their results are shared by every session
 @st.cache_resource
-def get_data():
-    df = pl.scan_parquet('df_consumer_v3.parquet')
-    
-    return df
+def get_queries():
+    if CACHE_DIR:
+        return EdaQueries(DATA_PATH, cache=DiskCache(CACHE_DIR, max_bytes=CACHE_MAX_MB * 1024 * 1024),
+                          topk=TOPK_MODE, topk_epsilon=TOPK_EPSILON)
+    return EdaQueries(DATA_PATH, cache=MemoryCache(), topk=TOPK_MODE, topk_epsilon=TOPK_EPSILON)
 
-df_consumer = get_data()
+
+# Fingerprint of the data the cached results were computed from
+@st.cache_resource
+def get_cached_data_version():
+    return {}
+
+# {name: st.cache_data function} of the functions over the data, of every run so far
+@st.cache_resource
+def get_data_caches():
+    return {}
+
+# st.cache_data for a function of the data, its results are dropped when the data changes
+def data_cache(func):
+    cached = st.cache_data(func)
+    get_data_caches()[func.__qualname__] = cached
+    return cached
+
+# When new data was appended (or the file replaced) the queries pick it up & drop the results
+# of the old data they keep in memory (see EdaQueries.refresh), and the functions of the page
+# over the data forget theirs. Results come from the rollup cube which
+# `python partitioned_dataset.py append` refreshes for just the new partitions, so recomputing
+# them is cheap. Figures & MMM fits are keyed by the data version, the query threads stay.
+data_version = get_data_version(DATA_PATH)
+if get_cached_data_version().get('version', data_version) != data_version:
+    get_queries().refresh()
+    for cached in get_data_caches().values():
+        cached.clear()
+get_cached_data_version()['version'] = data_version
+
+with query_trace.span('load', 'get_queries'):
+    queries = get_queries()
+df_consumer = queries.df
+
+
+############################## FILTERS ##############################
+# Filters in the sidebar re-drive every chart of the page (see query_filters.py), no filter
+# gives the same queries as before so those stay cached for everyone
+
+def _filter_options(df, col):
+    return sorted(df[col].cast(pl.Utf8).unique().to_list())
+
+def _parse_pincodes(text):
+    pincodes = []
+    for value in text.replace(' ', '').split(','):
+        if not value:
+            continue
+        if not value.isdigit():
+            st.sidebar.warning(f"'{value}' is not a pincode, it is ignored")
+            continue
+        pincodes.append(int(value))
+    return pincodes
+
+all_order_dates = queries.total_orders(['date_only'], 'order_id')['date_only']
+full_date_range = (all_order_dates.min(), all_order_dates.max())
+
+with st.sidebar:
+    st.header('Filters')
+    filter_dates = st.date_input('Order Dates', value=full_date_range,
+                                 min_value=full_date_range[0], max_value=full_date_range[1])
+    filter_categories = st.multiselect('Product Analytic Category',
+                                       _filter_options(queries.total_orders(['product_analytic_category'], 'order_id'), 'product_analytic_category'))
+    filter_payment_types = st.multiselect('Payment Type',
+                                          _filter_options(queries.percof_group(['Year','order_payment_type']), 'order_payment_type'))
+    filter_pincodes = _parse_pincodes(st.text_input('Pincodes (comma separated)'))
+
+# the date input gives a single date while the end of the range is being picked
+page_filters = make_filters(date_range=tuple(filter_dates) if len(filter_dates) == 2 else None,
+                            categories=filter_categories,
+                            payment_types=filter_payment_types,
+                            pincodes=filter_pincodes,
+                            full_date_range=full_date_range)
+
+# Threads running the page's queries in the background, polars releases the GIL while it works
+@st.cache_resource
+def get_query_pool():
+    return ThreadPoolExecutor(max_workers=8, thread_name_prefix='eda-query')
+
+# The queries behind each option of the radios below, the options not picked aren't shown so
+# their queries wait until they are. Both options of gmv_option7 chart the cohort matrix & the
+# data demo's stat summary isn't prefetched, it only runs once its checkbox is ticked.
+OPTION_QUERIES = {
+    'gmv_option1': {'No': [('daily_orders', (None, MAX_CHART_POINTS))],
+                    'Yes': [('daily_gmv', (None, MAX_CHART_POINTS)), ('aggregate', (gmv_spec(['date_only']),))]},
+    'gmv_option2': {'No': [('aggregate', (orders_spec(['Year','Month']),))],
+                    'Yes': [('aggregate', (gmv_spec(['Year','Month']),))]},
+    'gmv_option3': {'No': [('aggregate', (orders_spec(['Hour']),))],
+                    'Yes': [('aggregate', (orders_spec(['Year','Hour']),))]},
+    'gmv_option4': {'No': [('aggregate', (orders_spec(['product_analytic_category']),))],
+                    'Yes': [('aggregate', (orders_spec(['Year','product_analytic_category']),))]},
+    'gmv_option5': {'No': [('aggregate', (gmv_spec(['product_analytic_category']),))],
+                    'Yes': [('aggregate', (gmv_spec(['Year','product_analytic_category']),))]},
+    'gmv_option6': {'No': [('aggregate', (orders_spec(['Year','Month','product_analytic_category']),))],
+                    'Yes': [('aggregate', (gmv_spec(['Year','Month','product_analytic_category']),))]},
+}
+
+# the radios come later in the script, their picks are in the session state from the last run
+# ('No' before the first one)
+hidden_queries = [query for key, option_queries in OPTION_QUERIES.items()
+                  for option, option_query_list in option_queries.items() if option != st.session_state.get(key, 'No')
+                  for query in option_query_list]
+
+# The queries are independent so all of them start now, before the sidebar's totals, instead
+# of one after another as the script reaches them. The totals & every section below only wait
+# for their own results.
+queries.prefetch(get_query_pool(), dashboard_queries(MAX_CHART_POINTS, page_filters, skip=hidden_queries))
+
+# orders & gmv of the filtered data, from the bitmap index (see bitmap_index.py) when there is one
+filtered_totals = queries.filtered_totals(page_filters)
+with st.sidebar:
+    st.metric('Orders', f"{filtered_totals['total_orders'][0]:,}")
+    st.metric('GMV', f"{filtered_totals['total_gmv'][0]:,.0f}")
+
+############################## FILTERS DONE ##############################
+
+
+# Row count from the parquet footer so the header doesn't need to read the data
+@data_cache
+def get_row_count():
+    return queries.row_count()
+
+# describe() summary saved next to the data file & reused till the file changes
+@data_cache
+def get_stat_summary():
+    return pd.DataFrame(queries.stat_summary()).reindex(data_stats.STAT_NAMES)
 
 ############################## DATA DONE ##############################
 
@@ -62,52 +225,50 @@ def v_spacer(height, sb=False) -> None:
             st.write('\n')
 
 
+# Finished figures shared by every session & rerun, built again only when the data, the
+# sidebar filters or the code of the chart changes
+@st.cache_resource
+def get_figure_cache():
+    return FigureCache()
+
+# `key` is anything else the figure depends on, the name stays the same for every one of them
+def cached_figure(name, build, *key):
+    return get_figure_cache().get_figure(name, (data_version, page_filters) + key, build)
+
+
 # Total Orders Function
-@st.cache_data
-def Calc_total_orders(groupof,count_of):
-    return (df_consumer.groupby(groupof).agg( 
-                total_orders = pl.count(count_of)
-            ).sort(groupof).collect()
-            )
+@data_cache
+def Calc_total_orders(groupof,count_of,filters=None):
+    return queries.total_orders(groupof, count_of, filters)
 
 # Total GMV Function
-@st.cache_data
-def Calc_total_gmv(groupof,sum_of):
-    return (df_consumer.groupby(groupof).agg(
-                total_gmv = pl.sum(sum_of)
-            ).sort(groupof).collect()
-            )
-
-@st.cache_data
-def Calc_countof_group(groupof):
-    return (df_consumer.groupby(groupof).count().collect()
-            )
-
-@st.cache_data
-def Calc_percof_group(groupof):
-    return (df_consumer.groupby(groupof).count().with_columns(
-                total_orders = pl.sum('count').over('Year') 
-            ).with_columns(
-                perc_sales = (pl.col('count') / pl.col('total_orders') * 100 ).round(2)
-            ).collect()
-                    )
+@data_cache
+def Calc_total_gmv(groupof,sum_of,filters=None):
+    return queries.total_gmv(groupof, sum_of, filters)
+
+@data_cache
+def Calc_countof_group(groupof,filters=None):
+    return queries.countof_group(groupof, filters)
+
+@data_cache
+def Calc_percof_group(groupof,filters=None):
+    return queries.percof_group(groupof, filters)
 
 
 # Since cust_id is not available in slim data so below code will give error if slim data is used
-@st.cache_data()
-def get_Repeated_customer_df():
+@data_cache
+def get_Repeated_customer_df(filters=None):
+    return queries.repeat_customers(base_year=2015, by='order_payment_type', filters=filters)
 
-    customer_2015_list = df_consumer.filter(pl.col('Year') == 2015).select('cust_id').unique().collect().to_series().to_list()
+@data_cache
+def get_cohort_df(filters=None):
+    return queries.cohort_retention(filters)
 
-    return (df_consumer.select(pl.col(['Year','cust_id','order_payment_type'])).filter(pl.col('Year') > 2015).with_columns(
-            Repeat_cust_over_Year = pl.when(pl.col('cust_id').is_in(customer_2015_list)
-                                            ).then('Customer_Repeat_from_2015').otherwise('New_Customer')
-                                            ).groupby(['Repeat_cust_over_Year','order_payment_type']).count().with_columns(
-                                                total_count = pl.sum('count').over(pl.col('order_payment_type'))
-                                            ).with_columns(
-                                                perc_count = (pl.col('count') / pl.col('total_count') * 100 ).round(2)
-                            ).collect()
-)
+# Best MMM fit of every category & its weekly fitted gmv, as saved by mmm_fit.py or warm_cache.py
+# (the page never fits the grid itself), cached per version of the saved fits
+@st.cache_data()
+def get_mmm_best_fits(version):
+    return load_best_fits(queries)
 
 
 ############### Custom Functions Ends ###############
@@ -137,7 +298,7 @@ with header_mid:
     st.write(f"(App Work Under Progress) This is a demo webapp for **Consumer Electronics** data which was 1st built in **R** and is now replicated using **Python & Polars** in streamlit.   \
              As every Modeling Process first needs good **EDA** (Exploratary Data Analysis) to get business insights so this App is focused on EDA before the **Market Mix Modelling**.    \
              Eleckart Data used in this is from kaggle -  https://www.kaggle.com/datasets/ashydv/consumer-electronics-data or https://drive.google.com/drive/folders/1F5O1thcC43zAPxsWIw1WQMh58Qi5I5CB. \
-               \n\n Note: - Lot of Data Pre processing & Cleaning has been done before creating the Plots. It has 2 years of data and {df_consumer.collect().height} number of Rows after Data Cleaning." )
+               \n\n Note: - Lot of Data Pre processing & Cleaning has been done before creating the Plots. It has 2 years of data and {get_row_count()} number of Rows after Data Cleaning." )
 ############################## TOP CONTENT END ##############################
 
 
@@ -151,12 +312,16 @@ with header_mid:
 
 
 
-with st.expander("Click here to View the Demo of the Data"):
+# a checkbox instead of an expander, what's in a collapsed expander still runs every time
+if st.checkbox("Click here to View the Demo of the Data"):
 
-    tab11, tab21 = st.tabs(["🗃 Data Demo","📈 Stat Summary"])
+    demo_option = st.radio("Demo of the Data",options=["🗃 Data Demo","📈 Stat Summary"], horizontal=True, key=8,
+                           label_visibility='collapsed')
 
-    tab11.dataframe(df_consumer.head(10).collect().to_pandas())
-    tab21.dataframe(df_consumer.collect().to_pandas().describe()) #head(10).collect().to_pandas()
+    if demo_option == "🗃 Data Demo":
+        st.dataframe(df_consumer.head(10).collect().to_arrow())
+    else:
+        st.dataframe(get_stat_summary()) #head(10).collect().to_pandas()
 
 v_spacer(4)    
 
@@ -170,52 +335,58 @@ with col_12:
 
 plt_box_1,plt_box_2 = st.columns([7,1],gap = "small")
 
-@st.cache_data
-def df_overall_orders(): 
-    return (df_consumer.groupby(['date_only']).agg( 
-                                            total_orders = pl.count('order_id')
-                                        ).sort('date_only').collect().to_pandas())
+# daily series are downsampled to MAX_CHART_POINTS, a short enough date_range gets every day
+@data_cache
+def df_overall_orders(date_range=None, filters=None): 
+    return queries.daily_orders(date_range, MAX_CHART_POINTS, filters)
 
-@st.cache_data
-def df_overall_gmv():
-    return (df_consumer.groupby(['date_only']).agg( 
-                                                total_gmv = pl.sum('gmv')
-                                            ).sort('date_only').collect().to_pandas())
+@data_cache
+def df_overall_gmv(date_range=None, filters=None):
+    return queries.daily_gmv(date_range, MAX_CHART_POINTS, filters)
 
 with plt_box_1:
-    # if gmv_option1 == "No":
-    tab12, tab22 = st.tabs(["Total Orders","Total GMV"])
-
-    fig_overall_orders = px.line(df_overall_orders(),
-                                x='date_only',y='total_orders', #line_group='total_orders',
-                                # hover_name='Party',
-                                labels={
-                                        "date_only": "Order Date",
-                                        "total_orders": "Total Orders"
-                                    },
+    order_dates = Calc_total_orders(groupof=['date_only'],count_of='order_id',filters=page_filters)['date_only']
+    if order_dates.is_empty():
+        st.warning('No orders match the filters in the sidebar.')
+        st.stop()
+    zoom_dates = st.slider("Zoom into Order Dates", min_value=order_dates.min(), max_value=order_dates.max(),
+                           value=(order_dates.min(), order_dates.max()))
+    # the whole range is the same query as no range, the one warm_cache.py precomputes
+    date_range = None if zoom_dates == (order_dates.min(), order_dates.max()) else zoom_dates
+
+    gmv_option1 = st.radio("Total GMV instead of Total Orders?",options=['No','Yes'], horizontal=True, key='gmv_option1')
+
+    if gmv_option1 == "No":
+        fig_overall_orders = cached_figure('fig_overall_orders', lambda: px.line(chart_frame(df_overall_orders(date_range, page_filters)),
+                                    x='date_only',y='total_orders', #line_group='total_orders',
+                                    # hover_name='Party',
+                                    labels={
+                                            "date_only": "Order Date",
+                                            "total_orders": "Total Orders"
+                                        },
                             
-                            title=f'<b>Overall Total Orders </b>'
-    )
+                                title=f'<b>Overall Total Orders </b>'
+        ), date_range)
 
 
-    tab12.plotly_chart(fig_overall_orders,use_container_width=True, config = config)
+        st.plotly_chart(fig_overall_orders,use_container_width=True, config = config)
 
-    fig_overall_gmv = px.line(df_overall_gmv(),
-                                x='date_only',y='total_gmv', 
-                                # hover_name='Party',
-                                labels={
-                                        "date_only": "Order Date",
-                                        "total_gmv": "Total GMV"
-                                    },
+    else:
+        fig_overall_gmv = cached_figure('fig_overall_gmv', lambda: px.line(chart_frame(df_overall_gmv(date_range, page_filters)),
+                                    x='date_only',y='total_gmv', 
+                                    # hover_name='Party',
+                                    labels={
+                                            "date_only": "Order Date",
+                                            "total_gmv": "Total GMV"
+                                        },
                             
-                            title=f'<b>Overall Total GMV</b>'
-    )
+                                title=f'<b>Overall Total GMV</b>'
+        ), date_range)
 
-    tab22.plotly_chart(fig_overall_gmv,use_container_width=True, config = config)
+        st.plotly_chart(fig_overall_gmv,use_container_width=True, config = config)
     
 with plt_box_2:
     # v_spacer(3)
-    # gmv_option1 = st.radio("Total GMV instead of Total Orders?",options=['No','Yes'], horizontal=True, key=1)
     
     v_spacer(15)
     st.write(f"As we can see in the Plot there is only 2 years (2015,2016) of Data.")
@@ -234,59 +405,58 @@ st.markdown("""---""")
 
 plt_box_12,plt_box_22 = st.columns([1,1],gap = "small")
 
-@st.cache_data
-def df_monthly_orders():
-    return (Calc_total_orders(groupof=['Year','Month'],count_of='order_id'
-                                                            ).to_pandas())
-@st.cache_data
-def df_monthly_gmv():
-    return (Calc_total_gmv(groupof=['Year','Month'],sum_of='gmv'
-                                                        ).to_pandas())
-@st.cache_data
-def df_hr_total_orders():
-    return (Calc_total_orders(groupof=['Hour'],count_of='order_id'
-                                                            ).to_pandas())
-
-@st.cache_data
-def df_hr_total_orders_facet():
-    return (Calc_total_orders(groupof=['Year','Hour'],count_of='order_id'
-                                                            ).to_pandas())
+@data_cache
+def df_monthly_orders(filters=None):
+    return (Calc_total_orders(groupof=['Year','Month'],count_of='order_id',filters=filters
+                                                            ))
+@data_cache
+def df_monthly_gmv(filters=None):
+    return (Calc_total_gmv(groupof=['Year','Month'],sum_of='gmv',filters=filters
+                                                        ))
+@data_cache
+def df_hr_total_orders(filters=None):
+    return (Calc_total_orders(groupof=['Hour'],count_of='order_id',filters=filters
+                                                            ))
+
+@data_cache
+def df_hr_total_orders_facet(filters=None):
+    return (Calc_total_orders(groupof=['Year','Hour'],count_of='order_id',filters=filters
+                                                            ))
 
 
 with plt_box_12:
     
     # v_spacer(3)
-    # gmv_option2 = st.radio("In below Plot - Use Total GMV instead of Total Orders?",options=['No','Yes'], horizontal=True, key=2)
+    gmv_option2 = st.radio("In below Plot - Use Total GMV instead of Total Orders?",options=['No','Yes'], horizontal=True, key='gmv_option2')
 
-    tab13, tab23 = st.tabs(["Total Orders","Total GMV"])
 
-    # if gmv_option2 == "No":
-    fig_monthly_overall_orders = px.line(df_monthly_orders(),
-                                x='Month',y='total_orders', facet_col='Year',
-                                # hover_name='Party',
-                                labels={
-                                        "date_only": "Order Date",
-                                        "total_orders": "Total Orders"
-                                    },
+    if gmv_option2 == "No":
+        fig_monthly_overall_orders = cached_figure('fig_monthly_overall_orders', lambda: px.line(chart_frame(df_monthly_orders(page_filters)),
+                                    x='Month',y='total_orders', facet_col='Year',
+                                    # hover_name='Party',
+                                    labels={
+                                            "date_only": "Order Date",
+                                            "total_orders": "Total Orders"
+                                        },
                             
-                            title=f'<b>Overall Total Orders by Months</b>'
-    )
-
-    tab13.plotly_chart(fig_monthly_overall_orders,use_container_width=True, config = config)
-
-    # else:
-    fig_monthly_overall_gmv = px.line(df_monthly_gmv(),
-                        x='Month',y='total_gmv', facet_col='Year',
-                        # hover_name='Party',
-                        labels={
-                                "date_only": "Order Date",
-                                "total_gmv": "Total GMV"
-                            },
+                                title=f'<b>Overall Total Orders by Months</b>'
+        ))
+
+        st.plotly_chart(fig_monthly_overall_orders,use_container_width=True, config = config)
+
+    else:
+        fig_monthly_overall_gmv = cached_figure('fig_monthly_overall_gmv', lambda: px.line(chart_frame(df_monthly_gmv(page_filters)),
+                            x='Month',y='total_gmv', facet_col='Year',
+                            # hover_name='Party',
+                            labels={
+                                    "date_only": "Order Date",
+                                    "total_gmv": "Total GMV"
+                                },
                     
-                    title=f'<b>Overall Total GMV by Months</b>'
-)
+                        title=f'<b>Overall Total GMV by Months</b>'
+    ))
 
-    tab23.plotly_chart(fig_monthly_overall_gmv,use_container_width=True, config = config)
+        st.plotly_chart(fig_monthly_overall_gmv,use_container_width=True, config = config)
     # v_spacer(2)
     st.write(f"In 2015 the Max value was in Month of October and after a small decline the values have been pretty much constant.")
     
@@ -294,36 +464,35 @@ with plt_box_12:
 with plt_box_22:
     
     # v_spacer(3)
-    # gmv_option3 = st.radio("In below Plot - Split by Years?",options=['No','Yes'], horizontal=True, key=3)
-    tab15, tab25 = st.tabs(["Orders by Hours","Orders by Hours Split by Years"])
+    gmv_option3 = st.radio("In below Plot - Split by Years?",options=['No','Yes'], horizontal=True, key='gmv_option3')
     
 
-    # if gmv_option3 == "No":
-    fig_hourly_overall_orders = px.line(df_hr_total_orders(),
-                                x='Hour',y='total_orders',
-                                # hover_name='Party',
-                                labels={
-                                        "Hour": "Hour of Day",
-                                        "total_orders": "Total Orders"
-                                    },
+    if gmv_option3 == "No":
+        fig_hourly_overall_orders = cached_figure('fig_hourly_overall_orders', lambda: px.line(chart_frame(df_hr_total_orders(page_filters)),
+                                    x='Hour',y='total_orders',
+                                    # hover_name='Party',
+                                    labels={
+                                            "Hour": "Hour of Day",
+                                            "total_orders": "Total Orders"
+                                        },
                             
-                            title=f'<b>Overall Total Orders by Hour of the Day</b>'
-    )
-    tab15.plotly_chart(fig_hourly_overall_orders,use_container_width=True, config = config)
-
-    # else:
-    fig_hourly_overall_orders_facet = px.line(df_hr_total_orders_facet(),
-                        x='Hour',y='total_orders', facet_col='Year',
-                        # hover_name='Party',
-                        labels={
-                                "Hour": "Hour of Day",
-                                "total_gmv": "Total GMV"
-                            },
+                                title=f'<b>Overall Total Orders by Hour of the Day</b>'
+        ))
+        st.plotly_chart(fig_hourly_overall_orders,use_container_width=True, config = config)
+
+    else:
+        fig_hourly_overall_orders_facet = cached_figure('fig_hourly_overall_orders_facet', lambda: px.line(chart_frame(df_hr_total_orders_facet(page_filters)),
+                            x='Hour',y='total_orders', facet_col='Year',
+                            # hover_name='Party',
+                            labels={
+                                    "Hour": "Hour of Day",
+                                    "total_gmv": "Total GMV"
+                                },
                     
-                    title=f'<b>Overall Total Orders by Hour of the Day</b>'
-)
+                        title=f'<b>Overall Total Orders by Hour of the Day</b>'
+    ))
 
-    tab25.plotly_chart(fig_hourly_overall_orders_facet,use_container_width=True, config = config)
+        st.plotly_chart(fig_hourly_overall_orders_facet,use_container_width=True, config = config)
     
     # v_spacer(2)
     st.write(f"As it can be seen in the Plot that the Orders decline in the early hours of the day and is min around 5 am  \
@@ -345,9 +514,9 @@ col_31,col_32,col_33 = st.columns([3,4,2],gap = "small")
 with col_32:
     st.markdown('<p class="big-font">By Payment Method Type</p>', unsafe_allow_html=True)
 
-fig_payment_type = px.bar(
+fig_payment_type = cached_figure('fig_payment_type', lambda: px.bar(
                             # Calc_countof_group(groupof=['Year','order_payment_type']).to_pandas(),
-                            Calc_percof_group(groupof=['Year','order_payment_type']).to_pandas(),
+                            chart_frame(Calc_percof_group(groupof=['Year','order_payment_type'],filters=page_filters)),
                     y='count',x='order_payment_type', color='order_payment_type',facet_col= 'Year',
                     orientation='v',
                     category_orders={'Year':[2015,2016],
@@ -360,11 +529,11 @@ fig_payment_type = px.bar(
                 
                 title=f'<b>Total Orders by Payment type</b>'
                 
-).update_layout(height = 550)
+).update_layout(height = 550))
 
 
-fig_payment_type_perc = px.bar(
-                            Calc_percof_group(groupof=['Year','order_payment_type']).to_pandas(),
+fig_payment_type_perc = cached_figure('fig_payment_type_perc', lambda: px.bar(
+                            chart_frame(Calc_percof_group(groupof=['Year','order_payment_type'],filters=page_filters)),
                     y='perc_sales',x='order_payment_type', color='order_payment_type',facet_col= 'Year',
                     orientation='v',
                     category_orders={'Year':[2015,2016],
@@ -377,7 +546,7 @@ fig_payment_type_perc = px.bar(
                 
                 title=f'<b>Percntage Orders by Payment type</b>'
                 
-).update_layout(height = 550)
+).update_layout(height = 550))
 
 col_41,col_42 = st.columns([1,1],gap = "small")
 
@@ -409,7 +578,7 @@ col_51,col_52,col_53 = st.columns([3,8,2],gap = "small")
 with col_52:
     st.markdown('<p class="big-font">Repeat/New Customer Payment Method</p>', unsafe_allow_html=True)
 
-fig_payment_type_repeat_cust = px.bar(get_Repeated_customer_df().to_pandas(),
+fig_payment_type_repeat_cust = cached_figure('fig_payment_type_repeat_cust', lambda: px.bar(chart_frame(get_Repeated_customer_df(page_filters)),
                     y='count',x='Repeat_cust_over_Year', color='order_payment_type',
                     orientation='v',
                     category_orders={'Repeat_cust_over_Year': ['Customer_Repeat_2015','New_Customer']},
@@ -420,10 +589,10 @@ fig_payment_type_repeat_cust = px.bar(get_Repeated_customer_df().to_pandas(),
                 
                 title=f'<b>Count of New/ Repeated Customers in 2016 coming from 2015</b>'
                 
-).update_layout(height = 550)
+).update_layout(height = 550))
 
 
-fig_payment_type_repeat_cust_type = px.bar(get_Repeated_customer_df().to_pandas(),
+fig_payment_type_repeat_cust_type = cached_figure('fig_payment_type_repeat_cust_type', lambda: px.bar(chart_frame(get_Repeated_customer_df(page_filters)),
                     y='count',x='order_payment_type', color='Repeat_cust_over_Year',
                     orientation='v',
                     # category_orders={'Repeat_cust_over_Year': ['Customer_Repeat_2015','New_Customer']},
@@ -435,7 +604,7 @@ fig_payment_type_repeat_cust_type = px.bar(get_Repeated_customer_df().to_pandas(
                 
                 title=f'<b>Count of New/ Repeated Customers in 2016 coming from 2015 - by Payment type</b>'
                 
-).update_layout(height = 550)
+).update_layout(height = 550))
 
 
 col_61,col_62 = st.columns([1,1],gap = "small")
@@ -456,6 +625,64 @@ st.markdown("""---""")
 
 
 
+################################## CUSTOMER COHORTS  ##########################
+
+
+col_91,col_92,col_93 = st.columns([3,8,2],gap = "small")
+with col_92:
+    st.markdown('<p class="big-font">Customer Cohorts by First Order Month</p>', unsafe_allow_html=True)
+
+# cohorts labelled by their month, plotly can't color by a date column
+def cohort_frame():
+    return get_cohort_df(page_filters).with_columns(pl.col('cohort').dt.strftime('%Y-%m'))
+
+# cohorts as rows & months since the first order as columns
+def cohort_heatmap_frame(values):
+    return (cohort_frame()
+                .pivot(values=values, index='cohort', columns='months_since_first_order', aggregate_function='first')
+                .sort('cohort'))
+
+gmv_option7 = st.radio("In below Plot - GMV per Customer instead of Retention?",options=['No','Yes'], horizontal=True, key='gmv_option7')
+
+if gmv_option7 == "No":
+    fig_cohort_retention = cached_figure('fig_cohort_retention', lambda: px.imshow(
+                        chart_frame(cohort_heatmap_frame('retention')).set_index('cohort'),
+                        text_auto='.0f', aspect='auto', color_continuous_scale='Blues',
+                        labels={
+                                "x": "Months since first order",
+                                "y": "Cohort (first order month)",
+                                "color": "% of cohort ordering"
+                            },
+                
+                    title=f'<b>Monthly Retention of every Customer Cohort</b>'
+                
+    ).update_layout(height = 550))
+    st.plotly_chart(fig_cohort_retention,use_container_width=True, config = config)
+
+else:
+    fig_cohort_gmv = cached_figure('fig_cohort_gmv', lambda: px.line(chart_frame(cohort_frame()),
+                        x='months_since_first_order', y='gmv_per_customer', color='cohort',
+                        labels={
+                                "months_since_first_order": "Months since first order",
+                                "gmv_per_customer": "GMV per Customer so far",
+                                "cohort": "Cohort"
+                            },
+                
+                    title=f'<b>Cumulative GMV per Customer of every Cohort</b>'
+                
+    ).update_layout(height = 550))
+    st.plotly_chart(fig_cohort_gmv,use_container_width=True, config = config)
+
+st.write("Every row is the customers who ordered for the first time in that month, and every column the share of them \
+         ordering again that many months later. Their GMV per customer keeps growing with their repeat orders.")
+
+st.markdown("""---""") 
+ 
+################################## CUSTOMER COHORTS End  ##########################
+
+
+
+
 
 
 
@@ -470,96 +697,94 @@ with col_22:
 
 plt_box_13,plt_box_23 = st.columns([1,1],gap = "small")
 
-@st.cache_data
-def df_product_analytic_category_orders():
-    return (Calc_total_orders(groupof=['product_analytic_category'],count_of='order_id'
-                                                              ).to_pandas())
-
-@st.cache_data
-def df_product_analytic_category_orders_facet():
-    return (Calc_total_orders(groupof=['Year','product_analytic_category'],count_of='order_id'
-                                                              ).to_pandas())
-@st.cache_data
-def df_product_analytic_category_gmv():
-    return (Calc_total_gmv(groupof=['product_analytic_category'],sum_of='gmv'
-                                                                ).to_pandas())
-@st.cache_data
-def df_product_analytic_category_gmv_facet():
-    return (Calc_total_gmv(groupof=['Year','product_analytic_category'],sum_of='gmv'
-                                                                ).to_pandas())
+@data_cache
+def df_product_analytic_category_orders(filters=None):
+    return (Calc_total_orders(groupof=['product_analytic_category'],count_of='order_id',filters=filters
+                                                              ))
+
+@data_cache
+def df_product_analytic_category_orders_facet(filters=None):
+    return (Calc_total_orders(groupof=['Year','product_analytic_category'],count_of='order_id',filters=filters
+                                                              ))
+@data_cache
+def df_product_analytic_category_gmv(filters=None):
+    return (Calc_total_gmv(groupof=['product_analytic_category'],sum_of='gmv',filters=filters
+                                                                ))
+@data_cache
+def df_product_analytic_category_gmv_facet(filters=None):
+    return (Calc_total_gmv(groupof=['Year','product_analytic_category'],sum_of='gmv',filters=filters
+                                                                ))
 
 
 with plt_box_13:
     
     # v_spacer(3)
-    # gmv_option4 = st.radio("In below Plot - Split by Years?",options=['No','Yes'], horizontal=True, key=4)
-    tab16, tab26 = st.tabs(["Total Orders","Total Orders Split By Years"])
+    gmv_option4 = st.radio("In below Plot - Split by Years?",options=['No','Yes'], horizontal=True, key='gmv_option4')
 
     
-    # if gmv_option4 == "No":
-    fig_product_analytic_category_orders = px.pie(df_product_analytic_category_orders(),
-                                values='total_orders',names='product_analytic_category',
-                                # orientation='h',
-                                labels={
-                                        "total_orders": "Total Orders"
-                                    },
+    if gmv_option4 == "No":
+        fig_product_analytic_category_orders = cached_figure('fig_product_analytic_category_orders', lambda: px.pie(chart_frame(df_product_analytic_category_orders(page_filters)),
+                                    values='total_orders',names='product_analytic_category',
+                                    # orientation='h',
+                                    labels={
+                                            "total_orders": "Total Orders"
+                                        },
                             
-                            title=f'<b>Overall Total Orders by product_analytic_category</b>'
-    ).update_traces(textposition='inside', textinfo='percent+label+value')
-    # .update_yaxes(type='category', categoryorder='max ascending')
-
-    tab16.plotly_chart(fig_product_analytic_category_orders,use_container_width=True, config = config)
-
-    # else:
-    fig_product_analytic_category_orders_facet = px.bar(df_product_analytic_category_orders_facet(),
-                        x='total_orders',y='product_analytic_category', facet_col='Year',
-                        orientation='h',
-                        # hover_name='Party',
-                        labels={
-                                "total_gmv": "Total GMV"
-                            },
+                                title=f'<b>Overall Total Orders by product_analytic_category</b>'
+        ).update_traces(textposition='inside', textinfo='percent+label+value'))
+        # .update_yaxes(type='category', categoryorder='max ascending')
+
+        st.plotly_chart(fig_product_analytic_category_orders,use_container_width=True, config = config)
+
+    else:
+        fig_product_analytic_category_orders_facet = cached_figure('fig_product_analytic_category_orders_facet', lambda: px.bar(chart_frame(df_product_analytic_category_orders_facet(page_filters)),
+                            x='total_orders',y='product_analytic_category', facet_col='Year',
+                            orientation='h',
+                            # hover_name='Party',
+                            labels={
+                                    "total_gmv": "Total GMV"
+                                },
                     
-                    title=f'<b>Overall Total Orders by product_analytic_category</b>'
+                        title=f'<b>Overall Total Orders by product_analytic_category</b>'
                     
-    ).update_yaxes(type='category', categoryorder='max ascending')
+        ).update_yaxes(type='category', categoryorder='max ascending'))
     
-    tab26.plotly_chart(fig_product_analytic_category_orders_facet,use_container_width=True, config = config)
+        st.plotly_chart(fig_product_analytic_category_orders_facet,use_container_width=True, config = config)
     
 
 
 with plt_box_23:
 
-    # gmv_option5 = st.radio("In below Plot - Split by Years?",options=['No','Yes'], horizontal=True, key=5)
-    tab17, tab27 = st.tabs(["Total GMV","Total GMV Split By Years"])
+    gmv_option5 = st.radio("In below Plot - Split by Years?",options=['No','Yes'], horizontal=True, key='gmv_option5')
 
-    # if gmv_option5 == "No":
-    fig_product_analytic_category_gmv = px.pie(df_product_analytic_category_gmv(),
-                                values='total_gmv',names='product_analytic_category',
-                                # orientation='h',
-                                labels={
-                                        "total_gmv": "Total GMV"
-                                    },
+    if gmv_option5 == "No":
+        fig_product_analytic_category_gmv = cached_figure('fig_product_analytic_category_gmv', lambda: px.pie(chart_frame(df_product_analytic_category_gmv(page_filters)),
+                                    values='total_gmv',names='product_analytic_category',
+                                    # orientation='h',
+                                    labels={
+                                            "total_gmv": "Total GMV"
+                                        },
                             
-                            title=f'<b>Overall Total GMV by product_analytic_category</b>'
-    ).update_traces(textposition='inside', textinfo='percent+label+value')
-    # .update_yaxes(type='category', categoryorder='max ascending')
-
-    tab17.plotly_chart(fig_product_analytic_category_gmv,use_container_width=True, config = config)
-
-    # else:
-    fig_product_analytic_category_gmv_facet = px.bar(df_product_analytic_category_gmv_facet(),
-                                x='total_gmv',y='product_analytic_category',facet_col='Year',
-                                orientation='h',
-                                # hover_name='Party',
-                                labels={
-                                        "total_gmv": "Total GMV"
-                                    },
+                                title=f'<b>Overall Total GMV by product_analytic_category</b>'
+        ).update_traces(textposition='inside', textinfo='percent+label+value'))
+        # .update_yaxes(type='category', categoryorder='max ascending')
+
+        st.plotly_chart(fig_product_analytic_category_gmv,use_container_width=True, config = config)
+
+    else:
+        fig_product_analytic_category_gmv_facet = cached_figure('fig_product_analytic_category_gmv_facet', lambda: px.bar(chart_frame(df_product_analytic_category_gmv_facet(page_filters)),
+                                    x='total_gmv',y='product_analytic_category',facet_col='Year',
+                                    orientation='h',
+                                    # hover_name='Party',
+                                    labels={
+                                            "total_gmv": "Total GMV"
+                                        },
                             
-                            title=f'<b>Overall Total GMV by product_analytic_category</b>'
+                                title=f'<b>Overall Total GMV by product_analytic_category</b>'
                     
-    ).update_yaxes(type='category', categoryorder='max ascending')
+        ).update_yaxes(type='category', categoryorder='max ascending'))
     
-    tab27.plotly_chart(fig_product_analytic_category_gmv_facet,use_container_width=True, config = config)
+        st.plotly_chart(fig_product_analytic_category_gmv_facet,use_container_width=True, config = config)
     
 
 # st.divider()
@@ -576,39 +801,38 @@ st.markdown("---")
 #################################  By product_analytic_category Line facet plots ##########################
 
 # v_spacer(3)
-# gmv_option6 = st.radio("In below Plot - Use Total GMV instead of Total Orders??",options=['No','Yes'], horizontal=True, key=6)
-tab14, tab24 = st.tabs(["Total Orders","Total GMV"])
-
-# if gmv_option6 == "No":
-fig_product_analytic_category_orders_facet = px.line(Calc_total_orders(groupof=['Year','Month','product_analytic_category'],count_of='order_id'
-                                                        ).to_pandas(),
-                    y='total_orders',x='Month', facet_row= 'Year', facet_col= 'product_analytic_category',
-                    # orientation='h',
-                    # hover_name='Party',
-                    labels={
-                            "total_orders": "Total Orders"
-                        },
+gmv_option6 = st.radio("In below Plot - Use Total GMV instead of Total Orders??",options=['No','Yes'], horizontal=True, key='gmv_option6')
+
+if gmv_option6 == "No":
+    fig_product_analytic_category_orders_facet = cached_figure('fig_product_analytic_category_orders_facet_by_month', lambda: px.line(chart_frame(Calc_total_orders(groupof=['Year','Month','product_analytic_category'],count_of='order_id',filters=page_filters
+                                                              )),
+                        y='total_orders',x='Month', facet_row= 'Year', facet_col= 'product_analytic_category',
+                        # orientation='h',
+                        # hover_name='Party',
+                        labels={
+                                "total_orders": "Total Orders"
+                            },
                 
-                title=f'<b>Overall Total Orders by product_analytic_category</b>'
+                    title=f'<b>Overall Total Orders by product_analytic_category</b>'
                 
-).update_layout(height = 650)
-tab14.plotly_chart(fig_product_analytic_category_orders_facet,use_container_width=True, config = config)
-
-# else:
-fig_product_analytic_category_gmv_facet = px.line(Calc_total_gmv(groupof=['Year','Month','product_analytic_category'],sum_of='gmv'
-                                                        ).to_pandas(),
-                    y='total_gmv',x='Month', facet_row= 'Year', facet_col= 'product_analytic_category',
-                    # orientation='h',
-                    # hover_name='Party',
-                    labels={
-                            "total_gmv": "Total GMV"
-                        },
+    ).update_layout(height = 650))
+    st.plotly_chart(fig_product_analytic_category_orders_facet,use_container_width=True, config = config)
+
+else:
+    fig_product_analytic_category_gmv_facet = cached_figure('fig_product_analytic_category_gmv_facet_by_month', lambda: px.line(chart_frame(Calc_total_gmv(groupof=['Year','Month','product_analytic_category'],sum_of='gmv',filters=page_filters
+                                                              )),
+                        y='total_gmv',x='Month', facet_row= 'Year', facet_col= 'product_analytic_category',
+                        # orientation='h',
+                        # hover_name='Party',
+                        labels={
+                                "total_gmv": "Total GMV"
+                            },
                 
-                title=f'<b>Overall Total GMV by product_analytic_category</b>'
+                    title=f'<b>Overall Total GMV by product_analytic_category</b>'
                 
-).update_layout(height = 650)
+    ).update_layout(height = 650))
 
-tab24.plotly_chart(fig_product_analytic_category_gmv_facet,use_container_width=True, config = config)
+    st.plotly_chart(fig_product_analytic_category_gmv_facet,use_container_width=True, config = config)
     
 
 # st.divider()
@@ -639,23 +863,23 @@ plt_box_14,plt_box_24 = st.columns([1,1],gap = "small")
 #     return (Calc_total_orders(groupof=['product_analytic_sub_category'],count_of='order_id'
 #                                                               ).to_pandas())
 
-@st.cache_data
-def df_product_analytic_subcategory_orders_facet():
-    return (Calc_total_orders(groupof=['Year','product_analytic_sub_category'],count_of='order_id'
-                                                              ).to_pandas())
+@data_cache
+def df_product_analytic_subcategory_orders_facet(filters=None):
+    return (Calc_total_orders(groupof=['Year','product_analytic_sub_category'],count_of='order_id',filters=filters
+                                                              ))
 # @st.cache_data
 # def df_product_analytic_subcategory_gmv():
 #     return (Calc_total_gmv(groupof=['product_analytic_sub_category'],sum_of='gmv'
 #                                                                 ).to_pandas())
-@st.cache_data
-def df_product_analytic_subcategory_gmv_facet():
-    return (Calc_total_gmv(groupof=['Year','product_analytic_sub_category'],sum_of='gmv'
-                                                                ).to_pandas())
+@data_cache
+def df_product_analytic_subcategory_gmv_facet(filters=None):
+    return (Calc_total_gmv(groupof=['Year','product_analytic_sub_category'],sum_of='gmv',filters=filters
+                                                                ))
 
 
 with plt_box_14:
     
-    fig_product_analytic_subcategory_orders_facet = px.bar(df_product_analytic_subcategory_orders_facet(),
+    fig_product_analytic_subcategory_orders_facet = cached_figure('fig_product_analytic_subcategory_orders_facet', lambda: px.bar(chart_frame(df_product_analytic_subcategory_orders_facet(page_filters)),
                         x='total_orders',y='product_analytic_sub_category', facet_col='Year',
                         orientation='h',
                         # hover_name='Party',
@@ -665,7 +889,7 @@ with plt_box_14:
                     
                     title=f'<b>Overall Total Orders by product_analytic_subcategory</b>'
                     
-    ).update_yaxes(type='category', categoryorder='max ascending') # 
+    ).update_yaxes(type='category', categoryorder='max ascending')) # 
     
     st.plotly_chart(fig_product_analytic_subcategory_orders_facet,use_container_width=True, config = config)
     
@@ -673,7 +897,7 @@ with plt_box_14:
 
 with plt_box_24:
 
-    fig_product_analytic_subcategory_gmv_facet = px.bar(df_product_analytic_subcategory_gmv_facet(),
+    fig_product_analytic_subcategory_gmv_facet = cached_figure('fig_product_analytic_subcategory_gmv_facet', lambda: px.bar(chart_frame(df_product_analytic_subcategory_gmv_facet(page_filters)),
                                 x='total_gmv',y='product_analytic_sub_category',facet_col='Year',
                                 orientation='h',
                                 # hover_name='Party',
@@ -683,7 +907,7 @@ with plt_box_24:
                             
                             title=f'<b>Overall Total GMV by product_analytic_subcategory</b>'
                     
-    ).update_yaxes(type='category', categoryorder='max ascending') #
+    ).update_yaxes(type='category', categoryorder='max ascending')) #
     
     st.plotly_chart(fig_product_analytic_subcategory_gmv_facet,use_container_width=True, config = config)
 
@@ -712,24 +936,18 @@ with col_82:
 plt_box_15,plt_box_25 = st.columns([1,1],gap = "small")
 
 
-@st.cache_data
-def df_pincode_orders_facet():
-    return (Calc_total_orders(groupof=['Year','pincode'],count_of='order_id'
-                              ).sort(['Year','total_orders'], descending=[True,True]
-                                     ).groupby(['Year'], maintain_order=True
-                                               ).head(15).to_pandas())
+@data_cache
+def df_pincode_orders_facet(filters=None):
+    return queries.top_pincodes('total_orders', 15, filters)
 
-@st.cache_data
-def df_pincode_gmv_facet():
-    return (Calc_total_gmv(groupof=['Year','pincode'],sum_of='gmv'
-                            ).sort(['Year','total_gmv'], descending=[True,True]
-                                     ).groupby(['Year'], maintain_order=True
-                                               ).head(15).to_pandas())
+@data_cache
+def df_pincode_gmv_facet(filters=None):
+    return queries.top_pincodes('total_gmv', 15, filters)
 
 
 with plt_box_15:
     
-    fig_pincode_orders_facet = px.bar(df_pincode_orders_facet(),
+    fig_pincode_orders_facet = cached_figure('fig_pincode_orders_facet', lambda: px.bar(chart_frame(df_pincode_orders_facet(page_filters)),
                         x='total_orders',y='pincode', facet_col='Year',
                         orientation='h',
                         # hover_name='Party',
@@ -740,7 +958,7 @@ with plt_box_15:
                     
                     title=f'<b>Top 15 Pincodes by Total Orders in respective Years</b>'
                     
-    ).update_yaxes(type='category', categoryorder='max ascending') # 
+    ).update_yaxes(type='category', categoryorder='max ascending')) # 
     
     st.plotly_chart(fig_pincode_orders_facet,use_container_width=True, config = config)
     
@@ -748,7 +966,7 @@ with plt_box_15:
 
 with plt_box_25:
 
-    fig_pincode_gmv_facet = px.bar(df_pincode_gmv_facet(),
+    fig_pincode_gmv_facet = cached_figure('fig_pincode_gmv_facet', lambda: px.bar(chart_frame(df_pincode_gmv_facet(page_filters)),
                                 x='total_gmv',y='pincode',facet_col='Year',
                                 orientation='h',
                                 # hover_name='Party',
@@ -759,7 +977,7 @@ with plt_box_25:
                             
                             title=f'<b>Top 15 Pincodes by Total GMV in respective Years</b>'
                     
-    ).update_yaxes(type='category', categoryorder='max ascending') #
+    ).update_yaxes(type='category', categoryorder='max ascending')) #
     
     st.plotly_chart(fig_pincode_gmv_facet,use_container_width=True, config = config)
     
@@ -774,3 +992,93 @@ st.markdown("---")
 
 
 
+
+##################################  MMM FITS  #########################
+
+
+col_101,col_102,col_103 = st.columns([3,8,2],gap = "small")
+with col_102:
+    st.markdown('<p class="big-font">Best Market Mix Model fit by Category</p>', unsafe_allow_html=True)
+
+mmm_version = saved_fits_version(queries)
+mmm_fits = None if mmm_version is None else get_mmm_best_fits(mmm_version)
+
+if mmm_fits is None:
+    st.info(f"No Market Mix Model fits of this data yet, run `python mmm_fit.py {DATA_PATH}` (or warm_cache.py) to fit them.")
+else:
+    mmm_best, mmm_fitted = mmm_fits
+
+    st.write("Weekly GMV of every category regressed on the adstocked & saturated weekly orders of every payment type \
+             and the GMV of the weeks before, for every decay, saturation & ridge alpha of the grid. The best fit has the \
+             lowest error (MAPE %) on the last weeks, which are left out of the fit. These use all of the data, \
+             the sidebar filters don't apply here.")
+
+    st.dataframe(mmm_best.to_pandas().round(3), use_container_width=True)
+
+    mmm_category = st.selectbox('Category', mmm_best[GROUP_COL].to_list())
+
+    fig_mmm_fit = cached_figure('fig_mmm_fit', lambda: px.line(
+                        chart_frame(mmm_fitted.filter(pl.col(GROUP_COL) == mmm_category), ['week', 'gmv', 'fitted']),
+                        x='week', y=['gmv', 'fitted'],
+                        labels={
+                                "week": "Week",
+                                "value": "GMV",
+                                "variable": ""
+                            },
+                
+                    title=f'<b>Weekly GMV & the best fit of {mmm_category}</b> (held out weeks shaded)'
+                
+    ).add_vrect(x0=mmm_fitted.filter(pl.col(GROUP_COL) == mmm_category).filter(pl.col('holdout'))['week'].min(),
+                x1=mmm_fitted['week'].max(), fillcolor='grey', opacity=0.15, line_width=0
+    ).update_layout(height = 450), mmm_category, mmm_version)
+    st.plotly_chart(fig_mmm_fit,use_container_width=True, config = config)
+
+st.markdown("---")
+
+##################################  MMM FITS End  #########################
+
+
+
+
+############################## DEBUG PANEL ##############################
+# Traces of the queries, pandas conversions & chart builds (see query_trace.py), shown with
+# ?debug=1 in the page's url
+
+query_trace.record('render', 'page', time.perf_counter() - render_timer)
+
+if TRACE_PROM_FILE:
+    query_trace.tracer.write_prometheus(TRACE_PROM_FILE)
+
+if st.experimental_get_query_params().get('debug') == ['1']:
+    st.header('Debug')
+    query_trace.set_capture_plans(st.checkbox('Capture the plans of the queries computed from now on',
+                                              value=query_trace.CAPTURE_PLANS))
+
+    render_spans = query_trace.tracer.recent(since=render_started)
+    st.subheader(f'This render ({time.perf_counter() - render_timer:.2f}s)')
+    if render_spans:
+        spans_df = pd.DataFrame([span.to_dict() for span in render_spans]).drop(columns=['plan'])
+        spans_df['start'] = spans_df['start'] - render_started
+        st.dataframe(spans_df.sort_values('seconds', ascending=False), use_container_width=True)
+
+    st.subheader('Since the process started')
+    st.dataframe(pd.DataFrame(query_trace.tracer.summary()), use_container_width=True)
+
+    for span in render_spans:
+        if span.plan:
+            with st.expander(f'Plan of {span.kind} {span.label} ({span.seconds:.3f}s)'):
+                st.code(span.plan)
+
+    if lazy_exec.STREAMING:
+        # reported only on the run computing it, it is saved with the data's stats after that
+        st.caption("The data summary (Stat Summary) never streams, its quantiles read each numeric column "
+                   "into memory, one column at a time, when it is computed for a new version of the data.")
+    if lazy_exec.not_streamed:
+        st.subheader('Plans not fully streamed')
+        st.json(lazy_exec.not_streamed)
+
+    st.download_button('Download the traces (JSON)', query_trace.tracer.to_json(), 'eda_trace.json', 'application/json')
+    st.download_button('Download the metrics (Prometheus text)', query_trace.tracer.prometheus_text(),
+                       'eda_metrics.prom', 'text/plain')
+
+############################## DEBUG PANEL END ##############################
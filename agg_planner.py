@@ -0,0 +1,156 @@
+from typing import NamedTuple, Optional, Tuple
+
+import polars as pl
+
+import lazy_exec
+from data_schema import sort_exprs
+
+
+# Computes many (group keys, metric) aggregations of the same LazyFrame together.
+#
+# Requests whose keys are a subset of another request's keys are rolled up from that finer
+# "grain" instead of grouping the raw data again, and all grains go into one union plan so
+# polars' common subplan elimination reads the parquet file only once for the whole page.
+
+
+# agg is one of:
+#   'count' -> non null count of `column` (like pl.count(column))
+#   'sum'   -> sum of `column`
+#   'rows'  -> number of rows in the group (like groupby().count()), column is None
+class AggSpec(NamedTuple):
+    groupof: Tuple[str, ...]
+    agg: str
+    column: Optional[str]
+    alias: str
+
+
+def orders_spec(groupof, count_of='order_id', alias='total_orders'):
+    return AggSpec(tuple(groupof), 'count', count_of, alias)
+
+def gmv_spec(groupof, sum_of='gmv', alias='total_gmv'):
+    return AggSpec(tuple(groupof), 'sum', sum_of, alias)
+
+def rows_spec(groupof, alias='count'):
+    return AggSpec(tuple(groupof), 'rows', None, alias)
+
+
+_GRAIN_ID = '__grain'
+
+
+# name of the metric column inside a grain, shared by every spec using that metric
+def metric_name(spec):
+    if spec.agg == 'rows':
+        return '__rows'
+    return f'__{spec.agg}__{spec.column}'
+
+
+def metric_expr(spec):
+    if spec.agg == 'rows':
+        return pl.count().alias(metric_name(spec))
+    if spec.agg == 'count':
+        return pl.count(spec.column).alias(metric_name(spec))
+    if spec.agg == 'sum':
+        return pl.sum(spec.column).alias(metric_name(spec))
+    raise ValueError(f"Unknown aggregation '{spec.agg}', expected one of 'count', 'sum', 'rows'")
+
+
+# Assign every spec to the grain it will be rolled up from.
+# Biggest key sets become grains first, smaller ones join the first grain that contains them.
+def plan_grains(specs):
+    grains = []
+    for keys in sorted({frozenset(spec.groupof) for spec in specs}, key=len, reverse=True):
+        if not any(keys <= grain for grain in grains):
+            grains.append(keys)
+
+    plan = {}
+    for spec in specs:
+        grain = next(grain for grain in grains if frozenset(spec.groupof) <= grain)
+        plan.setdefault(grain, []).append(spec)
+
+    return plan
+
+
+# coarser result out of an already aggregated grain, counts & sums both roll up by summing
+def rollup(grain_df, grain_keys, spec):
+    metric = metric_name(spec)
+    groupof = list(spec.groupof)
+
+    if set(groupof) == set(grain_keys):
+        out = grain_df.select(groupof + [pl.col(metric).alias(spec.alias)])
+    else:
+        out = grain_df.groupby(groupof).agg(pl.sum(metric).alias(spec.alias))
+
+    return out.sort(sort_exprs(out, groupof))
+
+
+class AggPlanner:
+
+    # parts: df as one LazyFrame per file (see partitioned_dataset.scan_parts), so grains can be
+    # streamed file by file
+    def __init__(self, df, parts=None):
+        self.df = df
+        self.parts = parts or [df]
+        self.specs = []
+
+    def add(self, spec):
+        if spec not in self.specs:
+            self.specs.append(spec)
+        return spec
+
+    @staticmethod
+    def _grain_plan(df, grain_id, grain, specs):
+        metrics = {metric_name(spec): metric_expr(spec) for spec in specs}
+        return df.groupby(sorted(grain)).agg(list(metrics.values())).with_columns(
+            pl.lit(grain_id).alias(_GRAIN_ID)
+        )
+
+    # every grain of every part streamed on its own, a grain's counts & sums add up over the parts
+    def _collect_grains_by_part(self, plan):
+        plans = [self._grain_plan(part, grain_id, grain, specs)
+                 for grain_id, (grain, specs) in enumerate(plan.items()) for part in self.parts]
+        partials = lazy_exec.collect_all(plans, label='aggregations [parts]')
+
+        frames = []
+        for grain_id, grain in enumerate(plan):
+            grain_partials = partials[grain_id * len(self.parts):(grain_id + 1) * len(self.parts)]
+            metrics = [col for col in grain_partials[0].columns if col not in grain and col != _GRAIN_ID]
+            frames.append(pl.concat(grain_partials).groupby(sorted(grain)).agg(
+                [pl.sum(metric).cast(grain_partials[0].schema[metric]) for metric in metrics]))
+        return frames
+
+    # {grain keys: [specs]} -> {grain keys: aggregated grain DataFrame}
+    # every grain holds all metrics of its specs & all grains come from one union plan
+    # so the shared scan is cached & read once. The union doesn't stream though, in streaming
+    # mode (see lazy_exec.py) every grain is its own streamed plan reading the data again, one
+    # per file when there are several.
+    def collect_grains(self, plan):
+        grain_plans = [self._grain_plan(self.df, grain_id, grain, specs)
+                       for grain_id, (grain, specs) in enumerate(plan.items())]
+
+        if not grain_plans:
+            return {}
+        if lazy_exec.by_part(self.parts):
+            frames = self._collect_grains_by_part(plan)
+        elif lazy_exec.STREAMING:
+            frames = lazy_exec.collect_all(grain_plans, label='aggregations')
+        else:
+            if len(grain_plans) == 1:
+                combined = lazy_exec.collect(grain_plans[0], label='aggregations')
+            else:
+                combined = lazy_exec.collect(pl.concat(grain_plans, how='diagonal'), label='aggregations')
+            frames = [combined.filter(pl.col(_GRAIN_ID) == grain_id) for grain_id in range(len(grain_plans))]
+
+        grains = {}
+        for frame, (grain, specs) in zip(frames, plan.items()):
+            metrics = list(dict.fromkeys(metric_name(spec) for spec in specs))
+            grains[grain] = frame.select(sorted(grain) + metrics)
+
+        return grains
+
+    # All added specs in one go as {spec: DataFrame}
+    def collect(self):
+        plan = plan_grains(self.specs)
+        grains = self.collect_grains(plan)
+
+        return {spec: rollup(grains[grain], grain, spec)
+                for grain, specs in plan.items() for spec in specs}
@@ -0,0 +1,147 @@
+import argparse
+import json
+import os
+import resource
+import statistics
+import time
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+
+import polars as pl
+
+from eda_queries import EdaQueries
+from rollup_cube import build_cube
+from synthetic_data import generate
+
+
+# Benchmarks of the app's aggregation helpers on synthetic data (see synthetic_data.py), without
+# streamlit. Every helper runs in a fresh process so its wall time & peak RSS are its own:
+#
+#     python benchmark.py --rows 1m 10m 100m --save bench_today.json
+#     python benchmark.py --rows 1m 10m 100m --compare bench_today.json
+#
+# Data files are generated once into --data-dir & reused by later runs.
+
+
+# the app's queries on the raw data, no cube & nothing cached so every run does the full work
+def _queries(path):
+    return EdaQueries(path, cache=None, use_cube=False, use_index=False, batch_page_aggs=False)
+
+
+# helper name -> function(data path) running the same query as the app
+HELPERS = {
+    'Calc_total_orders': lambda path: _queries(path).total_orders(['Year', 'Month', 'product_analytic_category']),
+    'Calc_total_gmv': lambda path: _queries(path).total_gmv(['Year', 'Month', 'product_analytic_category']),
+    'Calc_percof_group': lambda path: _queries(path).percof_group(['Year', 'order_payment_type']),
+    'get_Repeated_customer_df': lambda path: _queries(path).repeat_customers(2015, 'order_payment_type'),
+    'df_pincode_orders_facet': lambda path: _queries(path).top_pincodes('total_orders', 15),
+    'df_pincode_gmv_facet': lambda path: _queries(path).top_pincodes('total_gmv', 15),
+    'build_cube': lambda path: pl.DataFrame({'rows': [
+        frame.height for frame in build_cube(path).frames.values()]}),
+}
+
+
+def _peak_rss_mb():
+    # VmHWM starts over in a new process, ru_maxrss keeps the parent's peak from before the fork
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    # in KB on linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def _run_helper(name, path):
+    rss_before = _peak_rss_mb()
+
+    start = time.perf_counter()
+    out = HELPERS[name](path)
+    wall = time.perf_counter() - start
+
+    return {'wall_s': wall, 'peak_rss_mb': _peak_rss_mb(), 'rss_added_mb': _peak_rss_mb() - rss_before,
+            'out_rows': out.height}
+
+
+def parse_rows(value):
+    value = value.lower().replace('_', '')
+    for suffix, factor in (('k', 1_000), ('m', 1_000_000), ('b', 1_000_000_000)):
+        if value.endswith(suffix):
+            return int(float(value[:-len(suffix)]) * factor)
+    return int(value)
+
+
+def data_path(data_dir, n_rows, skew, seed):
+    return os.path.join(data_dir, f'synthetic_{n_rows}_s{skew}_{seed}.parquet')
+
+
+# {rows: {helper: median result of `repeat` runs}}
+def run_benchmarks(sizes, helpers, data_dir, repeat=1, skew=0.9, seed=0):
+    os.makedirs(data_dir, exist_ok=True)
+    results = {}
+
+    for n_rows in sizes:
+        path = data_path(data_dir, n_rows, skew, seed)
+        if not os.path.exists(path):
+            print(f'Generating {n_rows:,} rows into {path} ...')
+            generate(path, n_rows, skew=skew, seed=seed)
+
+        results[n_rows] = {}
+        for name in helpers:
+            runs = []
+            for _ in range(repeat):
+                # fresh process for every run so the RSS numbers are the helper's alone
+                with ProcessPoolExecutor(max_workers=1, mp_context=get_context('spawn')) as pool:
+                    runs.append(pool.submit(_run_helper, name, path).result())
+
+            result = {key: statistics.median(run[key] for run in runs) for key in runs[0]}
+            result['rows_per_s'] = n_rows / result['wall_s']
+            results[n_rows][name] = result
+
+            print(f'{n_rows:>13,}  {name:<26} {result["wall_s"]:>9.3f}s {result["rows_per_s"] / 1e6:>9.1f}M rows/s'
+                  f' {result["peak_rss_mb"]:>9.0f} MB peak')
+
+    return results
+
+
+def print_comparison(results, previous):
+    print(f'\n{"rows":>13}  {"helper":<26} {"wall now":>10} {"wall before":>12} {"change":>8} {"peak MB now/before":>20}')
+    for n_rows, helpers in results.items():
+        for name, result in helpers.items():
+            before = previous.get(str(n_rows), {}).get(name)
+            if before is None:
+                continue
+            change = (result['wall_s'] / before['wall_s'] - 1) * 100
+            print(f'{n_rows:>13,}  {name:<26} {result["wall_s"]:>9.3f}s {before["wall_s"]:>11.3f}s {change:>+7.1f}%'
+                  f' {result["peak_rss_mb"]:>10.0f}/{before["peak_rss_mb"]:.0f}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the aggregation helpers on synthetic data.')
+    parser.add_argument('--rows', nargs='+', type=parse_rows, default=[1_000_000],
+                        help='dataset sizes, e.g. 1m 10m 500m')
+    parser.add_argument('--helpers', nargs='+', choices=list(HELPERS), default=list(HELPERS))
+    parser.add_argument('--data-dir', default='bench_data')
+    parser.add_argument('--repeat', type=int, default=1, help='runs per helper, the median is reported')
+    parser.add_argument('--skew', type=float, default=0.9)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--streaming', action='store_true', help="run the queries on polars' streaming engine")
+    parser.add_argument('--save', help='write the results to this JSON file')
+    parser.add_argument('--compare', help='JSON file of an earlier run to compare with')
+    args = parser.parse_args()
+
+    if args.streaming:
+        # read by lazy_exec when the helper processes import it
+        os.environ['EDA_STREAMING'] = '1'
+
+    results = run_benchmarks(args.rows, args.helpers, args.data_dir, args.repeat, args.skew, args.seed)
+
+    if args.compare:
+        with open(args.compare) as f:
+            print_comparison(results, json.load(f))
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=2)
@@ -0,0 +1,357 @@
+import argparse
+import json
+import os
+import shutil
+import time
+
+import numpy as np
+import polars as pl
+
+from data_schema import sort_exprs
+from data_stats import source_fingerprint
+from partitioned_dataset import scan_source
+from query_filters import VALUE_FILTERS, whole_months
+
+
+# Bitmap index of the data for filtered counts & sums over the dimensions the page slices by,
+# answered in about a millisecond without reading the data. Built offline with:
+#
+#     python bitmap_index.py df_consumer_v3.parquet
+#
+# and saved as numpy files in `<data file>.index/` along with the data's fingerprint, an index
+# built from an older version of the data is ignored (rebuild it after an append).
+#
+# For every distinct value of an INDEX_COLUMNS column it keeps the rows having it: as a bitmap
+# packed 8 rows per byte when the value is common, as the sorted row numbers when it is rare
+# (a bitmap of a pincode would be almost all zeros). Filters are ANDs of ORs of those, counted
+# by popcount. Every column also keeps the code of its value in every row & the rows keep their
+# gmv, so a group by over the selected rows is a bincount of their codes.
+#
+# The rollup cube answers filters on the columns of its cuboids, the index answers the ones it
+# can't, like a pincode filter on the sub category charts.
+
+
+INDEX_SUFFIX = '.index'
+MANIFEST_FILE = 'manifest.json'
+
+# changes when the files of the index change, indexes of an older format are ignored
+INDEX_FORMAT = 1
+
+# Month is there so whole month date ranges can be filtered too
+INDEX_COLUMNS = ['product_analytic_category', 'product_analytic_sub_category', 'order_payment_type',
+                 'Year', 'Month', 'pincode']
+
+# the metrics the index can sum, (agg, column) of an AggSpec
+INDEX_METRICS = {('count', 'order_id'), ('sum', 'gmv'), ('rows', None)}
+
+# set bits of every byte
+POPCOUNT = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+
+
+def index_dir(source_path):
+    return str(source_path).rstrip('/') + INDEX_SUFFIX
+
+
+def popcount(bitmap):
+    return int(POPCOUNT[bitmap].sum(dtype=np.int64))
+
+
+def _bitmap_of_ids(ids, n_bytes):
+    bitmap = np.zeros(n_bytes, dtype=np.uint8)
+    if len(ids):
+        byte_idx = ids >> 3
+        bits = (np.uint8(0x80) >> (ids & 7).astype(np.uint8)).astype(np.uint8)
+        # ids are sorted so the bits of a byte are next to each other
+        starts = np.flatnonzero(np.r_[True, byte_idx[1:] != byte_idx[:-1]])
+        bitmap[byte_idx[starts]] = np.bitwise_or.reduceat(bits, starts)
+    return bitmap
+
+
+def _bits_set(bitmap, ids):
+    return ((bitmap[ids >> 3] >> (7 - (ids & 7)).astype(np.uint8)) & 1).astype(bool)
+
+
+# Rows of the data, as a packed bitmap or as sorted row numbers (whichever it was made from)
+class RowSet:
+
+    def __init__(self, n_rows, bitmap=None, ids=None):
+        self.n_rows = n_rows
+        self.bitmap = bitmap
+        self.ids = ids
+
+    def __len__(self):
+        return len(self.ids) if self.ids is not None else popcount(self.bitmap)
+
+    def as_bitmap(self):
+        if self.bitmap is None:
+            return _bitmap_of_ids(self.ids, (self.n_rows + 7) // 8)
+        return self.bitmap
+
+    def row_ids(self):
+        if self.ids is None:
+            return np.flatnonzero(np.unpackbits(self.bitmap, count=self.n_rows))
+        return self.ids
+
+    # values of the rows in the set out of an array with a value per row
+    def gather(self, values):
+        if self.ids is None:
+            # a mask beats the row numbers when many rows are selected
+            return values[np.unpackbits(self.bitmap, count=self.n_rows).view(bool)]
+        return values[self.ids]
+
+    def __and__(self, other):
+        if self.ids is not None and other.ids is not None:
+            return RowSet(self.n_rows, ids=np.intersect1d(self.ids, other.ids, assume_unique=True))
+        if self.ids is not None or other.ids is not None:
+            sparse, dense = (self, other) if self.ids is not None else (other, self)
+            return RowSet(self.n_rows, ids=sparse.ids[_bits_set(dense.bitmap, sparse.ids)])
+        return RowSet(self.n_rows, bitmap=self.bitmap & other.bitmap)
+
+    def __or__(self, other):
+        if self.ids is not None and other.ids is not None:
+            return RowSet(self.n_rows, ids=np.union1d(self.ids, other.ids))
+        return RowSet(self.n_rows, bitmap=self.as_bitmap() | other.as_bitmap())
+
+
+def _read_manifest(out_dir):
+    try:
+        with open(os.path.join(out_dir, MANIFEST_FILE)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _array_path(out_dir, name):
+    return os.path.join(out_dir, f'{name}.npy')
+
+
+# memory mapped, as a plain array (indexing a np.memmap goes through python code)
+def _load_array(out_dir, name):
+    return np.asarray(np.load(_array_path(out_dir, name), mmap_mode='r'))
+
+
+# Build & save the index of the data, one column in memory at a time
+def build_index(source_path, columns=INDEX_COLUMNS):
+    fingerprint = source_fingerprint(source_path)
+    lf = scan_source(source_path)
+    schema = lf.schema
+
+    base = lf.select([pl.col('gmv').fill_null(0).cast(pl.Float64), pl.col('order_id').is_not_null()]).collect()
+    n_rows = base.height
+    n_bytes = (n_rows + 7) // 8
+
+    out_dir = index_dir(source_path)
+    tmp_dir = f'{out_dir}.{os.getpid()}.tmp'
+    os.makedirs(tmp_dir)
+
+    np.save(_array_path(tmp_dir, 'gmv'), base['gmv'].to_numpy())
+    np.save(_array_path(tmp_dir, 'orders'), np.packbits(base['order_id'].to_numpy()))
+    del base
+
+    manifest = {'format': INDEX_FORMAT, 'fingerprint': fingerprint, 'n_rows': n_rows,
+                'gmv_dtype': str(schema['gmv']), 'columns': {}}
+    for col in columns:
+        # values sorted so their codes are in the order the results are sorted in
+        values = lf.select(pl.col(col).unique()).collect()
+        values = values.sort(sort_exprs(values, [col]))[col]
+        if values.null_count():
+            raise ValueError(f"Can't index {col}, it has nulls")
+
+        codes = (lf.select(col)
+                   .join(pl.DataFrame({col: values, '__code': pl.arange(0, len(values), eager=True)}).lazy(),
+                         on=col, how='left')
+                   .select('__code').collect()['__code'].to_numpy())
+        codes = codes.astype(np.min_scalar_type(max(len(values) - 1, 0)))
+
+        # rows of every value, sorted by value then row
+        order = np.argsort(codes, kind='stable').astype(np.uint32)
+        offsets = np.searchsorted(codes[order], np.arange(len(values) + 1))
+
+        # a value in fewer than 1 of every 32 rows is smaller as 4 byte row numbers than as bitmap
+        counts = np.diff(offsets)
+        dense = np.flatnonzero(counts * 32 > n_rows)
+        slots = np.full(len(values), -1, dtype=np.int32)
+        slots[dense] = np.arange(len(dense))
+        bitmaps = np.zeros((len(dense), n_bytes), dtype=np.uint8)
+        for slot, code in enumerate(dense):
+            bitmaps[slot] = _bitmap_of_ids(order[offsets[code]:offsets[code + 1]], n_bytes)
+
+        np.save(_array_path(tmp_dir, f'{col}.codes'), codes)
+        np.save(_array_path(tmp_dir, f'{col}.bitmaps'), bitmaps)
+        np.save(_array_path(tmp_dir, f'{col}.slots'), slots)
+        np.save(_array_path(tmp_dir, f'{col}.ids'), order)
+        np.save(_array_path(tmp_dir, f'{col}.offsets'), offsets)
+        manifest['columns'][col] = {'dtype': str(schema[col]), 'values': values.to_list()}
+
+    with open(os.path.join(tmp_dir, MANIFEST_FILE), 'w') as f:
+        json.dump(manifest, f)
+
+    if os.path.exists(out_dir):
+        shutil.rmtree(out_dir)
+    os.replace(tmp_dir, out_dir)
+
+    return BitmapIndex.load(source_path)
+
+
+class BitmapIndex:
+
+    def __init__(self, out_dir, manifest):
+        self.n_rows = manifest['n_rows']
+        self.columns = manifest['columns']
+        self.gmv_dtype = getattr(pl, manifest['gmv_dtype'])
+        self.gmv = _load_array(out_dir, 'gmv')
+        self.orders = RowSet(self.n_rows, bitmap=_load_array(out_dir, 'orders'))
+
+        self._arrays = {
+            col: {part: _load_array(out_dir, f'{col}.{part}')
+                  for part in ('codes', 'bitmaps', 'slots', 'ids', 'offsets')}
+            for col in self.columns
+        }
+        self._codes = {col: {value: code for code, value in enumerate(info['values'])}
+                       for col, info in self.columns.items()}
+
+    # Load the saved index of the data, None if there is none or the data changed since
+    @classmethod
+    def load(cls, source_path):
+        out_dir = index_dir(source_path)
+        manifest = _read_manifest(out_dir)
+        if manifest is None or manifest.get('format') != INDEX_FORMAT \
+                or manifest.get('fingerprint') != source_fingerprint(source_path):
+            return None
+        return cls(out_dir, manifest)
+
+    ############### Row sets ###############
+
+    def rows_of(self, col, value):
+        code = self._codes[col].get(value)
+        if code is None:
+            return RowSet(self.n_rows, ids=np.empty(0, dtype=np.uint32))
+
+        arrays = self._arrays[col]
+        slot = arrays['slots'][code]
+        if slot >= 0:
+            return RowSet(self.n_rows, bitmap=arrays['bitmaps'][slot])
+        return RowSet(self.n_rows, ids=arrays['ids'][arrays['offsets'][code]:arrays['offsets'][code + 1]])
+
+    # rows having any of the values, the rows of a column's values never overlap
+    def rows_of_any(self, col, values):
+        sets = [self.rows_of(col, value) for value in values]
+        sparse = [s.ids for s in sets if s.ids is not None]
+        dense = [s for s in sets if s.ids is None]
+
+        rows = RowSet(self.n_rows, ids=np.sort(np.concatenate(sparse)) if sparse else np.empty(0, dtype=np.uint32))
+        for s in dense:
+            rows = rows | s
+        return rows
+
+    def _month_rows(self, date_range):
+        (start, end), rows = date_range, None
+        for year in range(start.year, end.year + 1):
+            first = start.month if year == start.year else 1
+            last = end.month if year == end.year else 12
+            year_rows = self.rows_of('Year', year)
+            if (first, last) != (1, 12):
+                year_rows = year_rows & self.rows_of_any('Month', range(first, last + 1))
+            rows = year_rows if rows is None else rows | year_rows
+        return rows
+
+    # Can the filters (see query_filters.py) be made of the index's row sets
+    def can_filter(self, filters):
+        if filters is None:
+            return True
+        if filters.date_range is not None and not (
+                {'Year', 'Month'} <= set(self.columns) and whole_months(filters.date_range)):
+            return False
+        return all(getattr(filters, field) is None or col in self.columns
+                   for field, col in VALUE_FILTERS.items())
+
+    # RowSet of the filtered rows, None for every row
+    def select(self, filters):
+        if filters is None:
+            return None
+
+        sets = []
+        if filters.date_range is not None:
+            sets.append(self._month_rows(filters.date_range))
+        for field, col in VALUE_FILTERS.items():
+            values = getattr(filters, field)
+            if values is not None:
+                sets.append(self.rows_of_any(col, values))
+
+        # sparse sets first, ANDing row numbers into a bitmap only looks up those rows
+        sets.sort(key=lambda s: len(s.ids) if s.ids is not None else self.n_rows)
+        rows = sets[0]
+        for s in sets[1:]:
+            rows = rows & s
+        return rows
+
+    ############### Aggregations ###############
+
+    def can_answer(self, spec, filters=None):
+        return set(spec.groupof) <= set(self.columns) and (spec.agg, spec.column) in INDEX_METRICS \
+            and self.can_filter(filters)
+
+    # {'total_orders', 'total_gmv', 'count'} of the filtered rows, by popcount & a gather of
+    # their gmv
+    def totals(self, filters=None):
+        rows = self.select(filters)
+        if rows is None:
+            return {'total_orders': len(self.orders), 'total_gmv': float(self.gmv.sum()), 'count': self.n_rows}
+
+        return {'total_orders': len(rows & self.orders),
+                'total_gmv': float(rows.gather(self.gmv).sum()),
+                'count': len(rows)}
+
+    def _decode(self, col, codes):
+        info = self.columns[col]
+        values = pl.Series(col, info['values']).take(pl.Series(codes))
+        dtype = getattr(pl, info['dtype'], None)
+        return values.cast(dtype) if dtype is not None and values.dtype != dtype else values
+
+    # result of the spec over the filtered rows, like the same group by of the data
+    def answer(self, spec, filters=None):
+        rows = self.select(filters)
+        take = (lambda values: values) if rows is None else rows.gather
+
+        # one code per combination of the group keys' values
+        key, n_keys = np.zeros(self.n_rows if rows is None else len(rows), dtype=np.int64), 1
+        for col in spec.groupof:
+            key = key * len(self.columns[col]['values']) + take(self._arrays[col]['codes'])
+            n_keys *= len(self.columns[col]['values'])
+
+        row_counts = np.bincount(key, minlength=n_keys)
+        if spec.agg == 'rows':
+            metric = pl.Series(spec.alias, row_counts, dtype=pl.UInt32)
+        elif spec.agg == 'count':
+            valid = take(np.unpackbits(self.orders.bitmap, count=self.n_rows).view(bool))
+            metric = pl.Series(spec.alias, np.bincount(key[valid], minlength=n_keys), dtype=pl.UInt32)
+        else:
+            metric = pl.Series(spec.alias, np.bincount(key, weights=take(self.gmv), minlength=n_keys)).cast(self.gmv_dtype)
+
+        # only the combinations that have rows, like a group by
+        present = np.flatnonzero(row_counts)
+        out, rest = {}, present
+        for col in reversed(spec.groupof):
+            n_values = len(self.columns[col]['values'])
+            out[col] = self._decode(col, rest % n_values)
+            rest = rest // n_values
+
+        df = pl.DataFrame([out[col] for col in spec.groupof] + [metric.take(pl.Series(present))])
+        return df.sort(sort_exprs(df, list(spec.groupof))) if spec.groupof else df
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Build the bitmap index of a parquet data file or partitioned dataset.')
+    parser.add_argument('source', nargs='?', default='df_consumer_v3.parquet')
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    index = build_index(args.source)
+    size = sum(os.path.getsize(os.path.join(index_dir(args.source), name))
+               for name in os.listdir(index_dir(args.source)))
+
+    for col, info in index.columns.items():
+        n_dense = len(index._arrays[col]['bitmaps'])
+        print(f'{col:>30}: {len(info["values"]):>6,} values, {n_dense:>3} as bitmaps')
+    print(f'Index of {index.n_rows:,} rows ({size / 1e6:,.1f} MB) saved to {index_dir(args.source)}'
+          f' in {time.perf_counter() - start:.2f}s')
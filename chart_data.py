@@ -0,0 +1,32 @@
+import pandas as pd
+import polars as pl
+
+import query_trace
+
+
+# Chart data straight from polars results.
+#
+# Plotly express only works on pandas (it turns anything else into a pandas frame itself) so
+# instead of a full to_pandas() copy of every result, chart_frame() wraps the polars columns'
+# numpy arrays in a pandas frame without copying them. Only the columns a chart uses are taken
+# and results stay cached as polars frames, pandas objects are never cached.
+
+
+# numpy array of a polars Series, a view of its buffer for numeric columns without nulls
+def column_array(s):
+    if s.dtype == pl.Date:
+        # datetime64 instead of an object array of python dates
+        s = s.cast(pl.Datetime('ns'))
+    elif s.dtype == pl.Categorical:
+        # plotly wants the labels, not the category codes
+        s = s.cast(pl.Utf8)
+    return s.to_numpy()
+
+
+# pandas frame for plotly express over the polars data, only `columns` if given
+def chart_frame(df, columns=None):
+    with query_trace.span('to_pandas', 'chart_frame') as span:
+        if columns is not None:
+            df = df.select(columns)
+        span.rows_in = span.rows_out = df.height
+        return pd.DataFrame({s.name: column_array(s) for s in df.get_columns()}, copy=False)
@@ -0,0 +1,152 @@
+import polars as pl
+
+
+# Customer level analysis on the order LazyFrame, everything stays inside one lazy plan.
+# Customer ids are matched with joins against a unique key set, never pulled into a Python list.
+
+
+REPEAT_COL = 'Repeat_cust_over_Year'
+NEW_CUSTOMER = 'New_Customer'
+REPEAT_CUSTOMER = 'Repeat_Customer'
+
+COHORT_COL = 'cohort'
+MONTHS_SINCE_COL = 'months_since_first_order'
+
+
+def repeat_label(base_year):
+    return f'Customer_Repeat_from_{base_year}'
+
+
+# the customers who ordered in base_year
+def base_customers(df, base_year):
+    return df.filter(pl.col('Year') == base_year).select('cust_id').unique()
+
+
+# base_customers of several parts of the data as one
+def combine_base_customers(frames):
+    return pl.concat(frames).unique()
+
+
+# Orders labelled as coming from a repeat or new customer in REPEAT_COL.
+#
+# With base_year, only orders after base_year are kept and a customer is a repeat one if they
+# ordered in base_year (e.g. 2016 orders of customers already seen in 2015). base_df, if given,
+# is where the base_year customers are looked up (e.g. a scan of just the base_year partitions),
+# base the base_customers already looked up.
+# Without it every order is labelled, a customer is a repeat one in any year after the first
+# year they ordered in, so it works for any number of years.
+def label_repeat_customers(df, base_year=None, base_df=None, base=None):
+    if base_year is not None:
+        if base is None:
+            base = base_customers(df if base_df is None else base_df, base_year)
+
+        return (df.filter(pl.col('Year') > base_year)
+                  # flagged here, a literal column after a unique is dropped when streaming
+                  .join(base.with_columns(pl.lit(True).alias('_in_base_year')), on='cust_id', how='left')
+                  .with_columns(
+                      pl.when(pl.col('_in_base_year')).then(repeat_label(base_year))
+                        .otherwise(NEW_CUSTOMER).alias(REPEAT_COL)
+                  ).drop('_in_base_year'))
+
+    first_year = df.groupby('cust_id').agg(pl.min('Year').alias('_first_year'))
+
+    return (df.join(first_year, on='cust_id', how='left')
+              .with_columns(
+                  pl.when(pl.col('Year') > pl.col('_first_year')).then(REPEAT_CUSTOMER)
+                    .otherwise(NEW_CUSTOMER).alias(REPEAT_COL)
+              ).drop('_first_year'))
+
+
+def _summary_keys(base_year, by):
+    return [REPEAT_COL, by] if base_year is not None else [REPEAT_COL, 'Year', by]
+
+
+# Count of orders by repeat/new customer & `by`. Without base_year the counts are also split by Year.
+def repeat_customer_counts(df, base_year=None, by='order_payment_type', base_df=None, base=None):
+    return (label_repeat_customers(df.select(['Year', 'cust_id', by]), base_year, base_df, base)
+              .groupby(_summary_keys(base_year, by)).count())
+
+
+# repeat_customer_counts of several parts of the data (with the same base) as one
+def combine_repeat_counts(frames, base_year=None, by='order_payment_type'):
+    counts = pl.concat(frames)
+    return counts.groupby(_summary_keys(base_year, by)).agg(pl.sum('count').cast(counts.schema['count']))
+
+
+# each count's % within its `by` group (& Year without base_year)
+def with_repeat_shares(counts, base_year=None, by='order_payment_type'):
+    total_over = [by] if base_year is not None else ['Year', by]
+
+    return (counts.with_columns(
+                total_count = pl.sum('count').over(total_over)
+            ).with_columns(
+                perc_count = (pl.col('count') / pl.col('total_count') * 100 ).round(2)
+            ))
+
+
+# repeat_customer_counts with their shares
+def repeat_customer_summary(df, base_year=None, by='order_payment_type', base_df=None):
+    return with_repeat_shares(repeat_customer_counts(df, base_year, by, base_df), base_year, by)
+
+
+# Monthly acquisition cohorts: for every month customers first ordered in & every month since
+# then, the customers of the cohort who ordered, their orders & gmv, the % of the cohort they
+# are (retention) and the cohort's gmv per customer so far.
+#
+# A customer's first month is a windowed min over their orders and the cells are one group by.
+# Neither a window nor a distinct count streams, so with streaming=True (see lazy_exec.py) the
+# cells are made from the customer_months grain instead, keeping the whole plan on the
+# streaming engine for any number of customers.
+def cohort_retention(df, streaming=False):
+    if streaming:
+        return cohort_retention_from_months(customer_months(df))
+
+    orders = df.select(['cust_id', 'gmv', _month_expr().alias('_month')])
+    months_since = (pl.col('_month') - pl.col('_cohort')).alias(MONTHS_SINCE_COL)
+    cells = (orders.with_columns(pl.min('_month').over('cust_id').alias('_cohort'))
+               .groupby(['_cohort', months_since])
+               .agg([pl.n_unique('cust_id').alias('customers'), pl.count().alias('orders'),
+                     pl.sum('gmv').alias('total_gmv')]))
+    return _cohort_table(cells)
+
+
+def _month_expr():
+    return pl.col('date_only').dt.year().cast(pl.Int32) * 12 + pl.col('date_only').dt.month().cast(pl.Int32) - 1
+
+
+# orders & gmv of every customer in every month they ordered in
+def customer_months(df):
+    return (df.select(['cust_id', 'gmv', _month_expr().alias('_month')])
+              .groupby(['cust_id', '_month'])
+              .agg([pl.count().alias('orders'), pl.sum('gmv').alias('total_gmv')]))
+
+
+# customer_months of several parts of the data as one, a customer's month can be in several
+def combine_customer_months(frames):
+    months = pl.concat(frames)
+    return months.groupby(['cust_id', '_month']).agg(
+        [pl.sum('orders').cast(months.schema['orders']), pl.sum('total_gmv')])
+
+
+# cohort_retention out of the customer_months (LazyFrame or DataFrame) of the orders
+def cohort_retention_from_months(months):
+    months = months.lazy()
+    first_month = months.groupby('cust_id').agg(pl.min('_month').alias('_cohort'))
+    cells = (months.join(first_month, on='cust_id')
+               .with_columns((pl.col('_month') - pl.col('_cohort')).alias(MONTHS_SINCE_COL))
+               .groupby(['_cohort', MONTHS_SINCE_COL])
+               .agg([pl.count().alias('customers'), pl.sum('orders'), pl.sum('total_gmv')]))
+    return _cohort_table(cells)
+
+
+def _cohort_table(cells):
+    # every cohort has its month 0, where all of its customers ordered
+    return (cells.sort(['_cohort', MONTHS_SINCE_COL])
+              .with_columns([
+                  pl.date(pl.col('_cohort') // 12, pl.col('_cohort') % 12 + 1, 1).alias(COHORT_COL),
+                  pl.first('customers').over('_cohort').alias('cohort_size'),
+              ]).with_columns([
+                  (pl.col('customers') / pl.col('cohort_size') * 100).round(2).alias('retention'),
+                  (pl.col('total_gmv').cumsum().over('_cohort') / pl.col('cohort_size')).alias('gmv_per_customer'),
+              ]).select([COHORT_COL, MONTHS_SINCE_COL, 'cohort_size', 'customers', 'retention',
+                         'orders', 'total_gmv', 'gmv_per_customer']))
@@ -0,0 +1,41 @@
+import polars as pl
+
+
+# Smaller types for the columns the dashboard groups by, for storing the data with.
+#
+# The few distinct strings of the category & payment type columns become Categorical, parquet
+# keeps them dictionary encoded so they are read back as Categorical and grouping on them hashes
+# small integers instead of strings, in a fraction of the memory. Year/Month/Hour & pincode fit
+# in small integer types. Casting at scan time only pays off for wide group bys (the rollup
+# cube), for the others the cast costs more than it saves so the data is better rewritten once
+# with parquet_layout.py (the partitioned dataset's convert & append store them on their own).
+# The global string cache is on so categoricals of different files, partitions & cached results
+# can be concatenated, joined & compared with each other.
+#
+# Categoricals sort by the order their values were first seen, not alphabetically, sort them by
+# sort_exprs() to get the order the string columns had.
+
+
+pl.enable_string_cache(True)
+
+CATEGORICAL_COLS = ['order_payment_type', 'product_analytic_super_category', 'product_analytic_category',
+                    'product_analytic_sub_category', 'product_analytic_vertical']
+
+# pincodes are 6 digits
+DOWNCAST = {'Year': pl.Int16, 'Month': pl.Int8, 'Hour': pl.Int8, 'pincode': pl.Int32}
+
+
+# the LazyFrame with the columns it has of the above cast, columns already of that type are left as they are
+def optimize_schema(lf):
+    schema = lf.schema
+    casts = [pl.col(col).cast(pl.Categorical) for col in CATEGORICAL_COLS
+             if col in schema and schema[col] == pl.Utf8]
+    casts += [pl.col(col).cast(dtype) for col, dtype in DOWNCAST.items()
+              if col in schema and schema[col] != dtype]
+
+    return lf.with_columns(casts) if casts else lf
+
+
+# sort expressions for `cols` of df, categoricals by their string
+def sort_exprs(df, cols):
+    return [pl.col(col).cast(pl.Utf8) if df.schema[col] == pl.Categorical else pl.col(col) for col in cols]
@@ -0,0 +1,142 @@
+import glob
+import hashlib
+import json
+import os
+
+import polars as pl
+import pyarrow.parquet as pq
+
+import lazy_exec
+
+
+# Row count & summary stats of the data file without reading it twice on every cold start.
+# Row count comes from the parquet footer and the describe() style summary is computed in
+# one polars pass & saved next to the file, keyed by the file's mtime and size.
+# `path` can also be a directory of parquet files (see partitioned_dataset.py).
+
+
+STATS_SUFFIX = '.stats.json'
+
+# same rows as pandas describe()
+STAT_NAMES = ['count', 'mean', 'std', 'min', '25%', '50%', '75%', 'max']
+
+
+# the file itself or all parquet files under the directory
+def parquet_files(path):
+    if os.path.isdir(path):
+        return sorted(glob.glob(os.path.join(path, '**', '*.parquet'), recursive=True))
+    return [path]
+
+
+# mtime & size of the file, used to tell if anything saved for it is still valid.
+# For a directory it is the latest mtime & total size plus a digest of every file's
+# name, mtime & size so adding, replacing or removing any file changes it.
+def source_fingerprint(path):
+    if not os.path.isdir(path):
+        st_info = os.stat(path)
+        return {'mtime_ns': st_info.st_mtime_ns, 'size': st_info.st_size}
+
+    digest = hashlib.sha1()
+    mtime_ns, size = 0, 0
+    for file in parquet_files(path):
+        st_info = os.stat(file)
+        digest.update(f'{os.path.relpath(file, path)}:{st_info.st_mtime_ns}:{st_info.st_size};'.encode())
+        mtime_ns = max(mtime_ns, st_info.st_mtime_ns)
+        size += st_info.st_size
+
+    return {'mtime_ns': mtime_ns, 'size': size, 'digest': digest.hexdigest()}
+
+
+# Number of rows from the parquet footer(s) only, no column data is read
+def parquet_row_count(path):
+    return sum(pq.read_metadata(file).num_rows for file in parquet_files(path))
+
+
+def _stat_exprs(col):
+    return [
+        pl.col(col).count().alias(f'{col}|count'),
+        pl.col(col).mean().alias(f'{col}|mean'),
+        pl.col(col).std().alias(f'{col}|std'),
+        pl.col(col).min().alias(f'{col}|min'),
+        pl.col(col).quantile(0.25, 'linear').alias(f'{col}|25%'),
+        pl.col(col).quantile(0.50, 'linear').alias(f'{col}|50%'),
+        pl.col(col).quantile(0.75, 'linear').alias(f'{col}|75%'),
+        pl.col(col).max().alias(f'{col}|max'),
+    ]
+
+
+# describe() of all numeric columns as {column: {stat: value}} in one select over the LazyFrame.
+# Only the numeric columns are projected so string columns are never read.
+# Quantiles can't stream so in streaming mode (see lazy_exec.py) it is a select per column
+# instead, reading the file once per column but holding only one column in memory at a time.
+# Quantiles don't add up over files either, on a partitioned dataset that column is read from
+# every file.
+def compute_summary(df):
+    num_cols = [col for col, dtype in df.schema.items() if dtype in pl.NUMERIC_DTYPES]
+    if not num_cols:
+        return {}
+
+    if lazy_exec.STREAMING:
+        row = {}
+        for col in num_cols:
+            row.update(lazy_exec.collect(df.select(_stat_exprs(col)), label=f'stat_summary [{col}]').row(0, named=True))
+    else:
+        row = lazy_exec.collect(df.select(
+            [expr for col in num_cols for expr in _stat_exprs(col)]
+        ), label='stat_summary').row(0, named=True)
+
+    summary = {col: {} for col in num_cols}
+    for key, value in row.items():
+        col, stat = key.rsplit('|', 1)
+        summary[col][stat] = None if value is None else float(value)
+
+    return summary
+
+
+def _stats_path(path):
+    return str(path).rstrip('/') + STATS_SUFFIX
+
+
+def _read_saved_stats(path, fingerprint):
+    try:
+        with open(_stats_path(path)) as f:
+            saved = json.load(f)
+    except (OSError, ValueError):
+        return None
+
+    if saved.get('fingerprint') != fingerprint:
+        return None
+
+    return saved
+
+
+def _save_stats(path, stats):
+    # write to a temp file first so a reader never sees half written json
+    tmp_path = f'{_stats_path(path)}.{os.getpid()}.tmp'
+    try:
+        with open(tmp_path, 'w') as f:
+            json.dump(stats, f)
+        os.replace(tmp_path, _stats_path(path))
+    except OSError:
+        # read only deployments just recompute on the next cold start
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+# Row count + summary for the data file at `path` (df is the LazyFrame scanning it).
+# Saved stats are reused as long as the file's mtime & size have not changed.
+def get_data_stats(path, df):
+    fingerprint = source_fingerprint(path)
+
+    saved = _read_saved_stats(path, fingerprint)
+    if saved is not None:
+        return saved
+
+    stats = {
+        'fingerprint': fingerprint,
+        'row_count': parquet_row_count(path),
+        'summary': compute_summary(df),
+    }
+    _save_stats(path, stats)
+
+    return stats
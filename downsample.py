@@ -0,0 +1,78 @@
+import numpy as np
+import polars as pl
+
+
+# Downsampling of long time series (like orders per date_only) before they are sent to a chart.
+#
+# The rows (sorted by x) are split into buckets of equal row count and a few rows are kept
+# per bucket so the shape of the line, its peaks included, survives:
+#   'minmax' -> the rows with the min & max y of every bucket, fully in polars
+#   'lttb'   -> largest triangle three buckets, the row making the biggest triangle with the
+#               row kept in the previous bucket & the average of the next one. Each bucket is
+#               one numpy step, the loop is over buckets not rows.
+# Series with at most n_out rows are returned as they are, so zooming into a small x_range
+# gives the full detail back.
+
+
+_ROW = '__row_nr'
+
+
+def _numeric_x(s):
+    if s.dtype in (pl.Date, pl.Datetime):
+        return s.cast(pl.Int64).to_numpy().astype('float64')
+    return s.cast(pl.Float64).to_numpy()
+
+
+def minmax_downsample(df, x, y, n_out):
+    n_buckets = max(n_out // 2, 1)
+
+    rows = (df.with_row_count(_ROW)
+              .with_columns((pl.col(_ROW).cast(pl.Int64) * n_buckets // df.height).alias('__bucket'))
+              .groupby('__bucket')
+              .agg([pl.col(_ROW).sort_by(y).first().alias('__min_row'),
+                    pl.col(_ROW).sort_by(y).last().alias('__max_row')]))
+
+    keep = pl.concat([rows['__min_row'], rows['__max_row']]).unique().sort()
+    return df[keep.to_list()]
+
+
+def lttb_downsample(df, x, y, n_out):
+    n = df.height
+    if n_out < 3:
+        return df.head(n_out)
+
+    xs, ys = _numeric_x(df[x]), df[y].cast(pl.Float64).to_numpy()
+
+    # first & last rows are always kept, the rest is split in n_out - 2 buckets
+    edges = np.linspace(1, n - 1, n_out - 1).astype(np.int64)
+
+    keep = np.empty(n_out, dtype=np.int64)
+    keep[0], keep[-1] = 0, n - 1
+
+    prev = 0
+    for i in range(n_out - 2):
+        start, end = edges[i], edges[i + 1]
+        next_end = edges[i + 2] if i + 2 < len(edges) else n
+        next_x, next_y = xs[end:next_end].mean(), ys[end:next_end].mean()
+
+        area = np.abs((xs[prev] - next_x) * (ys[start:end] - ys[prev])
+                      - (xs[prev] - xs[start:end]) * (next_y - ys[prev]))
+        prev = start + int(area.argmax())
+        keep[i + 1] = prev
+
+    return df[keep.tolist()]
+
+
+# df (sorted by x) cut to x_range = (from, to) if given & reduced to about n_out rows
+def downsample(df, x, y, n_out=1000, method='lttb', x_range=None):
+    if x_range is not None:
+        df = df.filter(pl.col(x).is_between(x_range[0], x_range[1], closed='both'))
+
+    if df.height <= n_out:
+        return df
+
+    if method == 'minmax':
+        return minmax_downsample(df, x, y, n_out)
+    if method == 'lttb':
+        return lttb_downsample(df, x, y, n_out)
+    raise ValueError(f"Unknown downsampling method '{method}', expected 'lttb' or 'minmax'")
@@ -0,0 +1,476 @@
+import hashlib
+import json
+import sys
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+
+import polars as pl
+
+import data_stats
+import lazy_exec
+import query_trace
+from agg_planner import AggPlanner, orders_spec, gmv_spec, rows_spec
+from bitmap_index import BitmapIndex
+from customer_cohorts import (base_customers, cohort_retention, cohort_retention_from_months, combine_base_customers,
+                              combine_customer_months, combine_repeat_counts, customer_months,
+                              repeat_customer_counts, repeat_customer_summary, with_repeat_shares)
+from downsample import downsample
+from partitioned_dataset import scan_parts, scan_source
+from query_filters import filter_expr
+from rollup_cube import RollupCube
+from topk_sketch import EPSILON, build_sketch, verified_top
+
+
+# Every query behind the dashboard as plain polars, without streamlit, so it can be imported
+# by the app, batch jobs & benchmarks alike:
+#
+#     queries = EdaQueries('df_consumer_v3.parquet', cache=MemoryCache())
+#     queries.total_orders(['Year', 'Month'])
+#
+# Results are polars DataFrames kept in the `cache` given (None for no caching), anything with
+# get(key) -> DataFrame or None & put(key, df) will do, like MemoryCache below or the on disk
+# result_cache.DiskCache. Keys are strings made of the version of the query code & of the data,
+# the query name & its arguments so a cache can be shared by any number of EdaQueries objects,
+# processes, deploys or data versions.
+
+
+# Every (group keys, metric) used by the charts on the page.
+# The ones of the charts on screen are computed together from a single scan of the data (see
+# EdaQueries.prefetch), coarser groupings are rolled up from finer ones instead of grouping the
+# raw data again.
+PAGE_AGGS = [
+    orders_spec(['date_only']),
+    gmv_spec(['date_only']),
+    orders_spec(['Year','Month']),
+    gmv_spec(['Year','Month']),
+    orders_spec(['Hour']),
+    orders_spec(['Year','Hour']),
+    rows_spec(['Year','order_payment_type']),
+    orders_spec(['product_analytic_category']),
+    orders_spec(['Year','product_analytic_category']),
+    gmv_spec(['product_analytic_category']),
+    gmv_spec(['Year','product_analytic_category']),
+    orders_spec(['Year','Month','product_analytic_category']),
+    gmv_spec(['Year','Month','product_analytic_category']),
+    orders_spec(['Year','product_analytic_sub_category']),
+    gmv_spec(['Year','product_analytic_sub_category']),
+    orders_spec(['Year','pincode']),
+    gmv_spec(['Year','pincode']),
+]
+
+
+# (method, args) of every query the page makes with its default inputs (and `filters`), for
+# warming a cache before the app gets any traffic (see warm_cache.py) or starting them all at once
+# skip: (method, args) of the charts the page doesn't show, given without the filters
+def dashboard_queries(max_points=1000, filters=None, skip=()):
+    queries = [('aggregate', (spec,)) for spec in PAGE_AGGS] + [
+        ('filtered_totals', ()),
+        ('percof_group', (['Year','order_payment_type'],)),
+        ('daily_orders', (None, max_points)),
+        ('daily_gmv', (None, max_points)),
+        ('top_pincodes', ('total_orders', 15)),
+        ('top_pincodes', ('total_gmv', 15)),
+        ('repeat_customers', (2015, 'order_payment_type')),
+        ('cohort_retention', ()),
+    ]
+    queries = [query for query in queries if query not in skip]
+    if filters is None:
+        return queries
+    # filters is the last argument of every query
+    return [(method, args + (filters,)) for method, args in queries]
+
+
+# modules deciding what a query returns, a change to any of them changes every cache key
+QUERY_MODULES = ['eda_queries', 'agg_planner', 'bitmap_index', 'customer_cohorts', 'data_schema',
+                 'downsample', 'partitioned_dataset', 'query_filters', 'rollup_cube', 'topk_sketch']
+
+
+def code_version():
+    digest = hashlib.sha1()
+    for name in QUERY_MODULES:
+        with open(sys.modules[name].__file__, 'rb') as f:
+            digest.update(f.read())
+    return digest.hexdigest()[:16]
+
+
+# short digest of the data's fingerprint, changes whenever the file or a partition does
+def data_version(path):
+    fingerprint = data_stats.source_fingerprint(path)
+    return hashlib.sha1(json.dumps(fingerprint, sort_keys=True).encode()).hexdigest()[:16]
+
+
+TOPK_MODES = ['exact', 'approx', 'verify']
+
+
+# In memory cache shared by the threads of one process, drops the least recently used results
+# past max_entries (every combination of filters is a new entry)
+class MemoryCache:
+
+    def __init__(self, max_entries=1024):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        with self._lock:
+            df = self._entries.get(key)
+            if df is not None:
+                self._entries.move_to_end(key)
+            return df
+
+    def put(self, key, df):
+        with self._lock:
+            self._entries[key] = df
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def drop_prefix(self, prefix):
+        with self._lock:
+            for key in [key for key in self._entries if key.startswith(prefix)]:
+                del self._entries[key]
+
+
+class EdaQueries:
+
+    # use_cube=False always reads the data (see rollup_cube.py), use_index=False never answers
+    # filtered queries from the bitmap index (see bitmap_index.py), batch_page_aggs=False
+    # computes every prefetched aggregation on its own instead of together in one scan.
+    # topk='approx' ranks pincodes with a sketch of error within topk_epsilon of the total
+    # when they'd otherwise be grouped from the data (see topk_sketch.py), 'verify' makes
+    # that ranking exact.
+    def __init__(self, source_path, cache=None, use_cube=True, use_index=True, batch_page_aggs=True,
+                 topk='exact', topk_epsilon=EPSILON):
+        if topk not in TOPK_MODES:
+            raise ValueError(f"Unknown topk mode '{topk}', expected one of {', '.join(TOPK_MODES)}")
+
+        self.source_path = source_path
+        self.cache = cache
+        self.use_cube = use_cube
+        self.use_index = use_index
+        self.topk = topk
+        self.topk_epsilon = topk_epsilon
+        self.batch_page_aggs = batch_page_aggs
+        self.code_version = code_version()
+        self._key_locks = {}
+        self._locks_lock = threading.Lock()
+        self._batch_lock = threading.Lock()
+        self.refresh()
+
+    # Pick up a new version of the data, results of the old one are never looked up again. An
+    # in memory cache drops them, files of a disk cache are left to its eviction as processes
+    # still on the old version may read them.
+    def refresh(self):
+        version = data_version(self.source_path)
+        old_version = getattr(self, 'data_version', None)
+        if old_version == version:
+            return False
+
+        if old_version is not None and isinstance(self.cache, MemoryCache):
+            self.cache.drop_prefix(self._key_prefix())
+        self.data_version = version
+        self.df = scan_source(self.source_path)
+        # the same data one LazyFrame per file, streamed one by one (see lazy_exec.collect_parts)
+        self.parts = scan_parts(self.source_path)
+        self._cube = RollupCube.load(self.source_path) if self.use_cube else None
+        self._index = BitmapIndex.load(self.source_path) if self.use_index else None
+        return True
+
+    def cache_key(self, name, *args):
+        # group keys given as a list or a tuple are the same query
+        args = tuple(tuple(arg) if isinstance(arg, list) else arg for arg in args)
+        # approximate rankings aren't the exact ones
+        if name == 'top_pincodes' and self.topk != 'exact':
+            name = f'top_pincodes[{self.topk}:{self.topk_epsilon}]'
+        return f'{self._key_prefix()}{name}{args!r}'
+
+    def _key_prefix(self):
+        return f'{self.code_version}/{self.data_version}/'
+
+    # Lock of one key while threads hold or wait for it, dropped after the last one so a long
+    # running server doesn't keep a lock for every filter combination ever asked for
+    @contextmanager
+    def _key_lock(self, key):
+        with self._locks_lock:
+            entry = self._key_locks.setdefault(key, [threading.Lock(), 0])
+            entry[1] += 1
+        try:
+            with entry[0]:
+                yield
+        finally:
+            with self._locks_lock:
+                entry[1] -= 1
+                if entry[1] == 0:
+                    del self._key_locks[key]
+
+    # threads missing the same key at once compute it once, the others wait for its result.
+    # Every query is traced with its cache hit or miss (see query_trace.py).
+    def _cached(self, name, args, compute):
+        with query_trace.span('query', name, args=repr(args)) as span:
+            if self.cache is None:
+                df = compute()
+                span.rows_out = df.height
+                return df
+
+            key = self.cache_key(name, *args)
+            df = self.cache.get(key)
+            span.cache = 'miss' if df is None else 'hit'
+            if df is None:
+                with self._key_lock(key):
+                    df = self.cache.get(key)
+                    if df is None:
+                        df = compute()
+                        self.cache.put(key, df)
+                    else:
+                        span.cache = 'hit'
+
+            span.rows_out = df.height
+            return df
+
+    # Start the (method, args) queries not cached yet on executor, each one's result goes to the
+    # cache where a later call for it finds it, or waits for it while it is still running.
+    # The aggregations of the list are computed together, one scan for each filters. Only the
+    # ones of the list, an aggregation the page doesn't show isn't computed with them.
+    def prefetch(self, executor, query_list):
+        if self.cache is None:
+            return []
+
+        missing = [(method, args) for method, args in query_list
+                   if self.cache.get(self.cache_key(method, *args)) is None]
+        if not self.batch_page_aggs:
+            return [executor.submit(getattr(self, method), *args) for method, args in missing]
+
+        # filters (or none) -> specs
+        batches = {}
+        for method, args in missing:
+            if method == 'aggregate':
+                batches.setdefault(args[1:], []).append(args[0])
+
+        # the batches first so they start before the queries waiting for them
+        return [executor.submit(self.aggregate_batch, specs, *filters) for filters, specs in batches.items()] + \
+               [executor.submit(getattr(self, method), *args) for method, args in missing if method != 'aggregate']
+
+    ############### Aggregations ###############
+
+    # Every query takes the page's Filters (see query_filters.py), None for all the data.
+    # Unfiltered queries keep the cache keys they had without filters.
+
+    def _filtered_cached(self, name, args, filters, compute):
+        return self._cached(name, args if filters is None else args + (filters,), compute)
+
+    def _can_cube(self, spec, filters):
+        return self._cube is not None and self._cube.can_answer(spec, filters)
+
+    # the cube answers every unfiltered query, the index the filtered ones the cube can't
+    def _can_index(self, spec, filters):
+        return filters is not None and self._index is not None and self._index.can_answer(spec, filters)
+
+    # Answer from the cube when it can, then from the bitmap index, otherwise from the
+    # (filtered) data
+    def aggregate(self, spec, filters=None):
+        return self._filtered_cached('aggregate', (spec,), filters, lambda: self._compute_aggregate(spec, filters))
+
+    def _agg_key(self, spec, filters):
+        return self.cache_key('aggregate', spec) if filters is None else self.cache_key('aggregate', spec, filters)
+
+    def _compute_aggregate(self, spec, filters=None):
+        if self._can_cube(spec, filters):
+            query_trace.annotate(source='cube')
+            return self._cube.answer(spec, filters)
+        if self._can_index(spec, filters):
+            query_trace.annotate(source='index', rows_in=self._index.n_rows)
+            return self._index.answer(spec, filters)
+        # the scan's input, parquet statistics may let it skip some of it
+        query_trace.annotate(source='scan', rows_in=self.row_count())
+
+        if self.cache is None or not self.batch_page_aggs:
+            return self._scan_aggregates([spec], filters)[spec]
+
+        # a batch running now may be computing it, wait for it & find its result cached
+        with self._batch_lock:
+            df = self.cache.get(self._agg_key(spec, filters))
+            if df is not None:
+                return df
+            return self._scan_aggregates([spec], filters)[spec]
+
+    def _filtered_parts(self, filters, parts=None):
+        parts = self.parts if parts is None else parts
+        return parts if filters is None else [part.filter(filter_expr(filters, self.df.columns)) for part in parts]
+
+    def _scan_aggregates(self, specs, filters):
+        planner = AggPlanner(self.df if filters is None else self.df.filter(filter_expr(filters, self.df.columns)),
+                             self._filtered_parts(filters))
+        for spec in specs:
+            planner.add(spec)
+        return planner.collect()
+
+    # Compute the specs not cached yet together from one scan of the data into the cache, the
+    # ones the cube or the index answer are left to aggregate(). One batch at a time, one waiting
+    # for another finds its results cached by it.
+    def aggregate_batch(self, specs, filters=None):
+        with query_trace.span('query', 'aggregate_batch', args=repr((specs, filters))) as span, self._batch_lock:
+            missing = [spec for spec in dict.fromkeys(specs)
+                       if self.cache.get(self._agg_key(spec, filters)) is None
+                       and not self._can_cube(spec, filters) and not self._can_index(spec, filters)]
+            span.cache = 'miss' if missing else 'hit'
+            if not missing:
+                return []
+
+            query_trace.annotate(source='scan', rows_in=self.row_count())
+            for spec, df in self._scan_aggregates(missing, filters).items():
+                self.cache.put(self._agg_key(spec, filters), df)
+            return missing
+
+    def total_orders(self, groupof, count_of='order_id', filters=None):
+        return self.aggregate(orders_spec(groupof, count_of), filters)
+
+    def total_gmv(self, groupof, sum_of='gmv', filters=None):
+        return self.aggregate(gmv_spec(groupof, sum_of), filters)
+
+    def countof_group(self, groupof, filters=None):
+        return self.aggregate(rows_spec(groupof), filters)
+
+    # row count of every group with its % of the rows of its Year
+    def percof_group(self, groupof, filters=None):
+        return self._filtered_cached('percof_group', (groupof,), filters, lambda: (
+            self.countof_group(groupof, filters).with_columns(
+                total_orders = pl.sum('count').over('Year')
+            ).with_columns(
+                perc_sales = (pl.col('count') / pl.col('total_orders') * 100 ).round(2)
+            )))
+
+    # orders (or gmv) per date_only cut to date_range & downsampled to about n_out points
+    def daily_orders(self, date_range=None, n_out=1000, filters=None):
+        return self._filtered_cached('daily_orders', (date_range, n_out), filters, lambda: downsample(
+            self.total_orders(['date_only'], filters=filters), 'date_only', 'total_orders', n_out,
+            x_range=date_range))
+
+    def daily_gmv(self, date_range=None, n_out=1000, filters=None):
+        return self._filtered_cached('daily_gmv', (date_range, n_out), filters, lambda: downsample(
+            self.total_gmv(['date_only'], filters=filters), 'date_only', 'total_gmv', n_out,
+            x_range=date_range))
+
+    # top n pincodes of every Year by orders (metric='total_orders') or gmv ('total_gmv')
+    def top_pincodes(self, metric='total_orders', n=15, filters=None):
+        def compute():
+            if metric == 'total_orders':
+                spec = orders_spec(['Year','pincode'])
+            elif metric == 'total_gmv':
+                spec = gmv_spec(['Year','pincode'])
+            else:
+                raise ValueError(f"Unknown metric '{metric}', expected 'total_orders' or 'total_gmv'")
+
+            # the cube & the index group pincodes cheaply, only the data is worth sketching
+            if self.topk != 'exact' and not self._can_cube(spec, filters) and not self._can_index(spec, filters):
+                query_trace.annotate(source=f'sketch ({self.topk})')
+                return self._sketch_top_pincodes(metric, n, filters)
+
+            return (self.aggregate(spec, filters).sort(['Year',metric], descending=[True,True])
+                      .groupby(['Year'], maintain_order=True).head(n))
+
+        return self._filtered_cached('top_pincodes', (metric, n), filters, compute)
+
+    # top pincodes out of one pass over the data keeping a bounded sketch instead of a group
+    # table of every pincode, in the types of the exact result
+    def _sketch_top_pincodes(self, metric, n, filters=None):
+        sketch = build_sketch(self.source_path, metric, self.topk_epsilon, filters)
+        if self.topk == 'verify':
+            df = self.df if filters is None else self.df.filter(filter_expr(filters, self.df.columns))
+            top, _ = verified_top(df, sketch, n)
+        else:
+            top = sketch.top(n)
+
+        schema = self.df.schema
+        return top.select([
+            pl.col('Year').cast(schema['Year']),
+            pl.col('pincode').cast(schema['pincode']),
+            pl.col(metric).cast(pl.UInt32 if metric == 'total_orders' else schema['gmv']),
+        ])
+
+    # New & repeat (from base_year) customers of the later years by `by`.
+    # base_year customers are matched with a join in the same lazy plan, with a partitioned
+    # dataset each side only opens the partitions of its years. Filters select the later
+    # years' orders, a customer is a repeat one for any order in base_year.
+    # Streaming over several files the base_year customers are looked up first & the later
+    # years' orders counted file by file against them.
+    def repeat_customers(self, base_year=2015, by='order_payment_type', filters=None):
+        def compute():
+            df = scan_source(self.source_path, lambda year, month: year > base_year)
+            if filters is not None:
+                df = df.filter(filter_expr(filters, df.columns))
+            base_df = scan_source(self.source_path, lambda year, month: year == base_year)
+            parts = self._filtered_parts(filters, scan_parts(self.source_path, lambda year, month: year > base_year))
+
+            if not lazy_exec.by_part(parts):
+                return lazy_exec.collect(repeat_customer_summary(df, base_year=base_year, by=by, base_df=base_df),
+                                         label='repeat_customers')
+
+            base = lazy_exec.collect_parts(
+                base_df, scan_parts(self.source_path, lambda year, month: year == base_year),
+                lambda part: base_customers(part, base_year), combine_base_customers, label='repeat_customers base')
+            return with_repeat_shares(lazy_exec.collect_parts(
+                df, parts, lambda part: repeat_customer_counts(part, base_year, by, base=base.lazy()),
+                lambda frames: combine_repeat_counts(frames, base_year, by), label='repeat_customers'),
+                base_year, by)
+
+        return self._filtered_cached('repeat_customers', (base_year, by), filters, compute)
+
+    # Monthly acquisition cohorts x months since the first order (see customer_cohorts.py).
+    # Cohorts are made of the filtered orders, a customer's first month is their first order
+    # matching the filters. Streaming over several files every file's customer x month grain is
+    # streamed & the cohorts made from them together.
+    def cohort_retention(self, filters=None):
+        def compute():
+            df = self.df if filters is None else self.df.filter(filter_expr(filters, self.df.columns))
+            parts = self._filtered_parts(filters)
+            if not lazy_exec.by_part(parts):
+                return lazy_exec.collect(cohort_retention(df, streaming=lazy_exec.STREAMING), label='cohort_retention')
+
+            months = lazy_exec.collect_parts(df, parts, customer_months, combine_customer_months,
+                                             label='cohort_retention')
+            return lazy_exec.collect(cohort_retention_from_months(months), label='cohort_retention [months]')
+
+        return self._filtered_cached('cohort_retention', (), filters, compute)
+
+    # total_orders, total_gmv & count (rows) of the filtered data in one row, from the bitmap
+    # index in about a millisecond when there is one
+    def filtered_totals(self, filters=None):
+        def compute():
+            if self._index is not None and self._index.can_filter(filters):
+                return pl.DataFrame([self._index.totals(filters)]).with_columns(
+                    [pl.col('total_orders').cast(pl.UInt32), pl.col('count').cast(pl.UInt32)])
+
+            df = self.df if filters is None else self.df.filter(filter_expr(filters, self.df.columns))
+            # one group of all the rows, a select of aggregations doesn't stream where a group by
+            # does. Its single row (none without data) or the ones of every part are summed.
+            totals = lazy_exec.collect_parts(df, self._filtered_parts(filters), lambda part: (
+                part.with_columns(pl.lit(0, pl.UInt8).alias('_all')).groupby('_all').agg([
+                    pl.count('order_id').alias('total_orders'),
+                    pl.sum('gmv').alias('total_gmv'),
+                    pl.count().alias('count'),
+                ])
+            ), pl.concat, label='filtered_totals')
+            return totals.select([pl.sum(col).cast(totals.schema[col]) for col in ['total_orders', 'total_gmv', 'count']])
+
+        return self._filtered_cached('filtered_totals', (), filters, compute)
+
+    ############### Data summary ###############
+
+    # from the parquet footers, the data itself isn't read
+    def row_count(self):
+        return data_stats.parquet_row_count(self.source_path)
+
+    # {column: {stat: value}}, saved next to the data & reused till it changes
+    def stat_summary(self):
+        return data_stats.get_data_stats(self.source_path, self.df)['summary']
+
+    def head(self, n=10):
+        return self.df.head(n).collect()
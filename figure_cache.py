@@ -0,0 +1,82 @@
+import hashlib
+import marshal
+import threading
+from collections import OrderedDict
+
+import plotly.io as pio
+
+import query_trace
+
+
+# Finished plotly figures kept as JSON so a rerun (or another session) doesn't build them again.
+#
+# Building a plotly express figure, specially the faceted ones, costs far more than loading
+# its JSON back. Figures are keyed by chart name, a fingerprint of the data behind them and
+# the code that builds them, so changing either one builds the figure again. The cache is
+# bounded by number of entries & total JSON size and drops the least recently used first.
+
+
+# digest of the function building a figure, changes when its code or any literal in it does
+def code_digest(build):
+    return hashlib.sha1(marshal.dumps(build.__code__)).hexdigest()
+
+
+class FigureCache:
+
+    def __init__(self, max_entries=128, max_bytes=64 * 1024 * 1024):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    @property
+    def size_bytes(self):
+        return self._bytes
+
+    def _get(self, key):
+        with self._lock:
+            fig_json = self._entries.get(key)
+            if fig_json is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return fig_json
+
+    def _put(self, key, fig_json):
+        with self._lock:
+            if key in self._entries:
+                self._bytes -= len(self._entries.pop(key))
+
+            self._entries[key] = fig_json
+            self._bytes += len(fig_json)
+
+            while self._entries and (len(self._entries) > self.max_entries or self._bytes > self.max_bytes):
+                _, old_json = self._entries.popitem(last=False)
+                self._bytes -= len(old_json)
+
+    # Figure `name` for the data identified by data_key, build() is only called on a miss
+    def get_figure(self, name, data_key, build):
+        key = (name, str(data_key), code_digest(build))
+
+        with query_trace.span('figure', name) as span:
+            fig_json = self._get(key)
+            if fig_json is not None:
+                span.cache = 'hit'
+                return pio.from_json(fig_json)
+
+            span.cache = 'miss'
+            fig = build()
+            self._put(key, fig.to_json())
+            return fig
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
@@ -0,0 +1,116 @@
+import logging
+import os
+import re
+import threading
+
+import polars as pl
+
+import query_trace
+
+
+# One place deciding how the lazy plans over the data are run.
+#
+# With EDA_STREAMING=1 (or set_streaming(True)) plans run on polars' streaming engine, which
+# reads the data in batches so memory stays bounded whatever the size of the file. Not every
+# operation streams in this polars version, the parts that don't read their input into memory
+# first. Every plan whose scan of the data isn't streamed is logged once as a warning & kept in
+# `not_streamed` so it can be looked into. Every collect is traced (see query_trace.py).
+#
+# A scan of several files, like the partitioned dataset's (see partitioned_dataset.py), is a
+# union of one scan per file & a union doesn't stream. Queries whose result adds up from the
+# results of each file (counts, sums, distinct keys) run one streamed plan per file instead &
+# combine those, see collect_parts.
+
+
+log = logging.getLogger(__name__)
+
+STREAMING = os.environ.get('EDA_STREAMING', '0') not in ('', '0')
+
+# {plan label: plan lines reading data outside of the streaming engine}
+not_streamed = {}
+_not_streamed_lock = threading.Lock()
+
+_PIPELINE = re.compile(r'--- PIPELINE.*?--- END PIPELINE', re.S)
+
+
+def set_streaming(enabled):
+    global STREAMING
+    STREAMING = bool(enabled)
+
+
+# scans of the plan that aren't inside a streaming pipeline, empty when all the data is streamed
+def non_streaming_scans(lf):
+    plan = lf.explain(streaming=True, common_subplan_elimination=False)
+    return [line.strip() for line in _PIPELINE.sub('', plan).splitlines() if 'SCAN' in line]
+
+
+def can_stream(lf):
+    return not non_streaming_scans(lf)
+
+
+def _check_streams(lf, label):
+    scans = non_streaming_scans(lf)
+    if not scans:
+        return
+
+    query_trace.annotate(not_streamed=scans)
+    with _not_streamed_lock:
+        if label in not_streamed:
+            return
+        not_streamed[label] = scans
+
+    log.warning("'%s' can't run fully streaming, it reads into memory: %s", label, '; '.join(scans))
+
+
+# lf.collect() in the configured mode, `label` names the plan in the not streamed report
+def collect(lf, label='query'):
+    with query_trace.span('collect', label) as span:
+        if query_trace.CAPTURE_PLANS:
+            span.plan = _explain(lf)
+
+        if not STREAMING:
+            df = lf.collect()
+        else:
+            _check_streams(lf, label)
+            # the streaming engine can't share a subplan, it runs every branch on its own
+            df = lf.collect(streaming=True, common_subplan_elimination=False)
+
+        span.rows_out = df.height
+        return df
+
+
+def collect_all(lfs, label='query'):
+    with query_trace.span('collect', label) as span:
+        if query_trace.CAPTURE_PLANS:
+            span.plan = '\n\n'.join(_explain(lf) for lf in lfs)
+
+        if not STREAMING:
+            dfs = pl.collect_all(lfs)
+        else:
+            for i, lf in enumerate(lfs):
+                _check_streams(lf, f'{label} [{i}]')
+            dfs = pl.collect_all(lfs, streaming=True, common_subplan_elimination=False)
+
+        span.rows_out = sum(df.height for df in dfs)
+        return dfs
+
+
+# whether collect_parts runs a plan per part, when streaming over several files
+def by_part(parts):
+    return STREAMING and len(parts) > 1
+
+
+# plan(df) collected, or with by_part(parts) plan(part) of every part (see
+# partitioned_dataset.scan_parts) streamed on its own & combined with combine([DataFrame]) into
+# what plan(df) would give. df is all the parts together.
+def collect_parts(df, parts, plan, combine, label='query'):
+    if not by_part(parts):
+        return collect(plan(df), label)
+    return combine(collect_all([plan(part) for part in parts], label=f'{label} [parts]'))
+
+
+# the optimized plan as it runs in the configured mode
+def _explain(lf):
+    if STREAMING:
+        return lf.explain(streaming=True, common_subplan_elimination=False)
+    return lf.explain()
@@ -0,0 +1,311 @@
+import argparse
+import hashlib
+import json
+import os
+import shutil
+import time
+from typing import NamedTuple, Tuple
+
+import numpy as np
+import polars as pl
+
+
+# Weekly features for Market Mix Modelling out of the data's daily aggregates.
+#
+# The data has no media spend, so the weekly orders of every payment type stand in as the
+# "channels" driving the weekly gmv of every category (swap CHANNEL_COL for a spend column when
+# the data has one). For every channel the pipeline computes:
+#   - geometric adstock: a[t] = x[t] + decay * a[t - 1]
+#   - Hill saturation of the adstock: a^slope / (a^slope + K^slope), K being half_saturation
+#     times the mean adstock of the series so it doesn't depend on the channel's scale
+# for every (decay, half_saturation, slope) of an AdstockGrid at once: the adstock of all the
+# decays is one matrix product with their decay ** lag matrices and the saturation of all the
+# configs is one broadcast, no python loop over the grid. Lags & rolling means of the past
+# weeks' gmv are added as controls.
+#
+# The daily aggregates come from EdaQueries, i.e. the rollup cube's daily cuboid when the data
+# has one, so building the features doesn't scan the data. They are saved in `<data file>.mmm/`
+# along with the data's version & the grid, & built again when either changes:
+#
+#     python mmm_features.py df_consumer_v3.parquet
+#
+#   - weekly.parquet: one row per (category, week) with the target gmv, the orders of every
+#     channel & the lag/rolling controls
+#   - features.parquet: one row per (config, category, week) with the config's parameters &
+#     the saturated adstock of every channel, sorted by config so one config is a row range
+
+
+MMM_SUFFIX = '.mmm'
+MANIFEST_FILE = 'manifest.json'
+
+# changes when the files change shape, features of an older format are built again
+FEATURES_FORMAT = 2
+
+GROUP_COL = 'product_analytic_category'
+CHANNEL_COL = 'order_payment_type'
+TARGET_COL = 'gmv'
+WEEK_COL = 'week'
+CONFIG_COL = 'config'
+
+
+class AdstockGrid(NamedTuple):
+    decays: Tuple[float, ...] = tuple(np.round(np.arange(0, 1, 0.025), 3).tolist())
+    half_saturations: Tuple[float, ...] = (0.25, 0.5, 0.75, 1.0, 1.5, 2.0)
+    slopes: Tuple[float, ...] = (0.5, 1.0, 1.5, 2.0, 3.0)
+    # weeks back of the gmv lags & of the rolling means of the gmv of the weeks before
+    lags: Tuple[int, ...] = (1, 2, 4)
+    windows: Tuple[int, ...] = (4, 8)
+
+    def n_configs(self):
+        return len(self.decays) * len(self.half_saturations) * len(self.slopes)
+
+    # (decay, half_saturation, slope) of every config id, ids in C order of the grid
+    def configs(self):
+        decay, half, slope = np.meshgrid(self.decays, self.half_saturations, self.slopes, indexing='ij')
+        return pl.DataFrame({
+            CONFIG_COL: np.arange(self.n_configs(), dtype=np.uint32),
+            'decay': decay.ravel(), 'half_saturation': half.ravel(), 'slope': slope.ravel(),
+        })
+
+    # leading weeks whose lag/rolling controls are incomplete
+    def warmup(self):
+        return max(self.lags + self.windows, default=0)
+
+
+def mmm_dir(source_path):
+    return str(source_path).rstrip('/') + MMM_SUFFIX
+
+
+def channel_col(prefix, channel):
+    return f'{prefix}_{channel}'
+
+
+############### Weekly panel ###############
+
+# Weekly orders & gmv of every (category, channel), weeks starting on Monday. Partial weeks at
+# the ends of the data are dropped & weeks (or channels of a category) without orders are
+# zeros, so the panel is the full categories x channels x weeks grid.
+def weekly_panel(queries, filters=None):
+    dims = ['date_only', GROUP_COL, CHANNEL_COL]
+    daily = queries.total_orders(dims, filters=filters).join(
+        queries.total_gmv(dims, filters=filters), on=dims)
+
+    first, last = daily['date_only'].min(), daily['date_only'].max()
+    daily = daily.with_columns([
+        pl.col('date_only').dt.truncate('1w').alias(WEEK_COL),
+        pl.col(GROUP_COL).cast(pl.Utf8), pl.col(CHANNEL_COL).cast(pl.Utf8),
+    ])
+    weeks = (daily.select(pl.col(WEEK_COL).unique().sort())
+                  .filter((pl.col(WEEK_COL) >= first) & (pl.col(WEEK_COL) + pl.duration(days=6) <= last)))
+
+    weekly = (daily.groupby([GROUP_COL, CHANNEL_COL, WEEK_COL])
+                   .agg([pl.sum('total_orders').alias('orders'), pl.sum('total_gmv').alias(TARGET_COL)]))
+
+    series = weekly.select(pl.col(GROUP_COL).unique()).join(weekly.select(pl.col(CHANNEL_COL).unique()), how='cross')
+    return (series.join(weeks, how='cross')
+                  .join(weekly, on=[GROUP_COL, CHANNEL_COL, WEEK_COL], how='left')
+                  .with_columns([pl.col('orders').fill_null(0).cast(pl.Float64),
+                                 pl.col(TARGET_COL).fill_null(0).cast(pl.Float64)])
+                  .sort([GROUP_COL, CHANNEL_COL, WEEK_COL]))
+
+
+# the panel as arrays: groups, channels, weeks, orders (group, channel, week), gmv (group, week)
+def panel_arrays(panel):
+    groups = panel[GROUP_COL].unique().sort().to_list()
+    channels = panel[CHANNEL_COL].unique().sort().to_list()
+    weeks = panel[WEEK_COL].unique().sort()
+    shape = (len(groups), len(channels), len(weeks))
+
+    orders = panel['orders'].to_numpy().reshape(shape)
+    gmv = panel[TARGET_COL].to_numpy().reshape(shape).sum(axis=1)
+    return groups, channels, weeks, orders, gmv
+
+
+############### Transforms ###############
+
+# Geometric adstock of x (..., week) for every decay at once, (decay, ..., week). With
+# W[d, s, t] = decay_d ** (t - s) for s <= t (0 otherwise) the adstock is x @ W[d].
+def adstock(x, decays):
+    decays = np.asarray(decays, dtype=np.float64)
+    n_weeks = x.shape[-1]
+    lag = np.arange(n_weeks)[None, :] - np.arange(n_weeks)[:, None]
+    # 0 ** 0 is 1, a decay of 0 is the series itself
+    weights = np.where(lag >= 0, decays[:, None, None] ** np.maximum(lag, 0), 0.0)
+
+    weights = weights.reshape((len(decays),) + (1,) * (x.ndim - 1) + (n_weeks, n_weeks))
+    return np.matmul(x[None], weights)
+
+
+# Hill saturation of a (..., week) for every (half_saturation, slope), (half, slope, ..., week).
+# K is half_saturation times the mean of every series over the weeks, series without any
+# orders stay zeros.
+def hill(a, half_saturations, slopes):
+    half = np.asarray(half_saturations, dtype=np.float64)
+    slopes = np.asarray(slopes, dtype=np.float64)
+    extra = (1,) * a.ndim
+
+    mean = a.mean(axis=-1, keepdims=True)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        ratio = np.where(mean > 0, a / mean, 0.0)
+    ratio = ratio[None] / half.reshape((-1,) + extra)
+    powered = ratio[:, None] ** slopes.reshape((1, -1) + extra)
+    return powered / (1 + powered)
+
+
+# Saturated adstock of x (group, channel, week) for every config of the grid,
+# (config, group, channel, week)
+def saturated_adstock(x, grid):
+    a = adstock(x, grid.decays)
+    sat = hill(a, grid.half_saturations, grid.slopes)
+    # (half, slope, decay, ...) -> (decay, half, slope, ...) to match the config ids
+    sat = np.moveaxis(sat, 2, 0)
+    return sat.reshape((grid.n_configs(),) + x.shape)
+
+
+# lags & rolling means of the past weeks' gmv of every group, nulls where the weeks before
+# are missing
+def control_exprs(grid):
+    target = pl.col(TARGET_COL)
+    exprs = [target.shift(lag).over(GROUP_COL).alias(f'{TARGET_COL}_lag_{lag}') for lag in grid.lags]
+    exprs += [target.shift(1).rolling_mean(window).over(GROUP_COL).alias(f'{TARGET_COL}_roll_{window}')
+              for window in grid.windows]
+    return exprs
+
+
+############### Build & load ###############
+
+def build_frames(panel, grid):
+    groups, channels, weeks, orders, gmv = panel_arrays(panel)
+    n_groups, n_weeks = gmv.shape
+
+    weekly = pl.DataFrame({
+        GROUP_COL: np.repeat(groups, n_weeks),
+        WEEK_COL: weeks.take(np.tile(np.arange(n_weeks), n_groups)),
+        TARGET_COL: gmv.ravel(),
+        **{channel_col('orders', ch): orders[:, i].ravel() for i, ch in enumerate(channels)},
+    }).with_columns(control_exprs(grid))
+
+    # rows in (config, group, week) order, the order design_arrays reshapes them in
+    sat = saturated_adstock(orders, grid)
+    configs = grid.configs()
+    rows_per_config = n_groups * n_weeks
+    features = pl.DataFrame({
+        **{col: np.repeat(configs[col].to_numpy(), rows_per_config) for col in configs.columns},
+        GROUP_COL: np.tile(np.repeat(groups, n_weeks), grid.n_configs()),
+        WEEK_COL: weeks.take(np.tile(np.arange(n_weeks), n_groups * grid.n_configs())),
+        **{channel_col('sat', ch): sat[:, :, i].ravel() for i, ch in enumerate(channels)},
+    })
+
+    return weekly, features
+
+
+def _grid_manifest(grid):
+    return {name: list(values) for name, values in grid._asdict().items()}
+
+
+def _read_manifest(out_dir):
+    try:
+        with open(os.path.join(out_dir, MANIFEST_FILE)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+# data & grid the features are of, the queries' data version covers the data's fingerprint
+def features_version(queries, grid):
+    manifest = {'format': FEATURES_FORMAT, 'data_version': queries.data_version, 'grid': _grid_manifest(grid)}
+    return hashlib.sha1(json.dumps(manifest, sort_keys=True).encode()).hexdigest()[:16]
+
+
+# Put the directory built in tmp_dir in the place of out_dir. The old one is moved aside first
+# as a directory can't be replaced by another, when another process put its own build there
+# in between that one is kept (it is of the same data & grid).
+def _swap_in(tmp_dir, out_dir):
+    old_dir = f'{out_dir}.{os.getpid()}.old'
+    try:
+        os.replace(out_dir, old_dir)
+    except FileNotFoundError:
+        pass
+
+    try:
+        os.replace(tmp_dir, out_dir)
+    except OSError:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+    shutil.rmtree(old_dir, ignore_errors=True)
+
+
+# Save the features next to the data, False when they can't be (read only deployments just
+# build them in memory again)
+def _save_features(out_dir, weekly, features, manifest):
+    tmp_dir = f'{out_dir}.{os.getpid()}.tmp'
+    try:
+        os.makedirs(tmp_dir)
+        weekly.write_parquet(os.path.join(tmp_dir, 'weekly.parquet'))
+        # a row group per few configs so reading some configs skips the others
+        features.write_parquet(os.path.join(tmp_dir, 'features.parquet'),
+                               row_group_size=max(weekly.height * 16, 1))
+        with open(os.path.join(tmp_dir, MANIFEST_FILE), 'w') as f:
+            json.dump(manifest, f)
+        _swap_in(tmp_dir, out_dir)
+        return True
+    except OSError:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        return False
+
+
+# Build the features of the queries' data & save them when the data's directory is writable
+def build_features(queries, grid=AdstockGrid()):
+    weekly, features = build_frames(weekly_panel(queries), grid)
+
+    channels = [col[len('orders_'):] for col in weekly.columns if col.startswith('orders_')]
+    manifest = {'format': FEATURES_FORMAT, 'version': features_version(queries, grid),
+                'grid': _grid_manifest(grid), 'channels': channels, 'warmup': grid.warmup(),
+                'n_configs': grid.n_configs(), 'n_rows': features.height}
+    _save_features(mmm_dir(queries.source_path), weekly, features, manifest)
+
+    return weekly, features
+
+
+# Saved (weekly, features) of the queries' data, built when there are none for this version
+# of the data & grid
+def load_features(queries, grid=AdstockGrid(), build=True):
+    out_dir = mmm_dir(queries.source_path)
+    manifest = _read_manifest(out_dir)
+    if manifest is not None and manifest.get('version') == features_version(queries, grid):
+        try:
+            return (pl.read_parquet(os.path.join(out_dir, 'weekly.parquet')),
+                    pl.read_parquet(os.path.join(out_dir, 'features.parquet')))
+        except OSError:
+            # another process is swapping in its build
+            pass
+
+    return build_features(queries, grid) if build else None
+
+
+if __name__ == '__main__':
+    from eda_queries import EdaQueries
+
+    parser = argparse.ArgumentParser(description='Build the weekly MMM features of a parquet data file or partitioned dataset.')
+    parser.add_argument('source', nargs='?', default='df_consumer_v3.parquet')
+    parser.add_argument('--decay-step', type=float, default=0.025, help='step of the decays from 0 to 1')
+    args = parser.parse_args()
+
+    grid = AdstockGrid(decays=tuple(np.round(np.arange(0, 1, args.decay_step), 6).tolist()))
+    queries = EdaQueries(args.source)
+
+    start = time.perf_counter()
+    panel = weekly_panel(queries)
+    panel_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    build_frames(panel, grid)
+    transform_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    weekly, features = build_features(queries, grid)
+    saved = (_read_manifest(mmm_dir(args.source)) or {}).get('version') == features_version(queries, grid)
+    print(f'{weekly[GROUP_COL].n_unique()} categories x {weekly[WEEK_COL].n_unique()} weeks,'
+          f' {grid.n_configs():,} configs ({features.height:,} rows): weekly panel {panel_time:.3f}s,'
+          f' adstock, saturation & frames of every config {transform_time:.3f}s,'
+          f' built {"& saved to " + mmm_dir(args.source) if saved else "(could not save them)"}'
+          f' in {time.perf_counter() - start:.2f}s')
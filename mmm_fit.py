@@ -0,0 +1,277 @@
+import argparse
+import hashlib
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+
+import numpy as np
+import polars as pl
+
+from mmm_features import (CONFIG_COL, GROUP_COL, TARGET_COL, WEEK_COL, AdstockGrid, channel_col, features_version,
+                          load_features, mmm_dir)
+
+
+# Grid search of ridge regressions over the MMM features (see mmm_features.py): for every
+# category, adstock/saturation config & ridge alpha, the category's weekly gmv regressed on
+# the saturated adstock of every channel & the gmv lag/rolling controls.
+#
+# Every fit is small (a few dozen weeks, a handful of columns) so fitting them one by one is
+# all python overhead. The design matrices of a chunk of configs are stacked into one array
+# (config, category, week, column) and solved together: X'X & X'y are one matmul each, the
+# ridge systems of every alpha one batched np.linalg.solve. Columns are standardized on the
+# training weeks so one alpha fits every scale, the intercept isn't penalized. Chunks of
+# configs go to a process pool when there is more than one cpu.
+#
+# The last `holdout` weeks aren't fitted on, their error picks the best config of every
+# category (in sample fits only get better with more freedom).
+#
+#     python mmm_fit.py df_consumer_v3.parquet
+#
+# prints the fits per second & the best config of every category, and saves the best fits with
+# their weekly fitted gmv in `<data file>.mmm/` (warm_cache.py does it too) for the page to show.
+# The page only reads them, it never fits.
+
+
+ALPHAS = (0.01, 0.1, 1.0, 10.0)
+HOLDOUT_WEEKS = 8
+CHUNK_CONFIGS = 256
+
+METRICS = ['r2', 'rmse', 'mape', 'holdout_rmse', 'holdout_mape']
+
+FITS_MANIFEST_FILE = 'fits.json'
+BEST_FITS_FILE = 'best_fits.parquet'
+FITTED_FILE = 'best_fitted.parquet'
+
+
+# (channels, control columns) of the weekly features
+def feature_columns(weekly):
+    channels = [col[len('orders_'):] for col in weekly.columns if col.startswith('orders_')]
+    controls = [col for col in weekly.columns if col.startswith(f'{TARGET_COL}_')]
+    return channels, controls
+
+
+# Arrays of the features after the warmup weeks: saturated adstock (config, group, week,
+# channel), controls (group, week, control), gmv (group, week)
+def design_arrays(weekly, features, grid):
+    channels, controls = feature_columns(weekly)
+    n_groups = weekly[GROUP_COL].n_unique()
+    n_weeks = weekly.height // n_groups
+    n_configs = features.height // weekly.height
+
+    # both are sorted by (config,) group, week when built
+    sat = np.stack([features[channel_col('sat', ch)].to_numpy() for ch in channels], axis=-1)
+    sat = sat.reshape(n_configs, n_groups, n_weeks, len(channels))
+    control = weekly.select(controls).to_numpy().reshape(n_groups, n_weeks, len(controls))
+    y = weekly[TARGET_COL].to_numpy().reshape(n_groups, n_weeks)
+
+    warmup = grid.warmup()
+    return sat[:, :, warmup:], control[:, warmup:], y[:, warmup:]
+
+
+# Ridge fits of every (config, alpha, group) of a chunk, metrics as (config, alpha, group)
+# arrays & the channels' coefficients (in gmv per unit of saturated adstock) as (config,
+# alpha, group, channel)
+def fit_chunk(sat, control, y, alphas=ALPHAS, holdout=HOLDOUT_WEEKS):
+    n_configs, n_groups, n_weeks, n_channels = sat.shape
+    x = np.concatenate([sat, np.broadcast_to(control, (n_configs,) + control.shape)], axis=-1)
+    n_train = n_weeks - holdout
+    if n_train <= x.shape[-1]:
+        raise ValueError(f'{n_train} training weeks for {x.shape[-1]} columns, use a shorter holdout or fewer lags')
+
+    # standardized on the training weeks, constant columns are left at zero
+    train = x[:, :, :n_train]
+    x_mean = train.mean(axis=2, keepdims=True)
+    x_std = train.std(axis=2, keepdims=True)
+    x_std[x_std == 0] = 1.0
+    xs = (x - x_mean) / x_std
+
+    y_mean = y[:, :n_train].mean(axis=1, keepdims=True)
+    y_std = y[:, :n_train].std(axis=1, keepdims=True)
+    y_std[y_std == 0] = 1.0
+    ys = (y - y_mean) / y_std
+
+    xs_train = xs[:, :, :n_train]
+    xtx = np.matmul(np.swapaxes(xs_train, -1, -2), xs_train)
+    xty = np.matmul(np.swapaxes(xs_train, -1, -2), ys[None, :, :n_train, None])
+
+    # (config, alpha, group, column, column), the penalty scaled to the training weeks
+    eye = np.eye(x.shape[-1])
+    penalty = (np.asarray(alphas, dtype=np.float64) * n_train)[None, :, None, None, None] * eye
+    lhs = xtx[:, None] + penalty
+    beta = np.linalg.solve(lhs, np.broadcast_to(xty[:, None], lhs.shape[:-1] + (1,)))
+
+    fitted = y_mean + y_std * np.matmul(xs[:, None], beta)[..., 0]
+    errors = fitted - y
+    train_err, holdout_err = errors[..., :n_train], errors[..., n_train:]
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        ss_tot = ((y[:, :n_train] - y_mean) ** 2).sum(axis=1)
+        metrics = {
+            'r2': 1 - (train_err ** 2).sum(axis=-1) / ss_tot,
+            'rmse': np.sqrt((train_err ** 2).mean(axis=-1)),
+            'mape': np.abs(train_err / y[:, :n_train]).mean(axis=-1) * 100,
+            'holdout_rmse': np.sqrt((holdout_err ** 2).mean(axis=-1)),
+            'holdout_mape': np.abs(holdout_err / y[:, n_train:]).mean(axis=-1) * 100,
+        }
+    coefs = beta[..., :n_channels, 0] * (y_std / x_std[:, :, 0, :n_channels])[:, None]
+    return metrics, coefs
+
+
+def _chunks(n_configs, chunk_size):
+    return [(start, min(start + chunk_size, n_configs)) for start in range(0, n_configs, chunk_size)]
+
+
+# Every fit of the grid as one row per (config, alpha, group) with the config's parameters,
+# the metrics & the channels' coefficients. `workers` processes fit chunks of `chunk_size`
+# configs (None for one per cpu, 1 to fit in this process).
+def fit_grid(weekly, features, grid=AdstockGrid(), alphas=ALPHAS, holdout=HOLDOUT_WEEKS,
+             workers=None, chunk_size=CHUNK_CONFIGS):
+    sat, control, y = design_arrays(weekly, features, grid)
+    chunks = _chunks(sat.shape[0], chunk_size)
+
+    workers = min(workers or os.cpu_count() or 1, len(chunks))
+    if workers > 1:
+        with ProcessPoolExecutor(max_workers=workers, mp_context=get_context('spawn')) as pool:
+            results = list(pool.map(fit_chunk, [sat[start:end] for start, end in chunks],
+                                    [control] * len(chunks), [y] * len(chunks),
+                                    [alphas] * len(chunks), [holdout] * len(chunks)))
+    else:
+        results = [fit_chunk(sat[start:end], control, y, alphas, holdout) for start, end in chunks]
+
+    metrics = {name: np.concatenate([m[name] for m, _ in results]) for name in METRICS}
+    coefs = np.concatenate([c for _, c in results])
+
+    n_configs, n_alphas, n_groups = metrics['r2'].shape
+    channels, _ = feature_columns(weekly)
+    groups = weekly[GROUP_COL].unique(maintain_order=True).to_list()
+    configs = grid.configs()
+    return pl.DataFrame({
+        **{col: np.repeat(configs[col].to_numpy(), n_alphas * n_groups) for col in configs.columns},
+        'alpha': np.tile(np.repeat(np.asarray(alphas, dtype=np.float64), n_groups), n_configs),
+        GROUP_COL: np.tile(groups, n_configs * n_alphas),
+        **{name: values.ravel() for name, values in metrics.items()},
+        **{channel_col('coef', ch): coefs[..., i].ravel() for i, ch in enumerate(channels)},
+    })
+
+
+# best fit of every group by `metric` (lower is better, r2 higher)
+def best_fits(fits, metric='holdout_mape'):
+    return (fits.filter(pl.col(metric).is_not_nan())
+                .sort(metric, descending=metric == 'r2')
+                .groupby(GROUP_COL, maintain_order=True).first()
+                .sort(GROUP_COL))
+
+
+# Weekly gmv & the fitted gmv of a fit (a row of fit_grid), with the weeks held out marked
+def fitted_weeks(weekly, features, fit, grid=AdstockGrid(), holdout=HOLDOUT_WEEKS):
+    sat, control, y = design_arrays(weekly, features, grid)
+    group = weekly[GROUP_COL].unique(maintain_order=True).to_list().index(fit[GROUP_COL])
+    config = fit[CONFIG_COL]
+
+    n_train = y.shape[1] - holdout
+    x = np.concatenate([sat[config, group], control[group]], axis=-1)
+    x_mean, x_std = x[:n_train].mean(axis=0), x[:n_train].std(axis=0)
+    x_std[x_std == 0] = 1.0
+    xs = (x - x_mean) / x_std
+    y_mean, y_std = y[group, :n_train].mean(), y[group, :n_train].std() or 1.0
+
+    penalty = fit['alpha'] * n_train * np.eye(x.shape[-1])
+    beta = np.linalg.solve(xs[:n_train].T @ xs[:n_train] + penalty, xs[:n_train].T @ ((y[group, :n_train] - y_mean) / y_std))
+
+    weeks = weekly.filter(pl.col(GROUP_COL) == fit[GROUP_COL])[WEEK_COL][grid.warmup():]
+    return pl.DataFrame({
+        WEEK_COL: weeks, TARGET_COL: y[group], 'fitted': y_mean + y_std * (xs @ beta),
+        'holdout': np.arange(len(weeks)) >= n_train,
+    })
+
+
+############### Saved best fits ###############
+
+# features & fit settings the best fits are of
+def fits_version(queries, grid=AdstockGrid(), alphas=ALPHAS, holdout=HOLDOUT_WEEKS):
+    manifest = {'features': features_version(queries, grid), 'alphas': list(alphas), 'holdout': holdout}
+    return hashlib.sha1(json.dumps(manifest, sort_keys=True).encode()).hexdigest()[:16]
+
+
+def _save_best_fits(out_dir, best, fitted, version):
+    paths = [os.path.join(out_dir, name) for name in (BEST_FITS_FILE, FITTED_FILE, FITS_MANIFEST_FILE)]
+    tmp_paths = [f'{path}.{os.getpid()}.tmp' for path in paths]
+    try:
+        best.write_parquet(tmp_paths[0])
+        fitted.write_parquet(tmp_paths[1])
+        with open(tmp_paths[2], 'w') as f:
+            json.dump({'version': version}, f)
+        # the manifest last, it only points at fits that are all there
+        for tmp_path, path in zip(tmp_paths, paths):
+            os.replace(tmp_path, path)
+    except OSError:
+        # read only deployments show no fits, they are made offline
+        for tmp_path in tmp_paths:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+
+# Fit the grid over the saved features (built when missing), then save & return the best fit
+# of every group & their weekly fitted gmv
+def fit_best(queries, grid=AdstockGrid(), alphas=ALPHAS, holdout=HOLDOUT_WEEKS, workers=None,
+             chunk_size=CHUNK_CONFIGS):
+    weekly, features = load_features(queries, grid)
+    fits = fit_grid(weekly, features, grid, alphas, holdout, workers, chunk_size)
+
+    best = best_fits(fits)
+    fitted = pl.concat([
+        fitted_weeks(weekly, features, fit, grid, holdout).with_columns(pl.lit(fit[GROUP_COL]).alias(GROUP_COL))
+        for fit in best.rows(named=True)])
+
+    _save_best_fits(mmm_dir(queries.source_path), best, fitted, fits_version(queries, grid, alphas, holdout))
+    return fits, best, fitted
+
+
+# version of the saved best fits when they are of the current data & settings, otherwise None
+def saved_fits_version(queries, grid=AdstockGrid(), alphas=ALPHAS, holdout=HOLDOUT_WEEKS):
+    try:
+        with open(os.path.join(mmm_dir(queries.source_path), FITS_MANIFEST_FILE)) as f:
+            saved = json.load(f).get('version')
+    except (OSError, ValueError):
+        return None
+
+    return saved if saved == fits_version(queries, grid, alphas, holdout) else None
+
+
+# saved (best fits, weekly fitted gmv) of the current data & settings, None when there are none
+def load_best_fits(queries, grid=AdstockGrid(), alphas=ALPHAS, holdout=HOLDOUT_WEEKS):
+    if saved_fits_version(queries, grid, alphas, holdout) is None:
+        return None
+
+    out_dir = mmm_dir(queries.source_path)
+    try:
+        return (pl.read_parquet(os.path.join(out_dir, BEST_FITS_FILE)),
+                pl.read_parquet(os.path.join(out_dir, FITTED_FILE)))
+    except OSError:
+        return None
+
+
+if __name__ == '__main__':
+    from eda_queries import EdaQueries
+
+    parser = argparse.ArgumentParser(description='Grid search the MMM ridge fits of every category.')
+    parser.add_argument('source', nargs='?', default='df_consumer_v3.parquet')
+    parser.add_argument('--workers', type=int, default=None, help='processes fitting (default one per cpu)')
+    parser.add_argument('--chunk-size', type=int, default=CHUNK_CONFIGS, help='configs per chunk of fits')
+    parser.add_argument('--holdout', type=int, default=HOLDOUT_WEEKS, help='last weeks left out of the fits')
+    args = parser.parse_args()
+
+    queries = EdaQueries(args.source)
+    load_features(queries)
+
+    start = time.perf_counter()
+    fits, best, _ = fit_best(queries, holdout=args.holdout, workers=args.workers, chunk_size=args.chunk_size)
+    fit_time = time.perf_counter() - start
+
+    saved = saved_fits_version(queries, holdout=args.holdout) is not None
+    print(f'{fits.height:,} fits in {fit_time:.3f}s ({fits.height / fit_time:,.0f} fits/s),'
+          f' best fits {"saved to " + mmm_dir(args.source) if saved else "could not be saved"}')
+    with pl.Config(tbl_cols=-1, tbl_width_chars=200):
+        print(best)
@@ -0,0 +1,203 @@
+import argparse
+import datetime as dt
+import os
+import shutil
+import statistics
+import tempfile
+import time
+
+import polars as pl
+import pyarrow.parquet as pq
+
+from agg_planner import AggPlanner
+from customer_cohorts import repeat_customer_summary
+from data_schema import optimize_schema
+from eda_queries import PAGE_AGGS
+from partitioned_dataset import list_partitions, partition_glob, write_partitions
+from query_filters import Filters, filter_expr
+
+
+# Rewrite of the data file laid out for the dashboard's queries:
+#   - rows sorted by date_only, so every row group covers a few days and its min/max
+#     statistics let a Year (or Month) filter skip it without reading it
+#   - row groups of ROW_GROUP_SIZE rows, small enough to skip at a fine grain, big enough
+#     that a full scan isn't slowed down by them
+#   - statistics for every column & a codec per column: the columns the page reads on every
+#     cold start with a fast one, the ones it never reads with a small one
+#   - the smaller column types of data_schema.py
+#
+#     python parquet_layout.py df_consumer_v3.parquet df_consumer_v3_sorted.parquet
+#
+# Sorting never needs the whole file in memory: the rows are first split into one temp file
+# per month in batches, then each month is sorted & written on its own. It then counts the row
+# groups polars' parquet reader skips for the dashboard's filters in the old & new file, next to
+# what the footers' statistics allow, and times a few scans of both.
+#
+# The skips are counted from polars' verbose log (one line per row group saying whether its
+# statistics let the reader skip it), not from bytes read: polars mmaps the file so /proc's
+# read counters don't see what it decodes. With polars 0.17 only the integer columns' statistics
+# are used, a date_only range filter reads every row group even when the footers would let it
+# skip most of them, the Year & Month filters do skip.
+
+
+SORT_BY = ['date_only']
+ROW_GROUP_SIZE = 256_000
+
+# columns read by the page's queries, decoded on every cold start
+HOT_COLUMNS = ['date_only', 'Year', 'Month', 'Hour', 'order_id', 'gmv', 'pincode', 'cust_id',
+               'order_payment_type', 'product_analytic_category', 'product_analytic_sub_category']
+HOT_CODEC = 'snappy'
+COLD_CODEC = 'zstd'
+
+
+def column_codecs(columns):
+    return {col: HOT_CODEC if col in HOT_COLUMNS else COLD_CODEC for col in columns}
+
+
+# Write source_path sorted by SORT_BY to out_path, returns the number of row groups written
+def rewrite_sorted(source_path, out_path, row_group_size=ROW_GROUP_SIZE, batch_size=1_000_000):
+    tmp_root = f'{out_path}.{os.getpid()}.parts'
+    tmp_path = f'{out_path}.{os.getpid()}.tmp'
+    writer = None
+    try:
+        # pass 1: rows of every month into their own temp files, one batch in memory at a time
+        for batch in pq.ParquetFile(source_path).iter_batches(batch_size=batch_size):
+            write_partitions(tmp_root, optimize_schema(pl.from_arrow(batch).lazy()).collect())
+
+        # pass 2: the months in order, each one sorted, so the whole file ends up sorted
+        for part_dir in list_partitions(tmp_root).values():
+            table = pl.read_parquet(partition_glob(part_dir)).sort(SORT_BY).to_arrow()
+            if writer is None:
+                writer = pq.ParquetWriter(tmp_path, table.schema, compression=column_codecs(table.column_names),
+                                          write_statistics=True)
+            writer.write_table(table, row_group_size=row_group_size)
+    finally:
+        if writer is not None:
+            writer.close()
+        shutil.rmtree(tmp_root, ignore_errors=True)
+
+    os.replace(tmp_path, out_path)
+    return pq.read_metadata(out_path).num_row_groups
+
+
+# (row groups that may have rows with lo <= column <= hi, all row groups) from the footer's
+# statistics, a row group without statistics has to be read. What a reader could skip, see
+# polars_row_groups_read() for what polars does skip.
+def row_groups_read(path, column, lo=None, hi=None):
+    metadata = pq.read_metadata(path)
+    col_idx = metadata.schema.names.index(column)
+
+    read = 0
+    for i in range(metadata.num_row_groups):
+        stats = metadata.row_group(i).column(col_idx).statistics
+        if stats is None or not stats.has_min_max:
+            read += 1
+        elif (lo is None or stats.max >= lo) and (hi is None or stats.min <= hi):
+            read += 1
+
+    return read, metadata.num_row_groups
+
+
+# row groups polars skips collecting `lf`, counted from its verbose log on stderr
+def polars_row_groups_skipped(lf):
+    old_verbose = os.environ.get('POLARS_VERBOSE')
+    os.environ['POLARS_VERBOSE'] = '1'
+    stderr = os.dup(2)
+    with tempfile.TemporaryFile() as log:
+        os.dup2(log.fileno(), 2)
+        try:
+            lf.collect()
+        finally:
+            os.dup2(stderr, 2)
+            os.close(stderr)
+            if old_verbose is None:
+                del os.environ['POLARS_VERBOSE']
+            else:
+                os.environ['POLARS_VERBOSE'] = old_verbose
+        log.seek(0)
+        return log.read().decode(errors='replace').count('statistics were sufficient to apply the predicate')
+
+
+# (row groups polars reads for `filter`, all row groups) of the file at path
+def polars_row_groups_read(path, filter):
+    n_groups = pq.read_metadata(path).num_row_groups
+    lf = pl.scan_parquet(path)
+    skipped = polars_row_groups_skipped(lf.filter(filter(lf.columns)).select(pl.count()))
+    return n_groups - skipped, n_groups
+
+
+BASE_YEAR = 2015
+MONTH = (dt.date(2016, 3, 1), dt.date(2016, 3, 31))
+
+# the dashboard's filters: the repeat customer query's Year filters & the sidebar's date range
+# and category, {name: (filter of the columns, (column, lo, hi) the footer estimate checks)}
+FILTERS = {
+    f'Year == {BASE_YEAR}': (lambda columns: pl.col('Year') == BASE_YEAR, ('Year', BASE_YEAR, BASE_YEAR)),
+    f'Year > {BASE_YEAR}': (lambda columns: pl.col('Year') > BASE_YEAR, ('Year', BASE_YEAR + 1, None)),
+    'date range (a month)': (lambda columns: filter_expr(Filters(date_range=MONTH), columns), ('date_only', *MONTH)),
+    'category': (lambda columns: filter_expr(Filters(categories=('Camera',)), columns),
+                 ('product_analytic_category', 'Camera', 'Camera')),
+}
+
+
+# {filter name: ((row groups polars reads, all), (row groups the footers allow to skip, all))}
+def filter_skipping(path):
+    return {name: (polars_row_groups_read(path, filter), row_groups_read(path, *estimate))
+            for name, (filter, estimate) in FILTERS.items()}
+
+
+SCANS = {
+    'repeat customers (Year filters)': lambda lf: repeat_customer_summary(lf, base_year=2015),
+    'Year == 2015 customers': lambda lf: lf.filter(pl.col('Year') == 2015).select('cust_id').unique(),
+    'page aggregates (full scan)': None,
+}
+
+
+def _page_aggregates(path):
+    planner = AggPlanner(pl.scan_parquet(path))
+    for spec in PAGE_AGGS:
+        planner.add(spec)
+    return planner.collect()
+
+
+# {scan name: median seconds of `repeat` runs}
+def scan_benchmark(path, repeat=3):
+    times = {}
+    for name, query in SCANS.items():
+        runs = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            if query is None:
+                _page_aggregates(path)
+            else:
+                query(pl.scan_parquet(path)).collect()
+            runs.append(time.perf_counter() - start)
+        times[name] = statistics.median(runs)
+
+    return times
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Rewrite the data file sorted by date_only with statistics & tuned row groups.')
+    parser.add_argument('source')
+    parser.add_argument('out')
+    parser.add_argument('--row-group-size', type=int, default=ROW_GROUP_SIZE)
+    parser.add_argument('--repeat', type=int, default=3, help='runs of every timed scan, the median is shown')
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    n_groups = rewrite_sorted(args.source, args.out, args.row_group_size)
+    print(f'Wrote {args.out} ({os.path.getsize(args.source) / 1e6:,.1f} MB -> {os.path.getsize(args.out) / 1e6:,.1f} MB,'
+          f' {n_groups} row groups) in {time.perf_counter() - start:.1f}s\n')
+
+    print('Row groups polars reads for the dashboard\'s filters (footer statistics estimate in brackets):')
+    before, after = filter_skipping(args.source), filter_skipping(args.out)
+    for name in after:
+        (read_b, n_b), (est_b, _), (read_a, n_a), (est_a, _) = *before[name], *after[name]
+        print(f'  {name:<22} before {read_b}/{n_b} ({est_b})  after {read_a}/{n_a} ({est_a})')
+
+    print('\nScans (median seconds):')
+    before, after = scan_benchmark(args.source, args.repeat), scan_benchmark(args.out, args.repeat)
+    for name in after:
+        print(f'  {name:<35} before {before[name]:.3f}s  after {after[name]:.3f}s'
+              f'  ({(after[name] / before[name] - 1) * 100:+.1f}%)')
@@ -0,0 +1,185 @@
+import argparse
+import glob
+import os
+import time
+import uuid
+
+import polars as pl
+
+from data_schema import optimize_schema
+from data_stats import source_fingerprint
+
+
+# Orders stored as a directory of parquet files partitioned by Year & Month:
+#
+#     <root>/Year=2015/Month=7/part-<id>.parquet
+#
+# New orders are appended as new part files in the partitions they fall in, nothing already
+# written is rewritten. The partition columns are also kept inside the files so the dataset
+# can be scanned like the single file. Append new data (& refresh the rollup cube for just
+# the partitions it touched, and the bitmap index if the dataset has one) with:
+#
+#     python partitioned_dataset.py append <root> <new orders .parquet>
+#
+# and turn the single data file into a partitioned dataset with:
+#
+#     python partitioned_dataset.py convert df_consumer_v3.parquet <root>
+
+
+PARTITION_COLS = ['Year', 'Month']
+
+
+def partition_key(year, month):
+    return f'Year={year}/Month={month}'
+
+
+def partition_path(root, year, month):
+    return os.path.join(root, f'Year={year}', f'Month={month}')
+
+
+# {(Year, Month): partition dir} of every partition under root
+def list_partitions(root):
+    partitions = {}
+    for part_dir in glob.glob(os.path.join(root, 'Year=*', 'Month=*')):
+        year_dir, month_dir = part_dir.split(os.sep)[-2:]
+        year, month = int(year_dir.split('=', 1)[1]), int(month_dir.split('=', 1)[1])
+        partitions[(year, month)] = part_dir
+
+    return dict(sorted(partitions.items()))
+
+
+# {partition key: fingerprint of its files}, a partition is changed when its fingerprint is
+def partition_fingerprints(root):
+    return {partition_key(year, month): source_fingerprint(part_dir)
+            for (year, month), part_dir in list_partitions(root).items()}
+
+
+def partition_glob(part_dir):
+    return os.path.join(part_dir, '*.parquet')
+
+
+# LazyFrame over the single data file or over the files of a partitioned dataset.
+#
+# partition_filter(year, month) -> bool picks the partitions to read, the others are never
+# opened. It only prunes files so callers still filter the rows themselves, that way the same
+# query works (just without the pruning) on a single data file.
+def scan_source(path, partition_filter=None):
+    if not os.path.isdir(path):
+        return pl.scan_parquet(path)
+
+    if partition_filter is None:
+        return pl.scan_parquet(os.path.join(path, '*', '*', '*.parquet'))
+
+    part_dirs = [part_dir for (year, month), part_dir in list_partitions(path).items()
+                 if partition_filter(year, month)]
+    if not part_dirs:
+        schema = pl.read_parquet_schema(glob.glob(os.path.join(path, '*', '*', '*.parquet'))[0])
+        return pl.DataFrame(schema=schema).lazy()
+
+    return pl.concat([pl.scan_parquet(partition_glob(part_dir)) for part_dir in part_dirs])
+
+
+# One LazyFrame per data file (the same partition_filter as scan_source). A scan of several files
+# is a union which doesn't stream in this polars version, a scan of one file does, see
+# lazy_exec.collect_parts.
+def scan_parts(path, partition_filter=None):
+    if not os.path.isdir(path):
+        return [pl.scan_parquet(path)]
+
+    return [pl.scan_parquet(file_path) for (year, month), part_dir in list_partitions(path).items()
+            if partition_filter is None or partition_filter(year, month)
+            for file_path in sorted(glob.glob(partition_glob(part_dir)))]
+
+
+# Write df into the partitions it falls in as new part files, returns the touched partitions
+def write_partitions(root, df, **write_options):
+    touched = []
+    for (year, month), part_df in df.partition_by(PARTITION_COLS, as_dict=True).items():
+        part_dir = partition_path(root, year, month)
+        os.makedirs(part_dir, exist_ok=True)
+
+        # files are only picked up by the *.parquet glob once they are complete
+        file_name = f'part-{time.strftime("%Y%m%d%H%M%S")}-{uuid.uuid4().hex[:8]}.parquet'
+        tmp_path = os.path.join(part_dir, f'.{file_name}.tmp')
+        part_df.write_parquet(tmp_path, **write_options)
+        os.replace(tmp_path, os.path.join(part_dir, file_name))
+
+        touched.append(partition_key(year, month))
+
+    return touched
+
+
+# Append the orders of a new (daily) parquet file to the dataset, with the column types of the
+# files already in it so they can all be scanned together
+def append(root, source_path):
+    df = optimize_schema(pl.scan_parquet(source_path))
+
+    existing = glob.glob(os.path.join(root, '*', '*', '*.parquet'))
+    if existing:
+        schema = pl.read_parquet_schema(existing[0])
+        df = df.select([pl.col(col).cast(dtype) for col, dtype in schema.items()])
+
+    return write_partitions(root, df.collect())
+
+
+# Rewrite a single parquet file as a partitioned dataset at root.
+# One partition is held in memory at a time, sorted by date_only so every row group covers a
+# narrow date range and its min/max statistics let date filters skip it. Columns are stored
+# with the smaller types of data_schema.py.
+def convert(source_path, root, row_group_size=256_000):
+    if list_partitions(root):
+        raise ValueError(f'{root} already has partitions, convert only into a new directory')
+
+    source = optimize_schema(scan_source(source_path))
+    partitions = source.select(PARTITION_COLS).unique().sort(PARTITION_COLS).collect().rows()
+
+    touched = []
+    for year, month in partitions:
+        part_df = (source.filter((pl.col('Year') == year) & (pl.col('Month') == month))
+                         .sort('date_only').collect())
+        # pyarrow's writer so the min/max statistics are ones every parquet reader understands
+        touched += write_partitions(root, part_df, row_group_size=row_group_size, statistics=True,
+                                    use_pyarrow=True)
+
+    return touched
+
+
+if __name__ == '__main__':
+    # imported here as rollup_cube & bitmap_index themselves import this module
+    from bitmap_index import build_index, index_dir
+    from rollup_cube import refresh_cube
+
+    parser = argparse.ArgumentParser(description='Maintain the Year/Month partitioned dataset.')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    append_cmd = commands.add_parser('append', help='append new orders & refresh the cube')
+    append_cmd.add_argument('root')
+    append_cmd.add_argument('source')
+
+    convert_cmd = commands.add_parser('convert', help='rewrite a single parquet file as a partitioned dataset')
+    convert_cmd.add_argument('source')
+    convert_cmd.add_argument('root')
+    convert_cmd.add_argument('--row-group-size', type=int, default=256_000)
+
+    args = parser.parse_args()
+
+    if args.command == 'append':
+        start = time.perf_counter()
+        touched = append(args.root, args.source)
+        print(f'Appended {args.source} to {len(touched)} partition(s): {", ".join(touched)}')
+
+        refreshed = refresh_cube(args.root)
+        print(f'Cube refreshed for {len(refreshed)} partition(s) in {time.perf_counter() - start:.2f}s')
+
+        # row numbers change with new rows, the index is built again as a whole
+        if os.path.isdir(index_dir(args.root)):
+            build_index(args.root)
+            print(f'Bitmap index rebuilt in {time.perf_counter() - start:.2f}s')
+
+    elif args.command == 'convert':
+        start = time.perf_counter()
+        touched = convert(args.source, args.root, args.row_group_size)
+        print(f'Wrote {len(touched)} partition(s) to {args.root}')
+
+        refresh_cube(args.root)
+        print(f'Dataset & its cube built in {time.perf_counter() - start:.2f}s')
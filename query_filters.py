@@ -0,0 +1,86 @@
+import datetime as dt
+from functools import reduce
+from typing import NamedTuple, Optional, Tuple
+
+import polars as pl
+
+
+# Filters of the page's sidebar, applied to every query.
+#
+# A Filters is hashable & has a stable repr so it can be part of any cache key, "no filter" is
+# always None (see make_filters) so unfiltered queries share their cache entries with the ones
+# made before filters existed. A filter can be applied to the raw data or to anything
+# aggregated from it that still has its columns, like a cuboid of the rollup cube, see
+# filter_expr().
+
+
+class Filters(NamedTuple):
+    date_range: Optional[Tuple[dt.date, dt.date]] = None
+    categories: Optional[Tuple[str, ...]] = None
+    payment_types: Optional[Tuple[str, ...]] = None
+    pincodes: Optional[Tuple[int, ...]] = None
+
+
+# filter field -> column it filters, for the ones keeping rows with a value in a list
+VALUE_FILTERS = {
+    'categories': 'product_analytic_category',
+    'payment_types': 'order_payment_type',
+    'pincodes': 'pincode',
+}
+
+
+# Filters out of the sidebar's inputs, None when nothing is filtered. `full_date_range` is the
+# range of the data, a date_range covering it filters nothing.
+def make_filters(date_range=None, categories=None, payment_types=None, pincodes=None, full_date_range=None):
+    if date_range is not None and full_date_range is not None \
+            and date_range[0] <= full_date_range[0] and date_range[1] >= full_date_range[1]:
+        date_range = None
+
+    filters = Filters(
+        date_range=tuple(date_range) if date_range else None,
+        categories=tuple(sorted(categories)) if categories else None,
+        payment_types=tuple(sorted(payment_types)) if payment_types else None,
+        pincodes=tuple(sorted(pincodes)) if pincodes else None,
+    )
+    return None if filters == Filters() else filters
+
+
+def whole_months(date_range):
+    start, end = date_range
+    return start.day == 1 and (end + dt.timedelta(days=1)).day == 1
+
+
+def _month_number(year, month):
+    return year * 12 + month
+
+
+# Expression keeping the filtered rows of a frame having `columns`, None when the filters need
+# a column it doesn't have. A date range is matched on date_only, or on Year & Month when it is
+# made of whole months.
+def filter_expr(filters, columns):
+    if filters is None:
+        return pl.lit(True)
+
+    columns = set(columns)
+    exprs = []
+
+    if filters.date_range is not None:
+        start, end = filters.date_range
+        if 'date_only' in columns:
+            exprs.append(pl.col('date_only').is_between(start, end, closed='both'))
+        elif {'Year', 'Month'} <= columns and whole_months(filters.date_range):
+            month = pl.col('Year').cast(pl.Int32) * 12 + pl.col('Month').cast(pl.Int32)
+            exprs.append(month.is_between(_month_number(start.year, start.month),
+                                          _month_number(end.year, end.month), closed='both'))
+        else:
+            return None
+
+    for field, col in VALUE_FILTERS.items():
+        values = getattr(filters, field)
+        if values is None:
+            continue
+        if col not in columns:
+            return None
+        exprs.append(pl.col(col).is_in(list(values)))
+
+    return reduce(lambda a, b: a & b, exprs, pl.lit(True))
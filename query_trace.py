@@ -0,0 +1,237 @@
+import json
+import os
+import resource
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+
+# Timings of the hot paths of the page, to see where a slow render spent its time.
+#
+# Every lazy plan collect (lazy_exec.py), query (eda_queries.py), pandas conversion
+# (chart_data.py) and chart build (figure_cache.py) runs in a span that records:
+#   - wall time and rows in & out
+#   - bytes read and peak memory growth
+#   - cache hit or miss
+#   - the optimized plan, with EDA_TRACE_PLANS=1
+# Bytes read & memory come from /proc/self & getrusage so they are the whole process', spans
+# running at the same time on other threads count in each other's numbers.
+#
+# The last MAX_SPANS spans & totals per (kind, label) since the process started are kept in
+# memory, shown by the app's debug panel (open the page with ?debug=1) and dumped as JSON or
+# in the Prometheus text format. EDA_TRACE=0 turns it all off.
+
+
+ENABLED = os.environ.get('EDA_TRACE', '1') not in ('', '0')
+CAPTURE_PLANS = os.environ.get('EDA_TRACE_PLANS', '0') not in ('', '0')
+
+MAX_SPANS = 2000
+
+_PAGE_SIZE = os.sysconf('SC_PAGE_SIZE') if hasattr(os, 'sysconf') else 4096
+
+
+def set_capture_plans(enabled):
+    global CAPTURE_PLANS
+    CAPTURE_PLANS = bool(enabled)
+
+
+# (bytes read through read calls, bytes read from disk) of the process, zeros where there is
+# no /proc
+def _io_counters():
+    try:
+        with open('/proc/self/io') as f:
+            counters = dict(line.split(': ') for line in f.read().splitlines())
+        return int(counters['rchar']), int(counters['read_bytes'])
+    except (OSError, KeyError, ValueError):
+        return 0, 0
+
+
+def _rss_bytes():
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * _PAGE_SIZE
+    except (OSError, IndexError, ValueError):
+        return 0
+
+
+# peak resident memory of the process so far (linux reports it in KB)
+def _max_rss_bytes():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class Span:
+
+    def __init__(self, kind, label, parent=None, **fields):
+        self.kind = kind
+        self.label = label
+        self.parent = parent
+        self.start = time.time()
+        self.seconds = None
+        self.rows_in = None
+        self.rows_out = None
+        self.bytes_read = None
+        self.disk_bytes_read = None
+        self.rss_delta = None
+        self.max_rss_delta = None
+        self.cache = None
+        self.plan = None
+        self.error = None
+        self.thread = threading.current_thread().name
+        self.fields = fields
+
+    def annotate(self, **fields):
+        for name, value in fields.items():
+            if hasattr(self, name) and name != 'fields':
+                setattr(self, name, value)
+            else:
+                self.fields[name] = value
+
+    def to_dict(self):
+        d = {name: value for name, value in vars(self).items() if name != 'fields'}
+        d.update(self.fields)
+        return d
+
+
+class Tracer:
+
+    def __init__(self, max_spans=MAX_SPANS):
+        self.spans = deque(maxlen=max_spans)
+        self.totals = {}
+        self.started = time.time()
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def _stack(self):
+        if not hasattr(self._local, 'stack'):
+            self._local.stack = []
+        return self._local.stack
+
+    # innermost span of this thread, None outside of any
+    def current(self):
+        stack = self._stack()
+        return stack[-1] if stack else None
+
+    # Record the block as a span, the span is given to it to annotate (rows, cache, plan...)
+    @contextmanager
+    def span(self, kind, label, **fields):
+        if not ENABLED:
+            yield Span(kind, label, **fields)
+            return
+
+        stack = self._stack()
+        span = Span(kind, label, parent=stack[-1].label if stack else None, **fields)
+        stack.append(span)
+
+        rchar, read_bytes = _io_counters()
+        rss, max_rss = _rss_bytes(), _max_rss_bytes()
+        start = time.perf_counter()
+        try:
+            yield span
+        except BaseException as e:
+            span.error = f'{type(e).__name__}: {e}'
+            raise
+        finally:
+            span.seconds = time.perf_counter() - start
+            end_rchar, end_read_bytes = _io_counters()
+            span.bytes_read = end_rchar - rchar
+            span.disk_bytes_read = end_read_bytes - read_bytes
+            span.rss_delta = _rss_bytes() - rss
+            span.max_rss_delta = _max_rss_bytes() - max_rss
+            stack.pop()
+            self._record(span)
+
+    # a span timed by the caller, for blocks that can't be wrapped in a with (a whole script run)
+    def record(self, kind, label, seconds, **fields):
+        if not ENABLED:
+            return
+        span = Span(kind, label, **fields)
+        span.start -= seconds
+        span.seconds = seconds
+        self._record(span)
+
+    def _record(self, span):
+        with self._lock:
+            self.spans.append(span)
+            total = self.totals.setdefault((span.kind, span.label), {
+                'kind': span.kind, 'label': span.label, 'count': 0, 'seconds': 0.0, 'max_seconds': 0.0,
+                'hits': 0, 'misses': 0, 'errors': 0, 'rows_out': 0, 'bytes_read': 0, 'not_streamed': 0,
+            })
+            total['count'] += 1
+            total['seconds'] += span.seconds
+            total['max_seconds'] = max(total['max_seconds'], span.seconds)
+            total['hits'] += span.cache == 'hit'
+            total['misses'] += span.cache == 'miss'
+            total['errors'] += span.error is not None
+            total['rows_out'] += span.rows_out or 0
+            total['bytes_read'] += span.bytes_read or 0
+            total['not_streamed'] += 'not_streamed' in span.fields
+
+    # spans that started at or after `since` (time.time()), oldest first
+    def recent(self, since=None):
+        with self._lock:
+            spans = list(self.spans)
+        return [span for span in spans if since is None or span.start >= since]
+
+    def summary(self):
+        with self._lock:
+            return sorted((dict(total) for total in self.totals.values()), key=lambda t: t['seconds'], reverse=True)
+
+    def reset(self):
+        with self._lock:
+            self.spans.clear()
+            self.totals.clear()
+            self.started = time.time()
+
+    def to_json(self, since=None):
+        return json.dumps({
+            'started': self.started,
+            'summary': self.summary(),
+            'spans': [span.to_dict() for span in self.recent(since)],
+        }, default=str)
+
+    def prometheus_text(self):
+        metrics = [
+            ('eda_span_seconds_total', 'counter', 'Wall time spent in traced spans', 'seconds'),
+            ('eda_span_count_total', 'counter', 'Traced spans run', 'count'),
+            ('eda_span_max_seconds', 'gauge', 'Slowest traced span', 'max_seconds'),
+            ('eda_cache_hits_total', 'counter', 'Traced spans answered from a cache', 'hits'),
+            ('eda_cache_misses_total', 'counter', 'Traced spans computed on a cache miss', 'misses'),
+            ('eda_span_errors_total', 'counter', 'Traced spans that raised', 'errors'),
+            ('eda_rows_out_total', 'counter', 'Rows returned by traced spans', 'rows_out'),
+            ('eda_bytes_read_total', 'counter', 'Bytes the process read during traced spans', 'bytes_read'),
+            ('eda_not_streamed_total', 'counter', 'Collects that could not fully stream', 'not_streamed'),
+        ]
+        summary = self.summary()
+
+        lines = []
+        for name, metric_type, help_text, field in metrics:
+            lines.append(f'# HELP {name} {help_text}')
+            lines.append(f'# TYPE {name} {metric_type}')
+            for total in summary:
+                lines.append(f'{name}{{kind="{_escape(total["kind"])}",label="{_escape(total["label"])}"}} {total[field]}')
+        return '\n'.join(lines) + '\n'
+
+    # write the Prometheus text to path (swapped in, for a node exporter textfile collector)
+    def write_prometheus(self, path):
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'w') as f:
+            f.write(self.prometheus_text())
+        os.replace(tmp_path, path)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+# one tracer for the whole process
+tracer = Tracer()
+span = tracer.span
+record = tracer.record
+
+
+# annotate the innermost span of this thread, if any
+def annotate(**fields):
+    current = tracer.current()
+    if current is not None:
+        current.annotate(**fields)
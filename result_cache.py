@@ -0,0 +1,132 @@
+import hashlib
+import os
+import threading
+import time
+import uuid
+
+import polars as pl
+
+
+# Query results (polars DataFrames) kept on disk as uncompressed Arrow IPC files shared by every
+# process of the node, so app replicas & worker jobs compute an aggregation once between them.
+#
+# Files are named by a digest of their key (see EdaQueries.cache_key, it holds the version of
+# the data & of the query code) so a key always maps to the same content, a new version of the
+# data simply uses new files. They are read back memory mapped: loading a result is mapping a
+# file, not copying it, and the OS shares the pages between processes.
+#
+# Writers write to a unique temp file & rename it into place so readers never see half a
+# file. The cache is bounded by total size, the least recently used files go first.
+
+
+SUFFIX = '.arrow'
+
+# temp files of writers that died are removed by eviction after this long
+STALE_TMP_SECONDS = 3600
+
+
+class DiskCache:
+
+    def __init__(self, cache_dir, max_bytes=1024 * 1024 * 1024):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def path(self, key):
+        digest = hashlib.sha1(key.encode()).hexdigest()
+        return os.path.join(self.cache_dir, digest[:2], digest + SUFFIX)
+
+    def _entries(self):
+        for sub_dir in os.scandir(self.cache_dir):
+            if not sub_dir.is_dir():
+                continue
+            for entry in os.scandir(sub_dir.path):
+                yield entry
+
+    @property
+    def size_bytes(self):
+        return sum(entry.stat().st_size for entry in self._entries() if entry.name.endswith(SUFFIX))
+
+    def __len__(self):
+        return sum(1 for entry in self._entries() if entry.name.endswith(SUFFIX))
+
+    def get(self, key):
+        path = self.path(key)
+        try:
+            df = pl.read_ipc(path, memory_map=True)
+        except (FileNotFoundError, PermissionError):
+            with self._lock:
+                self.misses += 1
+            return None
+
+        # mtime is the last use, eviction drops the oldest first. A file of another user (e.g. one
+        # warm_cache.py wrote) or a read only cache can't be touched, it's still a hit.
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+
+        with self._lock:
+            self.hits += 1
+        return df
+
+    def put(self, key, df):
+        path = self.path(key)
+        # same key, same content, whoever wrote it first
+        if os.path.exists(path):
+            return
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f'{path}.{os.getpid()}-{uuid.uuid4().hex[:8]}.tmp'
+        try:
+            # uncompressed so it can be memory mapped
+            df.write_ipc(tmp_path, compression='uncompressed')
+            os.replace(tmp_path, path)
+        except OSError:
+            # a full or read only disk only costs the caching
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+            return
+
+        self.evict()
+
+    # Remove the least recently used files till the cache fits in max_bytes
+    def evict(self):
+        now = time.time()
+        files = []
+        for entry in self._entries():
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+
+            if entry.name.endswith('.tmp'):
+                if now - stat.st_mtime > STALE_TMP_SECONDS:
+                    self._remove(entry.path)
+            elif entry.name.endswith(SUFFIX):
+                files.append((stat.st_mtime, stat.st_size, entry.path))
+
+        total = sum(size for _, size, _ in files)
+        for _, size, path in sorted(files):
+            if total <= self.max_bytes:
+                break
+            # other processes having it mapped keep their copy (on windows it stays till unmapped)
+            if self._remove(path):
+                total -= size
+
+    @staticmethod
+    def _remove(path):
+        try:
+            os.remove(path)
+            return True
+        except OSError:
+            return False
+
+    def clear(self):
+        for entry in list(self._entries()):
+            self._remove(entry.path)
@@ -0,0 +1,231 @@
+import argparse
+import json
+import os
+import shutil
+import time
+
+import polars as pl
+
+from agg_planner import AggPlanner, AggSpec, metric_name, rollup
+from data_schema import optimize_schema
+from data_stats import source_fingerprint
+from partitioned_dataset import list_partitions, partition_fingerprints, partition_glob, partition_key, scan_source
+from query_filters import filter_expr
+
+
+# Pre aggregated "cube" of the data file for the dimensions the dashboard groups by.
+#
+# It is made of a few cuboids (group by of a set of dimensions with order count, gmv sum and
+# row count), each small enough to load in memory. A query is answered by rolling up the
+# smallest cuboid holding all of its group keys, only queries no cuboid can answer need the
+# raw data. Built offline with:
+#
+#     python rollup_cube.py df_consumer_v3.parquet
+#
+# and saved as parquet files in `<data file>.cube/` along with the data file's fingerprint,
+# a cube built from an older version of the file is ignored.
+#
+# For a Year/Month partitioned dataset (see partitioned_dataset.py) the cube is kept per
+# partition, `python rollup_cube.py <root>` only rebuilds the pieces of new or changed
+# partitions so refreshing it costs as much as the new data, not the whole history.
+
+
+CUBE_SUFFIX = '.cube'
+MANIFEST_FILE = 'manifest.json'
+
+# changes when the cuboid files change shape or types, cubes of an older format are built again
+CUBE_FORMAT = 2
+
+# Year & Month come from date_only so keeping them next to it doesn't add any rows
+CUBOIDS = {
+    'daily': ['date_only', 'Year', 'Month', 'product_analytic_category',
+              'product_analytic_sub_category', 'order_payment_type'],
+    'hourly': ['Year', 'Month', 'Hour', 'product_analytic_category',
+               'product_analytic_sub_category', 'order_payment_type'],
+    'pincode': ['Year', 'Month', 'pincode', 'product_analytic_category', 'order_payment_type'],
+}
+
+# metrics stored in every cuboid, all of them roll up by summing
+CUBE_METRICS = [
+    AggSpec((), 'count', 'order_id', 'total_orders'),
+    AggSpec((), 'sum', 'gmv', 'total_gmv'),
+    AggSpec((), 'rows', None, 'count'),
+]
+
+
+def cube_dir(source_path):
+    return str(source_path).rstrip('/') + CUBE_SUFFIX
+
+
+def _cuboid_path(out_dir, name):
+    return os.path.join(out_dir, f'{name}.parquet')
+
+
+def _read_manifest(out_dir):
+    try:
+        with open(os.path.join(out_dir, MANIFEST_FILE)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _write_manifest(out_dir, manifest):
+    tmp_path = os.path.join(out_dir, f'{MANIFEST_FILE}.{os.getpid()}.tmp')
+    with open(tmp_path, 'w') as f:
+        json.dump(manifest, f)
+    os.replace(tmp_path, os.path.join(out_dir, MANIFEST_FILE))
+
+
+# Every cuboid of df in one scan, saved in out_dir (swapped in so readers never see half of it)
+def _write_cuboids(df, cuboids, out_dir):
+    plan = {frozenset(dims): [spec._replace(groupof=tuple(dims)) for spec in CUBE_METRICS]
+            for dims in cuboids.values()}
+    grains = AggPlanner(df).collect_grains(plan)
+
+    tmp_dir = f'{out_dir}.{os.getpid()}.tmp'
+    os.makedirs(tmp_dir)
+    for name, dims in cuboids.items():
+        grains[frozenset(dims)].write_parquet(_cuboid_path(tmp_dir, name))
+
+    if os.path.exists(out_dir):
+        shutil.rmtree(out_dir)
+    os.replace(tmp_dir, out_dir)
+
+    return {name: grains[frozenset(dims)] for name, dims in cuboids.items()}
+
+
+# Build & save every cuboid of the cube from the data file in one scan
+def build_cube(source_path, cuboids=CUBOIDS):
+    fingerprint = source_fingerprint(source_path)
+    out_dir = cube_dir(source_path)
+
+    frames = _write_cuboids(optimize_schema(scan_source(source_path)), cuboids, out_dir)
+    _write_manifest(out_dir, {'format': CUBE_FORMAT, 'fingerprint': fingerprint, 'cuboids': cuboids})
+
+    return RollupCube(cuboids, frames)
+
+
+# Bring the cube of a partitioned dataset up to date, only new or changed partitions are
+# aggregated again. Returns the partition keys that were rebuilt.
+def refresh_cube(root, cuboids=CUBOIDS):
+    out_dir = cube_dir(root)
+    os.makedirs(out_dir, exist_ok=True)
+
+    manifest = _read_manifest(out_dir)
+    if manifest is None or manifest.get('format') != CUBE_FORMAT or manifest.get('cuboids') != cuboids:
+        manifest = {'format': CUBE_FORMAT, 'cuboids': cuboids, 'partitions': {}}
+
+    current = partition_fingerprints(root)
+    done = manifest['partitions']
+
+    rebuilt = []
+    for (year, month), part_dir in list_partitions(root).items():
+        key = partition_key(year, month)
+        if done.get(key) == current[key]:
+            continue
+
+        _write_cuboids(optimize_schema(pl.scan_parquet(partition_glob(part_dir))), cuboids,
+                       os.path.join(out_dir, key))
+        done[key] = current[key]
+        rebuilt.append(key)
+
+        # saved after every partition so an interrupted refresh picks up where it stopped
+        _write_manifest(out_dir, manifest)
+
+    for key in set(done) - set(current):
+        shutil.rmtree(os.path.join(out_dir, key), ignore_errors=True)
+        del done[key]
+    _write_manifest(out_dir, manifest)
+
+    return rebuilt
+
+
+# one cuboid out of the per partition pieces, pieces only need summing again when the
+# cuboid doesn't have the partition columns
+def _combine_pieces(pieces, dims):
+    combined = pl.concat(pieces)
+    if {'Year', 'Month'} <= set(dims):
+        return combined
+
+    metrics = [col for col in combined.columns if col not in dims]
+    return combined.groupby(dims).agg([pl.sum(col) for col in metrics])
+
+
+class RollupCube:
+
+    def __init__(self, cuboids, frames):
+        self.cuboids = cuboids
+        self.frames = frames
+
+    # Load the saved cube of the data file, None if there is none or the data changed since
+    @classmethod
+    def load(cls, source_path):
+        out_dir = cube_dir(source_path)
+        manifest = _read_manifest(out_dir)
+        if manifest is None or manifest.get('format') != CUBE_FORMAT:
+            return None
+
+        cuboids = manifest['cuboids']
+
+        if not os.path.isdir(source_path):
+            if manifest.get('fingerprint') != source_fingerprint(source_path):
+                return None
+            frames = {name: pl.read_parquet(_cuboid_path(out_dir, name)) for name in cuboids}
+            return cls(cuboids, frames)
+
+        partitions = manifest.get('partitions', {})
+        if not partitions or partitions != partition_fingerprints(source_path):
+            return None
+
+        frames = {
+            name: _combine_pieces(
+                [pl.read_parquet(_cuboid_path(os.path.join(out_dir, key), name)) for key in partitions],
+                dims)
+            for name, dims in cuboids.items()
+        }
+        return cls(cuboids, frames)
+
+    # smallest cuboid that has all group keys & the metric of the spec, and the columns the
+    # filters (see query_filters.py) need
+    def _find_cuboid(self, spec, filters=None):
+        matches = [
+            name for name, dims in self.cuboids.items()
+            if set(spec.groupof) <= set(dims) and metric_name(spec) in self.frames[name].columns
+            and filter_expr(filters, dims) is not None
+        ]
+        if not matches:
+            return None
+        return min(matches, key=lambda name: self.frames[name].height)
+
+    def can_answer(self, spec, filters=None):
+        return self._find_cuboid(spec, filters) is not None
+
+    # result of the spec rolled up from the cube, None when the cube can't answer it
+    def answer(self, spec, filters=None):
+        name = self._find_cuboid(spec, filters)
+        if name is None:
+            return None
+
+        frame, dims = self.frames[name], self.cuboids[name]
+        if filters is not None:
+            frame = frame.filter(filter_expr(filters, dims))
+        return rollup(frame, dims, spec)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Build the rollup cube of a parquet data file or refresh the one of a partitioned dataset.')
+    parser.add_argument('source', nargs='?', default='df_consumer_v3.parquet')
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    if os.path.isdir(args.source):
+        rebuilt = refresh_cube(args.source)
+        print(f'Rebuilt {len(rebuilt)} partition(s): {", ".join(rebuilt) or "none, cube already up to date"}')
+        cube = RollupCube.load(args.source)
+    else:
+        cube = build_cube(args.source)
+
+    for name, frame in cube.frames.items():
+        print(f'{name:>10}: {frame.height:>10,} rows  {cube.cuboids[name]}')
+    print(f'Cube saved to {cube_dir(args.source)} in {time.perf_counter() - start:.2f}s')
@@ -0,0 +1,141 @@
+import argparse
+import datetime as dt
+import os
+import time
+
+import numpy as np
+import polars as pl
+import pyarrow.parquet as pq
+
+from partitioned_dataset import write_partitions
+
+
+# Synthetic orders with the same columns as df_consumer_v3.parquet, for benchmarking at sizes
+# the real file doesn't have (it is only a Git LFS pointer in the repo anyway).
+#
+# Customers & pincodes follow a power law (`skew`, 0 = uniform) so a few of them have most of
+# the orders like in the real data. Rows are made in chunks so any size fits in memory, and
+# go to a single parquet file (one row group per chunk) or a Year/Month partitioned dataset:
+#
+#     python synthetic_data.py bench_10m.parquet --rows 10_000_000
+#     python synthetic_data.py bench_10m/ --rows 10_000_000 --partitioned
+
+
+# product_analytic_category -> its product_analytic_sub_category values
+CATEGORIES = {
+    'CameraAccessory': ['CameraAccessory', 'CameraStorage'],
+    'Camera': ['Camera'],
+    'EntertainmentSmall': ['Speaker', 'AudioMP3Player', 'HomeAudio', 'AudioAccessory',
+                           'TVVideoSmall', 'AmplifierAndAudioVideoReceiver'],
+    'GameCDDVD': ['Game'],
+    'GamingHardware': ['GamingConsole', 'GamingAccessory'],
+}
+
+# share of orders by hour of day, lowest around 5am & highest around noon
+HOUR_WEIGHTS = np.array([3, 2, 1.5, 1, 0.8, 0.6, 0.8, 1.5, 3, 4.5, 5.5, 6.5,
+                         6.5, 6, 5.8, 5.6, 5.5, 5.5, 5.6, 5.8, 6, 5.5, 4.8, 4])
+
+PREPAID_SHARE = 0.3
+
+
+# `size` ranks in [0, n_items) with P(rank) ~ 1 / (rank + 1) ** skew, by inverting the
+# continuous power law so no per item array is needed even for 100M+ customers
+def _power_law_ranks(rng, n_items, skew, size):
+    u = rng.random(size)
+    if skew == 0:
+        x = 1 + u * n_items
+    elif skew == 1:
+        x = (n_items + 1.0) ** u
+    else:
+        x = (1 + u * ((n_items + 1.0) ** (1 - skew) - 1)) ** (1 / (1 - skew))
+
+    return np.clip(x.astype(np.int64) - 1, 0, n_items - 1)
+
+
+# string column out of a few distinct values, picked in polars (numpy string arrays are slow)
+def _pick(name, values, idx):
+    return pl.Series(name, values).take(idx)
+
+
+def _chunk(rng, start_id, n, *, start_date, n_days, n_customers, skew, pincodes):
+    sub_categories = [(cat, sub) for cat, subs in CATEGORIES.items() for sub in subs]
+    sub_idx = rng.integers(0, len(sub_categories), n)
+    is_camera = np.array([cat == 'Camera' for cat, _ in sub_categories])[sub_idx]
+
+    first_day = (start_date - dt.date(1970, 1, 1)).days
+    days = rng.integers(0, n_days, n)
+
+    return pl.DataFrame([
+        pl.Series('order_id', np.arange(start_id, start_id + n, dtype=np.int64)),
+        pl.Series('cust_id', _power_law_ranks(rng, n_customers, skew, n) * 7919 + 10_000_000),
+        pl.Series('gmv', rng.gamma(1.5, np.where(is_camera, 4000.0, 600.0)).round(0)),
+        pl.Series('Hour', rng.choice(24, n, p=HOUR_WEIGHTS / HOUR_WEIGHTS.sum()).astype(np.int64)),
+        pl.Series('pincode', pincodes[_power_law_ranks(rng, len(pincodes), skew, n)]),
+        _pick('order_payment_type', ['COD', 'Prepaid'], (rng.random(n) < PREPAID_SHARE).astype(np.uint32)),
+        _pick('product_analytic_super_category', ['CE'], np.zeros(n, dtype=np.uint32)),
+        _pick('product_analytic_category', [cat for cat, _ in sub_categories], sub_idx),
+        _pick('product_analytic_sub_category', [sub for _, sub in sub_categories], sub_idx),
+        _pick('product_analytic_vertical', [f'{sub}Vertical' for _, sub in sub_categories], sub_idx),
+        pl.Series('date_only', (days + first_day).astype(np.int32)).cast(pl.Date),
+    ]).with_columns(
+        Year = pl.col('date_only').dt.year().cast(pl.Int64),
+        Month = pl.col('date_only').dt.month().cast(pl.Int64),
+    )
+
+
+# Write n_rows synthetic orders to `path`, a parquet file or (partitioned=True) a dataset dir
+def generate(path, n_rows, *, n_customers=None, n_pincodes=20_000, skew=0.9,
+             start_date=dt.date(2015, 7, 1), n_days=366, chunk_rows=2_000_000,
+             partitioned=False, seed=0):
+    rng = np.random.default_rng(seed)
+
+    # about 3 orders per customer unless told otherwise
+    n_customers = n_customers or max(n_rows // 3, 1)
+    pincodes = rng.choice(900_000, n_pincodes, replace=False).astype(np.int64) + 100_000
+
+    options = dict(start_date=start_date, n_days=n_days, n_customers=n_customers, skew=skew,
+                   pincodes=pincodes)
+
+    writer = None
+    try:
+        for start in range(0, n_rows, chunk_rows):
+            chunk = _chunk(rng, start, min(chunk_rows, n_rows - start), **options)
+
+            if partitioned:
+                write_partitions(path, chunk)
+                continue
+
+            table = chunk.to_arrow()
+            if writer is None:
+                writer = pq.ParquetWriter(path, table.schema, compression='zstd')
+            writer.write_table(table)
+    finally:
+        if writer is not None:
+            writer.close()
+
+    return path
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Write synthetic orders shaped like df_consumer_v3.parquet.')
+    parser.add_argument('path')
+    parser.add_argument('--rows', type=lambda v: int(v.replace('_', '')), default=1_000_000)
+    parser.add_argument('--customers', type=int, default=None, help='distinct cust_id (default rows / 3)')
+    parser.add_argument('--pincodes', type=int, default=20_000)
+    parser.add_argument('--skew', type=float, default=0.9, help='power law exponent of customers & pincodes')
+    parser.add_argument('--days', type=int, default=366)
+    parser.add_argument('--chunk-rows', type=int, default=2_000_000)
+    parser.add_argument('--partitioned', action='store_true', help='write a Year/Month partitioned dataset')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    generate(args.path, args.rows, n_customers=args.customers, n_pincodes=args.pincodes,
+             skew=args.skew, n_days=args.days, chunk_rows=args.chunk_rows,
+             partitioned=args.partitioned, seed=args.seed)
+
+    if args.partitioned:
+        size = sum(os.path.getsize(os.path.join(d, f)) for d, _, files in os.walk(args.path) for f in files)
+    else:
+        size = os.path.getsize(args.path)
+    print(f'Wrote {args.rows:,} rows ({size / 1e6:,.1f} MB) to {args.path} in {time.perf_counter() - start:.1f}s')
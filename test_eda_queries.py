@@ -0,0 +1,102 @@
+from concurrent.futures import ThreadPoolExecutor, wait
+
+import polars as pl
+import pytest
+
+import lazy_exec
+from agg_planner import orders_spec, gmv_spec
+from eda_queries import PAGE_AGGS, EdaQueries, MemoryCache, dashboard_queries
+from query_filters import Filters
+from synthetic_data import generate
+
+
+@pytest.fixture(scope='module')
+def data_path(tmp_path_factory):
+    path = str(tmp_path_factory.mktemp('data') / 'orders.parquet')
+    generate(path, 20_000, n_pincodes=500, chunk_rows=10_000, seed=0)
+    return path
+
+
+# the page's prefetch with a radio showing the orders, then its chart: the gmv the other
+# option shows is never computed, with or without filters, from the raw data
+@pytest.mark.parametrize('filters', [None, Filters(payment_types=('COD',))])
+def test_hidden_option_stays_uncached(data_path, filters):
+    queries = EdaQueries(data_path, cache=MemoryCache(), use_cube=False, use_index=False)
+    shown, hidden = orders_spec(['Year','Month']), gmv_spec(['Year','Month'])
+
+    with ThreadPoolExecutor(max_workers=4) as pool:
+        wait(queries.prefetch(pool, dashboard_queries(100, filters, skip=[('aggregate', (hidden,))])))
+    queries.aggregate(shown, filters)
+
+    assert queries.cache.get(queries._agg_key(shown, filters)) is not None
+    assert queries.cache.get(queries._agg_key(hidden, filters)) is None
+
+    # picking the other option computes it then
+    queries.aggregate(hidden, filters)
+    assert queries.cache.get(queries._agg_key(hidden, filters)) is not None
+
+
+# a miss of one aggregation outside of a prefetch computes that one only
+def test_aggregate_computes_only_its_spec(data_path):
+    queries = EdaQueries(data_path, cache=MemoryCache(), use_cube=False, use_index=False)
+    filters = Filters(payment_types=('COD',))
+
+    queries.aggregate(orders_spec(['Year','Month']), filters)
+    assert queries.cache.get(queries._agg_key(gmv_spec(['Year','Month']), filters)) is None
+
+
+# the same orders as a Year/Month partitioned dataset, two part files in every partition
+@pytest.fixture(scope='module')
+def partitioned_path(tmp_path_factory):
+    path = str(tmp_path_factory.mktemp('data') / 'orders')
+    generate(path, 20_000, n_pincodes=500, chunk_rows=10_000, partitioned=True, seed=0)
+    return path
+
+
+def _results(path, filters):
+    queries = EdaQueries(path, cache=None, use_cube=False, use_index=False)
+    results = {spec: queries.aggregate(spec, filters) for spec in PAGE_AGGS}
+    results['filtered_totals'] = queries.filtered_totals(filters)
+    results['cohort_retention'] = queries.cohort_retention(filters)
+    results['repeat_customers'] = queries.repeat_customers(2015, 'order_payment_type', filters)
+    return results
+
+
+def _normalized(df):
+    # the partitioned files have the smaller types of data_schema.py
+    df = df.with_columns([pl.col(col).cast(pl.Utf8) for col, dtype in df.schema.items() if dtype == pl.Categorical]
+                         + [pl.col(col).cast(pl.Int64) for col, dtype in df.schema.items() if dtype in pl.INTEGER_DTYPES]
+                         + [pl.col(col).round(4) for col, dtype in df.schema.items() if dtype in pl.FLOAT_DTYPES])
+    return df.sort(df.columns)
+
+
+# streaming over the files of a partitioned dataset one by one gives what the single file does
+# & every plan of it streams
+@pytest.mark.parametrize('filters', [None, Filters(categories=('Camera',)), Filters(payment_types=('none',))])
+def test_streaming_partitioned_dataset(data_path, partitioned_path, monkeypatch, filters):
+    expected = _results(data_path, filters)
+
+    monkeypatch.setattr(lazy_exec, 'not_streamed', {})
+    monkeypatch.setattr(lazy_exec, 'STREAMING', True)
+    streamed = _results(partitioned_path, filters)
+
+    for name, df in expected.items():
+        assert _normalized(streamed[name]).frame_equal(_normalized(df)), name
+    assert lazy_exec.not_streamed == {}
+
+
+# new data drops the in memory results of the old data only
+def test_refresh_drops_the_old_versions_results(data_path, tmp_path):
+    path = str(tmp_path / 'orders.parquet')
+    pl.read_parquet(data_path).write_parquet(path)
+    queries = EdaQueries(path, cache=MemoryCache(), use_cube=False, use_index=False)
+    queries.filtered_totals()
+    old_key = queries.cache_key('filtered_totals')
+    queries.cache.put('other-code-version/other-data/filtered_totals()', pl.DataFrame())
+
+    pl.read_parquet(data_path).head(1000).write_parquet(path)
+    assert queries.refresh()
+
+    assert queries.cache.get(old_key) is None
+    assert queries.cache.get('other-code-version/other-data/filtered_totals()') is not None
+    assert queries.filtered_totals()['count'][0] == 1000
@@ -0,0 +1,31 @@
+import errno
+import os
+from unittest import mock
+
+import polars as pl
+import pytest
+
+from result_cache import DiskCache
+
+
+# a file another user wrote or a read only cache can't be touched, it's still served
+@pytest.mark.parametrize('error', [PermissionError(errno.EPERM, 'not the owner'),
+                                   OSError(errno.EROFS, 'read only file system')])
+def test_get_is_a_hit_when_the_file_cant_be_touched(tmp_path, error):
+    cache = DiskCache(str(tmp_path))
+    cache.put('key', pl.DataFrame({'a': [1, 2]}))
+
+    with mock.patch('os.utime', side_effect=error):
+        df = cache.get('key')
+
+    assert df is not None and df['a'].to_list() == [1, 2]
+    assert (cache.hits, cache.misses) == (1, 0)
+
+
+def test_get_touches_the_file(tmp_path):
+    cache = DiskCache(str(tmp_path))
+    cache.put('key', pl.DataFrame({'a': [1]}))
+    os.utime(cache.path('key'), (0, 0))
+
+    cache.get('key')
+    assert os.stat(cache.path('key')).st_mtime > 0
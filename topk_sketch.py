@@ -0,0 +1,226 @@
+import argparse
+import glob
+import math
+import os
+import time
+
+import polars as pl
+import pyarrow.parquet as pq
+
+from partitioned_dataset import scan_source
+from query_filters import VALUE_FILTERS, filter_expr
+
+
+# Approximate top pincodes of every Year without a group table of every pincode.
+#
+# The data is read once in batches. Every batch is grouped on its own and its groups are
+# merged into a Space-Saving style summary of at most `capacity` counters per Year. When
+# the summary grows past that, its smallest counters are dropped, and their biggest count
+# becomes the `floor` of the Year. Every counter is an upper bound of the true value:
+#   - `error` of a counter is how much it may be over
+#   - an item without a counter has at most `floor`
+# Summaries of different batches, files or partitions merge the same way, so they can be
+# built apart. With capacity = 1 / epsilon the error stays within about epsilon * total.
+#
+# verify mode counts the summary's candidates exactly. The result is the exact top n once the
+# n-th exact value is at least the floor (no item left out can beat it), otherwise it falls
+# back to the full group by.
+#
+#     python topk_sketch.py df_consumer_v3.parquet --epsilon 0.001
+#
+# compares the exact, approximate & verified top 15 pincodes.
+
+
+EPSILON = 0.001
+BATCH_SIZE = 256_000
+
+METRICS = {
+    'total_orders': pl.count('order_id'),
+    'total_gmv': pl.sum('gmv'),
+}
+
+
+def capacity_for(epsilon):
+    return math.ceil(1 / epsilon)
+
+
+def _metric_expr(metric):
+    if metric not in METRICS:
+        raise ValueError(f"Unknown metric '{metric}', expected one of {', '.join(METRICS)}")
+    return METRICS[metric].alias(metric)
+
+
+# Counters of the top items of every group (Year): group, key, value (upper bound), error
+class TopKSketch:
+
+    def __init__(self, capacity, counters, floors, group='Year', key='pincode', metric='total_orders'):
+        self.capacity = capacity
+        self.counters = counters
+        self.floors = floors
+        self.group = group
+        self.key = key
+        self.metric = metric
+
+    @classmethod
+    def empty(cls, capacity, group='Year', key='pincode', metric='total_orders'):
+        counters = pl.DataFrame(schema={group: pl.Int64, key: pl.Int64, metric: pl.Float64, 'error': pl.Float64})
+        return cls(capacity, counters, {}, group, key, metric)
+
+    # summary of exact (group, key, metric) values, truncated to capacity
+    @classmethod
+    def from_exact(cls, df, capacity, group='Year', key='pincode', metric='total_orders'):
+        counters = df.select([
+            pl.col(group).cast(pl.Int64), pl.col(key).cast(pl.Int64),
+            pl.col(metric).cast(pl.Float64), pl.lit(0.0).alias('error'),
+        ])
+        return cls(capacity, counters, {}, group, key, metric)._truncate()
+
+    # keep the capacity biggest counters of every group, the biggest dropped value becomes
+    # the floor of the group if it is above the one it had
+    def _truncate(self):
+        ranked = self.counters.sort([self.group, self.metric], descending=[False, True]).with_columns(
+            pl.col(self.metric).cumcount().over(self.group).alias('__rank'))
+
+        dropped = ranked.filter(pl.col('__rank') >= self.capacity)
+        floors = dict(self.floors)
+        for group, value in dropped.groupby(self.group).agg(pl.max(self.metric)).rows():
+            floors[group] = max(floors.get(group, 0.0), value)
+
+        self.counters = ranked.filter(pl.col('__rank') < self.capacity).drop('__rank')
+        self.floors = floors
+        return self
+
+    def floor(self, group):
+        return self.floors.get(group, 0.0)
+
+    # Summary of both streams. A key missing from one side may have had up to that side's
+    # floor there, so the floor is added to its value & error.
+    def merge(self, other):
+        g, k, m = self.group, self.key, self.metric
+        floors = pl.DataFrame({
+            g: list(set(self.floors) | set(other.floors)) or [0],
+            '__floor_l': [self.floor(y) for y in set(self.floors) | set(other.floors)] or [0.0],
+            '__floor_r': [other.floor(y) for y in set(self.floors) | set(other.floors)] or [0.0],
+        }).with_columns(pl.col(g).cast(pl.Int64))
+
+        merged = (self.counters.join(other.counters, on=[g, k], how='outer', suffix='__r')
+                      .join(floors, on=g, how='left')
+                      .with_columns([pl.col('__floor_l').fill_null(0.0), pl.col('__floor_r').fill_null(0.0)]))
+        merged = merged.select([
+            g, k,
+            (pl.col(m).fill_null(pl.col('__floor_l')) + pl.col(f'{m}__r').fill_null(pl.col('__floor_r'))).alias(m),
+            (pl.col('error').fill_null(pl.col('__floor_l')) + pl.col('error__r').fill_null(pl.col('__floor_r'))).alias('error'),
+        ])
+
+        groups = set(self.floors) | set(other.floors)
+        return TopKSketch(self.capacity, merged, {y: self.floor(y) + other.floor(y) for y in groups},
+                          g, k, m)._truncate()
+
+    # top n keys of every group by their upper bound, `guaranteed` when the key's lower bound
+    # is above every key ranked after it so it surely is in the top n
+    def top(self, n):
+        g, m = self.group, self.metric
+        ranked = self.counters.sort([g, m], descending=[True, True])
+        top = ranked.groupby(g, maintain_order=True).head(n)
+
+        # (n + 1)-th value of every group, or its floor when it has n counters or less
+        next_values = {group: value for group, value in
+                       ranked.groupby(g, maintain_order=True).agg(pl.col(m).slice(n, 1).first()).rows()}
+        return top.with_columns(
+            ((pl.col(m) - pl.col('error')) >= pl.col(g).apply(
+                lambda group: max(next_values.get(group) or 0.0, self.floor(group)), return_dtype=pl.Float64)
+             ).alias('guaranteed'))
+
+
+def source_files(path):
+    if os.path.isdir(path):
+        return sorted(glob.glob(os.path.join(path, '*', '*', '*.parquet')))
+    return [path]
+
+
+def _columns_needed(path, metric, filters, group, key):
+    schema = pq.read_schema(source_files(path)[0])
+    columns = {group, key, 'order_id' if metric == 'total_orders' else 'gmv'}
+    if filters is not None:
+        if filters.date_range is not None:
+            columns |= {'date_only', 'Year', 'Month'} & set(schema.names)
+        columns |= {col for field, col in VALUE_FILTERS.items() if getattr(filters, field) is not None}
+    return [col for col in schema.names if col in columns]
+
+
+# Sketch of the top keys of the data in one pass over batches of its rows, any filters
+# (see query_filters.py) applied to every batch
+def build_sketch(path, metric='total_orders', epsilon=EPSILON, filters=None, batch_size=BATCH_SIZE,
+                 group='Year', key='pincode'):
+    capacity = capacity_for(epsilon)
+    columns = _columns_needed(path, metric, filters, group, key)
+    sketch = TopKSketch.empty(capacity, group, key, metric)
+
+    for file in source_files(path):
+        for batch in pq.ParquetFile(file).iter_batches(batch_size=batch_size, columns=columns):
+            df = pl.from_arrow(batch)
+            if filters is not None:
+                df = df.filter(filter_expr(filters, df.columns))
+            if df.height:
+                exact = df.groupby([group, key]).agg(_metric_expr(metric))
+                sketch = sketch.merge(TopKSketch.from_exact(exact, capacity, group, key, metric))
+
+    return sketch
+
+
+def _exact_top(lf, metric, n, group, key):
+    return (lf.groupby([group, key]).agg(_metric_expr(metric))
+              .sort([group, metric], descending=[True, True])
+              .groupby(group, maintain_order=True).head(n)
+              .collect())
+
+
+# Exact top n out of the sketch's candidates, (result, True) when the sketch proves no other
+# key can be in it, otherwise (full group by result, False)
+def verified_top(lf, sketch, n):
+    g, k, m = sketch.group, sketch.key, sketch.metric
+
+    schema = lf.schema
+    candidates = sketch.counters.select([pl.col(g).cast(schema[g]), pl.col(k).cast(schema[k])])
+    top = _exact_top(lf.join(candidates.lazy(), on=[g, k], how='semi'), m, n, g, k)
+
+    for group, values in top.groupby(g).agg(pl.col(m)).rows():
+        if len(values) < n or min(values) < sketch.floor(group):
+            return _exact_top(lf, m, n, g, k), False
+
+    return top, True
+
+
+def _compare(exact, approx, group, key):
+    exact_keys = set(exact.select([group, key]).rows())
+    approx_keys = set(approx.select([group, key]).rows())
+    return len(exact_keys & approx_keys) / max(len(exact_keys), 1)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compare the exact, approximate & verified top pincodes of every Year.')
+    parser.add_argument('source', nargs='?', default='df_consumer_v3.parquet')
+    parser.add_argument('--epsilon', type=float, default=EPSILON, help='error bound as a fraction of the total')
+    parser.add_argument('--n', type=int, default=15)
+    args = parser.parse_args()
+
+    lf = scan_source(args.source)
+
+    for metric in METRICS:
+        start = time.perf_counter()
+        exact = _exact_top(lf, metric, args.n, 'Year', 'pincode')
+        exact_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        sketch = build_sketch(args.source, metric, args.epsilon)
+        approx = sketch.top(args.n)
+        approx_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        verified, proven = verified_top(lf, sketch, args.n)
+        verify_time = time.perf_counter() - start
+
+        print(f'{metric}: exact {exact_time:.3f}s, sketch {approx_time:.3f}s'
+              f' ({_compare(exact, approx, "Year", "pincode") * 100:.0f}% of the top {args.n} found,'
+              f' {approx["guaranteed"].sum()} guaranteed, floors {sketch.floors}),'
+              f' verify {verify_time:.3f}s ({"proven exact" if proven else "fell back to the full group by"})')
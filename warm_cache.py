@@ -0,0 +1,127 @@
+import argparse
+import os
+import sys
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+
+from eda_queries import TOPK_MODES, EdaQueries, dashboard_queries
+from mmm_fit import fit_best, saved_fits_version
+from result_cache import DiskCache
+
+
+# Runs every query of the dashboard into the on disk result cache (see result_cache.py) so the
+# first user after a deploy finds them all computed. Meant to run in the deploy before the app
+# gets traffic, with the same data path & cache settings as the app:
+#
+#     python warm_cache.py --data df_consumer_v3.parquet --cache-dir .eda_cache
+#
+# Queries run on a thread pool, polars releases the GIL while it works so they do run in
+# parallel. It prints the time of every query & exits with 1 if any of them failed.
+#
+# It then fits the MMM grid (see mmm_fit.py) when the saved best fits aren't of this data, the
+# page only shows saved fits.
+
+
+def _describe(method, args):
+    return f'{method}({", ".join(map(repr, args))})'
+
+
+def _run_query(queries, method, args):
+    was_cached = queries.cache.get(queries.cache_key(method, *args)) is not None
+
+    start = time.perf_counter()
+    try:
+        df = getattr(queries, method)(*args)
+    except Exception:
+        return {'query': _describe(method, args), 'seconds': time.perf_counter() - start,
+                'cached': was_cached, 'rows': None, 'error': traceback.format_exc()}
+
+    return {'query': _describe(method, args), 'seconds': time.perf_counter() - start,
+            'cached': was_cached, 'rows': df.height, 'error': None}
+
+
+def _run_batch(queries, specs):
+    start = time.perf_counter()
+    try:
+        computed = queries.aggregate_batch(specs)
+    except Exception:
+        return {'query': f'aggregate_batch({len(specs)} specs)', 'seconds': time.perf_counter() - start,
+                'cached': False, 'rows': None, 'error': traceback.format_exc()}
+
+    return {'query': f'aggregate_batch({len(specs)} specs)', 'seconds': time.perf_counter() - start,
+            'cached': not computed, 'rows': None, 'error': None}
+
+
+def warm_cache(queries, max_points=1000, workers=None):
+    query_list = dashboard_queries(max_points)
+    with ThreadPoolExecutor(max_workers=workers or os.cpu_count()) as pool:
+        # the aggregations together from one scan of the data, then looked up one by one as the
+        # page does once the scan is done
+        batch = pool.submit(_run_batch, queries, [args[0] for method, args in query_list if method == 'aggregate'])
+        futures = [pool.submit(_run_query, queries, method, args)
+                   for method, args in query_list if method != 'aggregate']
+        results = [batch.result()]
+        futures += [pool.submit(_run_query, queries, method, args)
+                    for method, args in query_list if method == 'aggregate']
+        return results + [future.result() for future in futures]
+
+
+def warm_mmm_fits(queries):
+    was_cached = saved_fits_version(queries) is not None
+
+    start = time.perf_counter()
+    try:
+        if not was_cached:
+            fit_best(queries)
+    except Exception:
+        return {'query': 'mmm_fit.fit_best()', 'seconds': time.perf_counter() - start,
+                'cached': was_cached, 'rows': None, 'error': traceback.format_exc()}
+
+    return {'query': 'mmm_fit.fit_best()', 'seconds': time.perf_counter() - start,
+            'cached': was_cached, 'rows': None, 'error': None}
+
+
+def print_report(results, wall):
+    print(f'{"query":<90} {"seconds":>8} {"rows":>8}  status')
+    for result in sorted(results, key=lambda r: r['seconds'], reverse=True):
+        status = 'FAILED' if result['error'] else ('cached' if result['cached'] else 'computed')
+        rows = '' if result['rows'] is None else f'{result["rows"]:,}'
+        print(f'{result["query"][:90]:<90} {result["seconds"]:>8.3f} {rows:>8}  {status}')
+
+    computed = sum(1 for r in results if not r['cached'] and not r['error'])
+    print(f'\n{len(results)} queries, {computed} computed, {sum(1 for r in results if r["error"])} failed'
+          f' in {wall:.2f}s (sum of query times {sum(r["seconds"] for r in results):.2f}s)')
+
+    for result in results:
+        if result['error']:
+            print(f'\n{result["query"]} failed:\n{result["error"]}', file=sys.stderr)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Precompute the dashboard's queries into the result cache.")
+    parser.add_argument('--data', default=os.environ.get('EDA_DATA_PATH', 'df_consumer_v3.parquet'))
+    parser.add_argument('--cache-dir', default=os.environ.get('EDA_CACHE_DIR', '.eda_cache'))
+    parser.add_argument('--cache-max-mb', type=int, default=int(os.environ.get('EDA_CACHE_MAX_MB', 1024)))
+    parser.add_argument('--max-points', type=int, default=int(os.environ.get('EDA_MAX_CHART_POINTS', 1000)),
+                        help='points of the downsampled daily series, as in the app')
+    parser.add_argument('--workers', type=int, default=None, help='threads (default: one per cpu)')
+    parser.add_argument('--topk', choices=TOPK_MODES, default=os.environ.get('EDA_TOPK', 'exact'),
+                        help='top pincodes mode, as in the app')
+    parser.add_argument('--topk-epsilon', type=float, default=float(os.environ.get('EDA_TOPK_EPSILON', 0.001)))
+    parser.add_argument('--no-mmm', action='store_true', help="don't fit the MMM grid")
+    args = parser.parse_args()
+
+    if not args.cache_dir:
+        parser.error('--cache-dir is empty, there is no shared cache to warm')
+
+    queries = EdaQueries(args.data, cache=DiskCache(args.cache_dir, max_bytes=args.cache_max_mb * 1024 * 1024),
+                         topk=args.topk, topk_epsilon=args.topk_epsilon)
+
+    start = time.perf_counter()
+    results = warm_cache(queries, args.max_points, args.workers)
+    if not args.no_mmm:
+        results.append(warm_mmm_fits(queries))
+    print_report(results, time.perf_counter() - start)
+
+    sys.exit(1 if any(result['error'] for result in results) else 0)